@@ -0,0 +1,283 @@
+"""Offline benchmarks
+
+Encodes synthetic sources (see `sources.py`) end to end with `detect_volume`,
+`encode_all` and `mux_clean_directory`, and reports wall time, per-stage time,
+fps, output bitrates and peak memory as JSON. A report can be compared against
+a stored baseline to catch regressions.
+
+  python3 benchmarks/run.py -o report.json
+  python3 benchmarks/run.py -baseline report.json
+
+The package is imported from `src/` next to this folder, so the working tree
+is what gets measured.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import sources
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, os.pardir, 'src'))
+
+BENCHMARKS = ['detect_volume', 'encode_all', 'mux_clean_directory']
+"""(list of str): Benchmarks run for every scenario, in order."""
+
+COMPARED = ['wall', 'cpu', 'peak_rss']
+"""(list of str): Metrics checked against the baseline; higher is worse."""
+
+MIN_SECONDS = 0.5
+"""(float): Time differences below this are never regressions, since short
+stages are dominated by noise."""
+
+
+def run_scenario(name, work_dir, jobs=1, repeat=1):
+  """
+  Runs every benchmark on a scenario's source.
+
+  Args:
+    name (str): Scenario name, see `sources.SCENARIOS`.
+    work_dir (str): Folder for sources, outputs and caches.
+    jobs (int, optional): `max_workers` for every benchmark. Defaults to 1.
+    repeat (int, optional): Number of times to run each benchmark. The run
+      with the median wall time is reported. Defaults to 1.
+
+  Returns:
+    (dict of str: any): Dictionary with keys `source` and `benchmarks`.
+  """
+  from amqencode import audio, encode
+
+  scenario = sources.SCENARIOS[name]
+  source = sources.make_source(work_dir, name)
+  clean_audio = sources.make_clean_audio(work_dir, name)
+  frames = scenario['rate'] * scenario['duration']
+  out_dir = os.path.join(work_dir, 'out', name)
+  source_dir = os.path.join(out_dir, 'source')
+  clean_dir = os.path.join(out_dir, 'clean')
+
+  calls = {
+    'detect_volume': lambda: audio.detect_volume(source, segments=jobs),
+    'encode_all': lambda: encode.encode_all(
+      source, source_dir, norm=True, max_workers=jobs),
+    'mux_clean_directory': lambda: encode.mux_clean_directory(
+      source_dir, clean_audio, clean_dir, norm=True, max_workers=jobs),
+  }
+  runs = {benchmark: [] for benchmark in BENCHMARKS}
+  for _ in range(repeat):
+    # Every repetition starts cold: no outputs and no on-disk caches.
+    shutil.rmtree(out_dir, ignore_errors=True)
+    shutil.rmtree(os.environ['AMQENCODE_CACHE_DIR'], ignore_errors=True)
+    for benchmark in BENCHMARKS:
+      runs[benchmark].append(_measure(calls[benchmark]))
+
+  benchmarks = {}
+  for benchmark, measurements in runs.items():
+    walls = [m['wall'] for m in measurements]
+    summary = sorted(measurements, key=lambda m: m['wall'])[
+      (len(measurements) - 1) // 2]
+    summary['walls'] = walls
+    summary['fps'] = (
+      frames / summary['wall'] if benchmark == 'encode_all' else None)
+    benchmarks[benchmark] = summary
+  return {
+    'source': dict(scenario, sha256=sources.sha256(source)),
+    'benchmarks': benchmarks,
+  }
+
+
+def _measure(call):
+  """
+  Runs a benchmark call and summarizes the stage results it recorded.
+  """
+  from amqencode import trace
+
+  with trace.recording() as recorder:
+    start = time.monotonic()
+    call()
+    wall = time.monotonic() - start
+  results = recorder.results
+  failed = trace.failed(results)
+  if len(failed) != 0:
+    raise RuntimeError(
+      f"{failed[0]['stage']} {failed[0]['job']} exited with code "
+      f"{failed[0]['returncode']}")
+
+  stages = {}
+  outputs = {}
+  for result in results:
+    stage = stages.setdefault(
+      result['stage'], {'count': 0, 'wall': 0, 'cpu': 0, 'peak_rss': None})
+    stage['count'] += 1
+    stage['wall'] += result['wall']
+    stage['cpu'] += result['cpu'] or 0
+    stage['peak_rss'] = _max(stage['peak_rss'], result['max_rss'])
+    if result['bytes'] is not None:
+      outputs[os.path.basename(result['output'])] = {
+        'bytes': result['bytes'],
+        'bitrate': result['bitrate'],
+      }
+  return {
+    'wall': wall,
+    'cpu': sum(stage['cpu'] for stage in stages.values()),
+    'peak_rss': max(
+      (s['peak_rss'] for s in stages.values() if s['peak_rss'] is not None),
+      default=None),
+    'stages': stages,
+    'outputs': outputs,
+  }
+
+
+def _max(a, b):
+  """
+  Returns the larger of two values, ignoring None.
+  """
+  if a is None:
+    return b
+  if b is None:
+    return a
+  return max(a, b)
+
+
+def environment():
+  """
+  Returns details of the machine and ffmpeg build, to tell apart reports
+  that aren't comparable.
+
+  Returns:
+    (dict of str: any): Environment details.
+  """
+  version = subprocess.run(
+    ['ffmpeg', '-hide_banner', '-version'],
+    stdout=subprocess.PIPE, universal_newlines=True).stdout
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'machine': platform.machine(),
+    'cpus': os.cpu_count(),
+    'ffmpeg': version.splitlines()[0] if version else None,
+  }
+
+
+def compare(report, baseline, threshold):
+  """
+  Compares a report against a baseline report.
+
+  Args:
+    report (dict of str: any): New report.
+    baseline (dict of str: any): Baseline report.
+    threshold (float): Relative increase counted as a regression.
+
+  Returns:
+    (tuple of list of str, int): Comparison lines and the number of
+      regressions.
+  """
+  lines = []
+  regressions = 0
+  for name, scenario in report['scenarios'].items():
+    base_scenario = baseline['scenarios'].get(name)
+    if base_scenario is None:
+      lines.append(f"{name}: not in baseline")
+      continue
+    if base_scenario['source']['sha256'] != scenario['source']['sha256']:
+      lines.append(f"{name}: source differs from baseline")
+    for benchmark, summary in scenario['benchmarks'].items():
+      base = base_scenario['benchmarks'].get(benchmark)
+      if base is None:
+        continue
+      for metric in COMPARED:
+        old, new = base.get(metric), summary.get(metric)
+        if not old or new is None:
+          continue
+        change = new / old - 1
+        line = (f"{name} {benchmark} {metric}: {_format(metric, old)} -> "
+          f"{_format(metric, new)} ({change:+.1%})")
+        if change > threshold and (
+            metric == 'peak_rss' or new - old >= MIN_SECONDS):
+          line += ' REGRESSION'
+          regressions += 1
+        lines.append(line)
+  return lines, regressions
+
+
+def _format(metric, value):
+  """
+  Formats a metric for display.
+  """
+  if metric == 'peak_rss':
+    return f"{value / (1 << 20):.1f}MiB"
+  return f"{value:.2f}s"
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog='benchmarks/run.py')
+  parser.add_argument('scenarios', type=str, nargs='*',
+    metavar='SCENARIO', help='scenarios to run: '
+      + ', '.join(sources.SCENARIOS)
+      + ' or all (default=' + ' '.join(sources.DEFAULT_SCENARIOS) + ')')
+  parser.add_argument('-o', type=str, dest='output',
+    metavar='FILE', help='write the JSON report to FILE instead of stdout')
+  parser.add_argument('-baseline', type=str,
+    metavar='FILE', help='compare against a previous report and exit with '
+      'code 1 on regressions')
+  parser.add_argument('-threshold', type=float,
+    metavar='FRACTION', help='relative slowdown counted as a regression '
+      '(default=0.1)')
+  parser.add_argument('-jobs', type=int,
+    metavar='N', help='max_workers for every benchmark (default=1)')
+  parser.add_argument('-repeat', type=int,
+    metavar='N', help='runs per benchmark; the median is reported '
+      '(default=1)')
+  parser.add_argument('-work', type=str, dest='work_dir',
+    metavar='DIRECTORY', help='folder for sources and outputs '
+      '(default=benchmarks/work)')
+  parser.set_defaults(
+    scenarios=[],
+    threshold=0.1,
+    jobs=1,
+    repeat=1,
+    work_dir=os.path.join(_HERE, 'work')
+  )
+  args = parser.parse_args(argv)
+
+  names = args.scenarios or sources.DEFAULT_SCENARIOS
+  if names == ['all']:
+    names = list(sources.SCENARIOS)
+  unknown = [name for name in names if name not in sources.SCENARIOS]
+  if len(unknown) != 0:
+    print('unknown scenarios: ' + ' '.join(unknown))
+    exit(1)
+
+  # Keep the package's caches inside the work folder, so that runs don't
+  # depend on (or pollute) the user's cache.
+  os.environ['AMQENCODE_CACHE_DIR'] = os.path.join(args.work_dir, 'cache')
+
+  report = {
+    'environment': environment(),
+    'settings': {'jobs': args.jobs, 'repeat': args.repeat},
+    'scenarios': {
+      name: run_scenario(name, args.work_dir, args.jobs, args.repeat)
+      for name in names},
+  }
+  if args.output:
+    with open(args.output, 'w') as file:
+      json.dump(report, file, indent=2)
+  else:
+    print(json.dumps(report, indent=2))
+
+  if args.baseline:
+    with open(args.baseline) as file:
+      baseline = json.load(file)
+    lines, regressions = compare(report, baseline, args.threshold)
+    print('\n'.join(lines), file=sys.stderr)
+    if regressions != 0:
+      exit(1)
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
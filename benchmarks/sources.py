@@ -0,0 +1,117 @@
+"""Synthetic benchmark sources
+
+Generates deterministic test sources with ffmpeg's lavfi inputs, so that
+benchmarks run offline and every machine encodes the same frames.
+"""
+
+
+__all__ = [
+  'SCENARIOS',
+  'DEFAULT_SCENARIOS',
+  'make_source',
+  'make_clean_audio',
+  'sha256',
+]
+
+
+import hashlib
+import os
+import subprocess
+
+
+SCENARIOS = {
+  '360p-10s': {'width': 640, 'height': 360, 'rate': 24, 'duration': 10},
+  '720p-30s': {'width': 1280, 'height': 720, 'rate': 24, 'duration': 30},
+  '1080p-60s': {'width': 1920, 'height': 1080, 'rate': 24, 'duration': 60},
+}
+"""(dict of str: dict): Source size, frame rate and length of each scenario."""
+
+DEFAULT_SCENARIOS = ['360p-10s', '720p-30s']
+"""(list of str): Scenarios run when none are requested."""
+
+_BITEXACT = [
+  '-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact',
+  '-map_metadata', '-1']
+
+
+def make_source(work_dir, name):
+  """
+  Generates the video source for a scenario, unless it already exists.
+  The video is `testsrc2` encoded with single-threaded x264, and the audio is
+  a beeping `sine`, so the output is the same on every run.
+
+  Args:
+    work_dir (str): Folder to write sources to.
+    name (str): Scenario name, see `SCENARIOS`.
+
+  Returns:
+    (str): Path to the source.
+  """
+  scenario = SCENARIOS[name]
+  path = os.path.join(work_dir, 'sources', name + '.mkv')
+  if os.path.isfile(path):
+    return path
+  duration = scenario['duration']
+  _run([
+    '-f', 'lavfi', '-i', 'testsrc2=size={width}x{height}:rate={rate}:'
+      'duration={duration}'.format(**scenario),
+    '-f', 'lavfi', '-i', 'sine=frequency=440:beep_factor=4:'
+      f'sample_rate=48000:duration={duration}',
+    '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18',
+    '-pix_fmt', 'yuv420p', '-g', str(scenario['rate'] * 2), '-threads', '1',
+    '-c:a', 'pcm_s16le', '-ac', '2'], path)
+  return path
+
+
+def make_clean_audio(work_dir, name):
+  """
+  Generates the clean audio for a scenario, unless it already exists.
+
+  Args:
+    work_dir (str): Folder to write sources to.
+    name (str): Scenario name, see `SCENARIOS`.
+
+  Returns:
+    (str): Path to the clean audio.
+  """
+  duration = SCENARIOS[name]['duration']
+  path = os.path.join(work_dir, 'sources', f"{name}-clean.wav")
+  if os.path.isfile(path):
+    return path
+  _run([
+    '-f', 'lavfi', '-i', 'sine=frequency=660:beep_factor=2:'
+      f'sample_rate=48000:duration={duration}',
+    '-c:a', 'pcm_s16le', '-ac', '2'], path)
+  return path
+
+
+def sha256(path):
+  """
+  Returns the SHA-256 digest of a file, to check that sources match across
+  machines.
+
+  Args:
+    path (str): Path to file.
+
+  Returns:
+    (str): Hex digest.
+  """
+  digest = hashlib.sha256()
+  with open(path, 'rb') as file:
+    for block in iter(lambda: file.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def _run(args, path):
+  """
+  Runs ffmpeg with the given arguments, writing to a temporary file that is
+  renamed into place once complete.
+  """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  partial = path + '.part' + os.path.splitext(path)[1]
+  subprocess.run(
+    ['ffmpeg', '-y', '-nostdin', '-hide_banner', '-loglevel', 'error']
+      + args + _BITEXACT + [partial],
+    check=True)
+  os.replace(partial, path)
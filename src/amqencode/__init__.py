@@ -1,8 +1,37 @@
-from . import audio, video, common, encode
-
-__all__ = (
-  audio.__all__ +
-  video.__all__ +
-  common.__all__ +
-  encode.__all__
-)
\ No newline at end of file
+import importlib
+import os
+import sys
+
+# Every module in the package, listed from its folder so that new modules
+# can't be left out.
+_SUBMODULES = tuple(sorted(
+  name[:-3] for name in os.listdir(os.path.dirname(__file__))
+  if name.endswith('.py') and not name.startswith('_')))
+
+_EXPORTS = ('audio', 'video', 'common', 'encode', 'probe')
+
+
+def _all():
+  return [
+    name
+    for module in _EXPORTS
+    for name in importlib.import_module(f".{module}", __name__).__all__]
+
+
+# Submodules are imported on first use, so that the CLI and workers only load
+# what they run. Module __getattr__ needs Python 3.7.
+if sys.version_info < (3, 7):
+  for _name in _SUBMODULES:
+    importlib.import_module(f".{_name}", __name__)
+  __all__ = _all()
+else:
+  def __getattr__(name):
+    if name in _SUBMODULES:
+      return importlib.import_module(f".{name}", __name__)
+    if name == '__all__':
+      globals()['__all__'] = _all()
+      return globals()['__all__']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+  def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
@@ -1,9 +1,12 @@
 import argparse
+import logging
 import os
+import sys
 
-from . import encode
 
-if __name__ == "__main__":
+def encode_main(argv):
+  from . import encode, plan, progress, trace
+
   parser = argparse.ArgumentParser()
   parser.add_argument('-i', type=str, required=True,
     help='input video')
@@ -23,21 +26,75 @@ if __name__ == "__main__":
     metavar='TIME', help='encode duration')
   parser.add_argument('-norm', action='store_true',
     help='normalize output volume (default=False)')
+  parser.add_argument('-incremental', action='store_true',
+    help='skip outputs that are already up to date (default=False)')
+  parser.add_argument('-passcache', action='store_true', dest='passlog_cache',
+    help='reuse cached pass 1 statistics (default=False)')
+  parser.add_argument('-mezzanine', action='store_true',
+    help='cut the trimmed range once to a cached lossless intermediate and '
+      'encode from it (default=False)')
+  parser.add_argument('-snapseek', action='store_true', dest='snap_seek',
+    help='move a start time just before a source keyframe onto it '
+      '(default=False)')
+  parser.add_argument('-validate', action='store_true',
+    help='check new outputs without decoding them (default=False)')
   parser.add_argument('-outdir', type=str,
     metavar='DIRECTORY', help='output path')
   parser.add_argument('-skip', type=int, nargs='+', dest='skip_resolutions',
     metavar='RESOLUTION', help='resolutions to skip, separated by spaces')
+  parser.add_argument('-workers', type=int, dest='max_workers',
+    metavar='N', help='number of resolutions to encode at once (default=1)')
+  parser.add_argument('-engine', type=str, choices=['separate', 'split'],
+    help='encode resolutions separately, or from one split decode '
+      '(default=separate)')
+  parser.add_argument('-chunks', type=int,
+    metavar='N', help='split each webm into N segments encoded in parallel '
+      '(default=1)')
+  parser.add_argument('-cpus', type=int, dest='cpu_budget',
+    metavar='N', help='tune VP9 threading and limit total encoder threads '
+      'to N (0=all cores)')
+  parser.add_argument('-size', type=str, dest='target_size',
+    metavar='SIZE', help='raise crf so that each webm stays under SIZE, '
+      'e.g. 8M or 7.5MiB')
+  parser.add_argument('-bitrate', type=str, dest='target_bitrate',
+    metavar='RATE', help='raise crf so that each webm stays under an '
+      'overall bitrate, e.g. 2M')
+  parser.add_argument('-draft', '--draft', type=int, nargs='?', const=0,
+    metavar='HEIGHT', help='quickly encode a single-pass preview of one '
+      'resolution (default=the smallest) and the mp3 into OUTDIR/preview')
+  parser.add_argument('-dry-run', '--dry-run', action='store_true',
+    dest='dry_run', help='print the planned ffmpeg commands and their '
+      'dependencies without running them (default=False)')
+  parser.add_argument('-executor', type=str, choices=plan.EXECUTORS,
+    help='run the planned jobs on WORKERS threads or processes, or '
+      'serially (default=thread)')
+  parser.add_argument('-progress', action='store_true',
+    help='show a compact progress line instead of ffmpeg output '
+      '(default=False)')
+  parser.add_argument('-trace', type=str,
+    metavar='FILE', help='write a Chrome trace of every ffmpeg stage')
   parser.set_defaults(
+    incremental=False,
+    progress=False,
+    passlog_cache=False,
+    mezzanine=False,
+    snap_seek=False,
+    validate=False,
+    dry_run=False,
+    executor='thread',
+    engine='separate',
+    chunks=1,
     norm=False,
+    max_workers=1,
     outdir='./source/',
     skip_resolutions=[]
   )
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
 
   if not os.path.isfile(args.i):
     print('invalid input file provided')
     exit()
-  
+
   kwargs = {k: v for k, v in {
     'ss': args.ss,
     'to': args.to,
@@ -47,9 +104,325 @@ if __name__ == "__main__":
     'crf': args.crf,
     'g': args.g}.items() if not v == None}
 
-  encode.encode_all(
-    args.i, args.outdir,
+  if args.snap_seek:
+    kwargs['snap_seek'] = True
+  if args.draft:
+    kwargs['resolutions'] = [0, args.draft]
+
+  options = dict(
     vf=args.vf, af=args.af,
     norm=args.norm,
+    incremental=args.incremental,
+    passlog_cache=args.passlog_cache,
+    mezzanine=args.mezzanine,
+    validate=args.validate,
+    max_workers=args.max_workers,
+    engine=args.engine,
+    chunks=args.chunks,
+    cpu_budget=args.cpu_budget,
+    target_size=args.target_size,
+    target_bitrate=args.target_bitrate,
+    draft=args.draft is not None,
     vp9_settings=vp9_settings,
     **kwargs)
+
+  if args.dry_run:
+    try:
+      job_plan = encode.compile_encode_all(args.i, args.outdir, **options)
+    except (OSError, RuntimeError, ValueError) as error:
+      print(error)
+      exit(1)
+    print(plan.format_plan(job_plan))
+    return
+
+  display = progress.ProgressDisplay() if args.progress else None
+
+  try:
+    results = encode.encode_all(
+      args.i, args.outdir, executor=args.executor, progress_callback=display,
+      **options)
+  except (RuntimeError, ValueError) as error:
+    print(error)
+    exit(1)
+  if display is not None:
+    display.close()
+  if args.trace:
+    trace.write_chrome_trace(results, args.trace)
+
+  for result in results:
+    if result['stage'] == 'skip':
+      print(f"Skipping {result['job']}, already up to date")
+
+  failed = trace.failed(results)
+  for result in failed:
+    print(trace.format_failure(result))
+  if len(failed) != 0:
+    exit(1)
+
+
+def batch_main(argv):
+  from . import batch, progress, trace
+
+  parser = argparse.ArgumentParser(prog='amqencode batch')
+  parser.add_argument('manifest', type=str,
+    help='JSON or CSV manifest of encode jobs')
+  parser.add_argument('-jobs', type=int, dest='max_jobs',
+    metavar='N', help='number of manifest entries to encode at once '
+      '(default=1)')
+  parser.add_argument('-workers', type=int, dest='max_workers',
+    metavar='N', help='default number of ffmpeg processes to run at once '
+      'per entry (default=1)')
+  parser.add_argument('-processes', type=int, dest='max_processes',
+    metavar='N', help='limit ffmpeg processes across the batch to N, '
+      'shared by every entry')
+  parser.add_argument('-cpus', type=int, dest='cpu_budget',
+    metavar='N', help='tune VP9 threading and limit total encoder threads '
+      'across the batch to N (0=all cores)')
+  parser.add_argument('-progress', action='store_true',
+    help='show a compact progress line instead of ffmpeg output '
+      '(default=False)')
+  parser.add_argument('-trace', type=str,
+    metavar='FILE', help='write a Chrome trace of every ffmpeg stage '
+      'in the batch')
+  parser.add_argument('-journal', type=str,
+    metavar='FILE', help='journal of job states used to resume the batch '
+      '(default=MANIFEST.journal)')
+  parser.add_argument('-resume', '--resume', action='store_true',
+    help='skip jobs the journal lists as done and keep finished outputs '
+      'of the others (default=False)')
+  parser.set_defaults(
+    progress=False,
+    resume=False,
+    max_jobs=1,
+    max_workers=1
+  )
+  args = parser.parse_args(argv)
+
+  if not os.path.isfile(args.manifest):
+    print('invalid manifest file provided')
+    exit(1)
+
+  display = progress.ProgressDisplay() if args.progress else None
+  with trace.recording() as recorder:
+    summary = batch.run_batch(
+      batch.load_manifest(args.manifest),
+      max_jobs=args.max_jobs,
+      max_workers=args.max_workers,
+      cpu_budget=args.cpu_budget,
+      progress_callback=display,
+      journal_file=args.journal or args.manifest + '.journal',
+      resume=args.resume,
+      max_processes=args.max_processes)
+  if display is not None:
+    display.close()
+  if args.trace:
+    recorder.write_chrome_trace(args.trace)
+  print(batch.format_summary(summary))
+  if summary['failed'] != 0:
+    exit(1)
+
+
+def watch_main(argv):
+  from . import capabilities, progress, watch
+
+  parser = argparse.ArgumentParser(prog='amqencode watch')
+  parser.add_argument('folder', type=str,
+    help='folder to watch for source videos, clean audio and JSON sidecars')
+  parser.add_argument('-outdir', type=str,
+    metavar='DIRECTORY', help='output path (default=FOLDER/encoded)')
+  parser.add_argument('-jobs', type=int, dest='max_jobs',
+    metavar='N', help='number of drops to encode at once (default=1)')
+  parser.add_argument('-workers', type=int, dest='max_workers',
+    metavar='N', help='default number of resolutions to encode at once '
+      'per drop (default=1)')
+  parser.add_argument('-cpus', type=int, dest='cpu_budget',
+    metavar='N', help='tune VP9 threading and limit total encoder threads '
+      'to N (0=all cores)')
+  parser.add_argument('-settle', type=float,
+    metavar='SECONDS', help='time files must stop changing before they are '
+      'picked up (default=5)')
+  parser.add_argument('-poll', type=float, dest='poll_interval',
+    metavar='SECONDS', help='time between folder scans (default=2)')
+  parser.add_argument('-needclean', action='store_true', dest='require_audio',
+    help='wait for clean audio before encoding a video (default=False)')
+  parser.add_argument('-progress', action='store_true',
+    help='show a compact progress line instead of ffmpeg output '
+      '(default=False)')
+  parser.set_defaults(
+    progress=False,
+    require_audio=False,
+    max_jobs=1,
+    max_workers=1,
+    settle=5,
+    poll_interval=2
+  )
+  args = parser.parse_args(argv)
+
+  if not os.path.isdir(args.folder):
+    print('invalid folder provided')
+    exit(1)
+
+  try:
+    capabilities.require(capabilities.ENCODERS, ['volumedetect'])
+  except (OSError, RuntimeError) as error:
+    print(error)
+    exit(1)
+
+  display = progress.ProgressDisplay() if args.progress else None
+  try:
+    watch.watch(
+      args.folder,
+      args.outdir,
+      max_jobs=args.max_jobs,
+      max_workers=args.max_workers,
+      cpu_budget=args.cpu_budget,
+      settle=args.settle,
+      poll_interval=args.poll_interval,
+      require_audio=args.require_audio,
+      progress_callback=display)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if display is not None:
+      display.close()
+
+
+def queue_main(argv):
+  from . import batch, jobqueue
+
+  parser = argparse.ArgumentParser(prog='amqencode queue')
+  parser.add_argument('database', type=str,
+    help='queue database, on a volume shared by the workers')
+  parser.add_argument('action', type=str, choices=['add', 'status', 'retry'],
+    help='add manifest entries as jobs, list jobs, or requeue failed jobs')
+  parser.add_argument('manifest', type=str, nargs='?',
+    help='JSON or CSV manifest of encode jobs to add')
+  args = parser.parse_args(argv)
+
+  job_queue = jobqueue.JobQueue(args.database)
+  if args.action == 'add':
+    if args.manifest is None or not os.path.isfile(args.manifest):
+      print('invalid manifest file provided')
+      exit(1)
+    for entry in batch.load_manifest(args.manifest):
+      job_id = job_queue.submit('entry', **entry)
+      print(f"queued job {job_id}: {entry['input']}")
+  elif args.action == 'retry':
+    print(f"requeued {job_queue.retry()} jobs")
+  else:
+    for job in job_queue.jobs():
+      print(f"{job['id']:>5} {job['state']:<8} {job['kind']} "
+        f"{job['args'].get('input', '')} {job['worker'] or ''}")
+    print(', '.join(
+      f"{count} {state}" for state, count in job_queue.counts().items()))
+
+
+def worker_main(argv):
+  from . import capabilities, jobqueue, progress
+
+  parser = argparse.ArgumentParser(prog='amqencode worker')
+  parser.add_argument('database', type=str,
+    help='queue database, on a volume shared by the workers')
+  parser.add_argument('-jobs', type=int, dest='max_jobs',
+    metavar='N', help='number of jobs to run at once (default=1)')
+  parser.add_argument('-workers', type=int, dest='max_workers',
+    metavar='N', help='default number of resolutions to encode at once '
+      'per job (default=1)')
+  parser.add_argument('-cpus', type=int, dest='cpu_budget',
+    metavar='N', help='tune VP9 threading and limit total encoder threads '
+      'to N (0=all cores)')
+  parser.add_argument('-lease', type=float,
+    metavar='SECONDS', help='time before a job of an unresponsive worker is '
+      'requeued (default=60)')
+  parser.add_argument('-poll', type=float, dest='poll_interval',
+    metavar='SECONDS', help='time between checks of an empty queue '
+      '(default=5)')
+  parser.add_argument('-once', action='store_true', dest='exit_when_idle',
+    help='exit when the queue is empty instead of waiting for more jobs '
+      '(default=False)')
+  parser.add_argument('-progress', action='store_true',
+    help='show a compact progress line instead of ffmpeg output '
+      '(default=False)')
+  parser.set_defaults(
+    progress=False,
+    exit_when_idle=False,
+    max_jobs=1,
+    max_workers=1,
+    lease=60,
+    poll_interval=5
+  )
+  args = parser.parse_args(argv)
+
+  try:
+    capabilities.require(capabilities.ENCODERS, ['volumedetect'])
+  except (OSError, RuntimeError) as error:
+    print(error)
+    exit(1)
+
+  display = progress.ProgressDisplay() if args.progress else None
+  try:
+    jobqueue.run_worker(
+      jobqueue.JobQueue(args.database, lease=args.lease),
+      max_jobs=args.max_jobs,
+      max_workers=args.max_workers,
+      cpu_budget=args.cpu_budget,
+      poll_interval=args.poll_interval,
+      exit_when_idle=args.exit_when_idle,
+      progress_callback=display)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if display is not None:
+      display.close()
+
+
+def validate_main(argv):
+  from . import validate
+
+  parser = argparse.ArgumentParser(prog='amqencode validate')
+  parser.add_argument('directories', type=str, nargs='+',
+    metavar='DIRECTORY', help='folders of webms and mp3s to check')
+  parser.add_argument('-workers', type=int, dest='max_workers',
+    metavar='N', help='number of files to check at once (default=4)')
+  parser.add_argument('-deep', action='store_true',
+    help='also decode short samples of every file (default=False)')
+  parser.set_defaults(
+    max_workers=4,
+    deep=False
+  )
+  args = parser.parse_args(argv)
+
+  invalid = 0
+  for directory in args.directories:
+    if not os.path.isdir(directory):
+      print(f"invalid directory provided: {directory}")
+      exit(1)
+    for report in validate.validate_directory(
+        directory, max_workers=args.max_workers, deep=args.deep):
+      if report['ok']:
+        print(f"[ok] {report['output']}")
+        continue
+      invalid += 1
+      print(f"[INVALID] {report['output']}")
+      for error in report['errors']:
+        print(f"  {error}")
+  if invalid != 0:
+    exit(1)
+
+
+COMMANDS = {
+  'batch': batch_main,
+  'watch': watch_main,
+  'queue': queue_main,
+  'worker': worker_main,
+  'validate': validate_main,
+}
+
+if __name__ == "__main__":
+  # Library modules report through logging; show their messages like prints.
+  logging.basicConfig(format='%(message)s', level=logging.INFO,
+    stream=sys.stdout)
+  if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+    COMMANDS[sys.argv[1]](sys.argv[2:])
+  else:
+    encode_main(sys.argv[1:])
@@ -0,0 +1,634 @@
+"""Asynchronous API
+
+asyncio counterparts of the probing, encoding and muxing functions. They run
+the same compiled ffmpeg commands as the blocking functions, through
+`asyncio.create_subprocess_exec`, so a single event loop can drive many
+ffmpeg processes without a thread for each one.
+
+Every function takes an optional `limit` semaphore that bounds how many
+ffmpeg processes run at the same time. Share one semaphore between calls to
+apply a global limit.
+"""
+
+
+__all__ = [
+    'run_ffmpeg',
+    'probe',
+    'probe_duration',
+    'detect_volume',
+    'get_norm_filter',
+    'encode_mp3',
+    'encode_opus',
+    'encode_webm',
+    'mux_clean',
+    'encode_all',
+    'run_plan',
+]
+
+
+import asyncio
+import copy
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import partial
+from typing import Callable, Dict, List, Tuple, Union
+
+from . import (
+    audio, common, encode, lazy, mux, plan, probe as probe_, progress, trace,
+    video)
+
+ffmpeg = lazy.import_module('ffmpeg')
+
+_get_running_loop = getattr(
+    asyncio, 'get_running_loop', asyncio.get_event_loop)
+"""(callable): Returns the running event loop. Python 3.6 lacks
+`asyncio.get_running_loop`, but `get_event_loop` does the same inside a
+coroutine there."""
+
+
+async def run_ffmpeg(
+        cmd: List[str],
+        limit: asyncio.Semaphore = None,
+        capture_log: bool = False,
+        capture_output: bool = False,
+        job: str = None,
+        pass_number: int = None,
+        progress_callback: Callable = None,
+        stage: str = None,
+        output_file: str = None,
+        outputs: List[str] = None
+        ) -> Tuple[Dict[str, any], List[str], bytes]:
+    """
+    Runs a compiled ffmpeg (or ffprobe) command and records its stage result,
+    see `trace`. ffmpeg commands report their progress through
+    `-progress pipe:1`, see `progress.run`. CPU time isn't available for
+    processes run by the event loop.
+
+    Args:
+        cmd (list of str): Command line to run.
+        limit (asyncio.Semaphore, optional): Semaphore to hold while the
+            process runs.
+        capture_log (bool, optional): Whether to collect stderr lines instead
+            of passing them through to the terminal. Defaults to False.
+        capture_output (bool, optional): Whether to collect stdout.
+            Not available for ffmpeg commands. Defaults to False.
+        job (str, optional): Job name passed to the progress callback.
+        pass_number (int, optional): Pass number passed to the callback.
+        progress_callback (callable, optional): Called with each progress
+            report.
+        stage (str, optional): Stage name for the result. Defaults to the
+            program name.
+        output_file (str, optional): File written by the command, to record
+            its size and bitrate. It is written to a partial path and moved
+            into place only if the command succeeds.
+        outputs (list of str, optional): Every file written by the command,
+            handled the same way. Defaults to `output_file`.
+
+    Returns:
+        (tuple of dict of str: any, list of str, bytes): Stage result,
+            stderr lines (if captured) and stdout (if captured).
+
+    Raises:
+        asyncio.CancelledError: If cancelled. The process is killed and its
+            partial output removed first.
+    """
+    if outputs is None:
+        outputs = [output_file] if output_file is not None else []
+    full_cmd = common.stage_outputs(cmd, outputs)
+    report = cmd[0] == 'ffmpeg'
+    if report:
+        full_cmd[1:1] = progress.progress_args(
+            progress_callback is not None, capture_log)
+    if limit is not None:
+        await limit.acquire()
+    try:
+        start_time = time.time()
+        start = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            *full_cmd,
+            stdout=(asyncio.subprocess.PIPE
+                    if capture_output or report else None),
+            stderr=asyncio.subprocess.PIPE if capture_log else None)
+        stdout_task = None
+        try:
+            if report:
+                stdout_task = asyncio.ensure_future(_report(
+                    proc.stdout, job, pass_number, progress_callback))
+            elif capture_output:
+                stdout_task = asyncio.ensure_future(proc.stdout.read())
+            lines = []
+            if capture_log:
+                async for line in proc.stderr:
+                    lines.append(line.decode('utf-8', 'replace'))
+            output = b''
+            out_time = None
+            if report:
+                out_time = await stdout_task
+            elif capture_output:
+                output = await stdout_task
+            returncode = await proc.wait()
+        except BaseException:
+            # Cancelled, e.g. because a sibling encode failed: don't leave
+            # ffmpeg running or a partial file behind.
+            if stdout_task is not None:
+                stdout_task.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            common.finish_outputs(outputs, False)
+            raise
+        wall = time.monotonic() - start
+        common.finish_outputs(outputs, returncode == 0)
+    finally:
+        if limit is not None:
+            limit.release()
+    result = trace.stage_result(
+        stage or cmd[0], job, cmd, returncode, start_time, wall,
+        output_file=output_file, duration=out_time)
+    return result, lines, output
+
+
+async def _report(
+        stream: asyncio.StreamReader,
+        job: str,
+        pass_number: int,
+        progress_callback: Callable) -> Union[float, None]:
+    """
+    Reads ffmpeg's progress reports from a stream, passing each one to the
+    progress callback.
+
+    Returns:
+        (float or None): Last position reached in the output, in seconds.
+    """
+    lines = []
+    out_time = None
+    async for line in stream:
+        lines.append(line.decode('utf-8', 'replace'))
+        if not line.startswith(b'progress='):
+            continue
+        for fields in progress.parse_progress(lines):
+            if fields['out_time'] is not None:
+                out_time = fields['out_time']
+            if progress_callback is not None:
+                progress_callback(
+                    job, pass_number,
+                    fields['out_time'], fields['fps'], fields['speed'])
+        lines = []
+    return out_time
+
+
+async def probe(
+        input_file: str,
+        limit: asyncio.Semaphore = None) -> Dict[str, any]:
+    """
+    Returns ffprobe's stream and format info for the input file, using the
+    same cache as `probe.probe`.
+
+    Args:
+        input_file (str): Path to media file to probe.
+        limit (asyncio.Semaphore, optional): Process limit.
+
+    Returns:
+        (dict of str: any): Dictionary with keys `streams` and `format`.
+
+    Raises:
+        ffmpeg.Error: If ffprobe fails.
+    """
+    metadata = probe_.load_cached(input_file)
+    if metadata is None:
+        cmd = probe_.compile_probe(input_file)
+        result, lines, output = await run_ffmpeg(
+            cmd, limit, capture_log=True, capture_output=True,
+            job=os.path.basename(input_file), stage='probe')
+        if result['returncode'] != 0:
+            raise _error(cmd[0], lines)
+        metadata = json.loads(output.decode('utf-8'))
+        probe_.store_cached(input_file, metadata)
+    # Callers get their own copy, so they can't corrupt the shared cache.
+    return copy.deepcopy(metadata)
+
+
+async def probe_duration(
+        input_file: str,
+        limit: asyncio.Semaphore = None) -> float:
+    """
+    Returns the duration of the first audio stream of an input file.
+    See `audio.probe_duration`.
+    """
+    return audio.duration_from_metadata(await probe(input_file, limit))
+
+
+async def detect_volume(
+        input_file: str,
+        segments: int = 1,
+        limit: asyncio.Semaphore = None,
+        progress_callback: Callable = None,
+        **kwargs) -> Dict[str, Union[float, None]]:
+    """
+    Returns the peak and mean dB for the input file.
+    See `audio.detect_volume`; segments are analyzed concurrently.
+
+    Returns:
+        (dict of str: float): Dictionary with keys `peak_db` and `mean_db`.
+    """
+    if segments <= 1:
+        _, lines, _ = await run_ffmpeg(
+            audio.compile_volumedetect(input_file, **kwargs),
+            limit, capture_log=True, job='volumedetect',
+            progress_callback=progress_callback, stage='volumedetect')
+        levels = audio.parse_volumedetect(lines)
+        return {
+            'peak_db': levels['peak_db'],
+            'mean_db': levels['mean_db']}
+
+    start = common.parse_timestamp(kwargs.pop('ss', 0))
+    if 't' in kwargs:
+        end = start + common.parse_timestamp(kwargs.pop('t'))
+        kwargs.pop('to', None)
+    elif 'to' in kwargs:
+        end = common.parse_timestamp(kwargs.pop('to'))
+    else:
+        end = await probe_duration(input_file, limit)
+    length = (end - start) / segments
+
+    outputs = await _gather(*(
+        run_ffmpeg(
+            audio.compile_volumedetect(
+                input_file,
+                ss=f"{start + i*length:.6f}", t=f"{length:.6f}",
+                **kwargs),
+            limit, capture_log=True,
+            job=f"volumedetect [{i + 1}/{segments}]",
+            progress_callback=progress_callback, stage='volumedetect')
+        for i in range(segments)))
+    return audio.merge_levels([
+        audio.parse_volumedetect(lines) for _, lines, _ in outputs])
+
+
+async def get_norm_filter(
+        input_file: str,
+        target_peak_db: float = audio.DEFAULT_PEAK_DB,
+        target_mean_db: float = audio.DEFAULT_MEAN_DB,
+        limit: asyncio.Semaphore = None,
+        **kwargs) -> Dict[str, str]:
+    """
+    Returns a filter dictionary for applying gain based on peak and mean dB.
+    See `audio.get_norm_filter`.
+
+    Returns:
+        (dict of str: str): Filter dictionary for volume adjustment.
+    """
+    return audio.gain_filter(
+        await detect_volume(input_file, limit=limit, **kwargs),
+        target_peak_db, target_mean_db)
+
+
+async def encode_mp3(
+        input_file: str,
+        output_file: str,
+        limit: asyncio.Semaphore = None,
+        **kwargs) -> Dict[str, any]:
+    """
+    Encodes an mp3 from the supplied input file. See `audio.encode_mp3`.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+    """
+    common.ensure_dir(output_file)
+    progress_callback = kwargs.pop('progress_callback', None)
+    return await _check(
+        audio.compile_mp3(input_file, output_file, **kwargs), limit,
+        os.path.basename(output_file), progress_callback=progress_callback,
+        stage='mp3', output_file=output_file)
+
+
+async def encode_opus(
+        input_file: str,
+        output_file: str,
+        limit: asyncio.Semaphore = None,
+        **kwargs) -> Dict[str, any]:
+    """
+    Encodes an audio-only Opus webm from the supplied input file.
+    See `audio.encode_opus`.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+    """
+    common.ensure_dir(output_file)
+    progress_callback = kwargs.pop('progress_callback', None)
+    return await _check(
+        audio.compile_audio(input_file, output_file, 'webm', **kwargs),
+        limit, os.path.basename(output_file),
+        progress_callback=progress_callback,
+        stage='opus', output_file=output_file)
+
+
+async def encode_webm(
+        input_file: str,
+        output_file: str,
+        muted: bool = False,
+        limit: asyncio.Semaphore = None,
+        progress_callback: Callable = None,
+        **kwargs) -> List[Dict[str, any]]:
+    """
+    Encodes a webm from the supplied input file using 2-pass VP9.
+    See `video.encode_webm`. Chunked encoding and the pass log cache are
+    only available in the blocking API.
+
+    Returns:
+        (list of dict of str: any): Stage results of both passes, see
+            `trace`.
+    """
+    common.ensure_dir(output_file)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='amqencode-') as log_dir:
+        kwargs.setdefault('passlogfile', os.path.join(log_dir, 'ffmpeg2pass'))
+        cmds = video.compile_webm(input_file, output_file, muted, **kwargs)
+        for pass_number, cmd in enumerate(cmds, 1):
+            results.append(await _check(
+                cmd, limit, os.path.basename(output_file), pass_number,
+                progress_callback, stage=f"pass {pass_number}",
+                output_file=output_file if pass_number == 2 else None))
+    return results
+
+
+async def mux_clean(
+        input_video: str,
+        input_audio: str,
+        output_file: str,
+        norm: bool = False,
+        limit: asyncio.Semaphore = None,
+        progress_callback: Callable = None) -> Dict[str, any]:
+    """
+    Muxes an input file with a clean audio file. See `mux.mux_clean`.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+    """
+    common.ensure_dir(output_file)
+    if input_video.endswith('.mp3'):
+        await probe(input_video, limit)
+    return await _check(mux.compile_mux_clean(
+        input_video, input_audio, output_file,
+        await get_norm_filter(
+            input_audio, limit=limit, progress_callback=progress_callback)
+        if norm else {}),
+        limit, os.path.basename(output_file),
+        progress_callback=progress_callback,
+        stage='mux', output_file=output_file)
+
+
+async def encode_all(
+        input_file: str,
+        output_dir: str = './source/',
+        norm: bool = False,
+        muted: bool = False,
+        skip_resolutions: Union[str, list] = '360',
+        max_workers: int = 1,
+        shared_audio: bool = True,
+        limit: asyncio.Semaphore = None,
+        progress_callback: Callable = None,
+        **kwargs) -> List[Dict[str, any]]:
+    """
+    Encodes a video in all requested resolutions, running the encodes
+    concurrently. See `encode.encode_all` for arguments. The plan is
+    compiled by `encode.compile_encode_all` in the loop's default executor,
+    and its ffmpeg jobs run on the event loop; jobs that aren't plain ffmpeg
+    commands (pass 1 through the pass log cache, concat lists, validation
+    and fingerprints) run in the executor.
+
+    Args:
+        max_workers (int, optional): Number of ffmpeg processes to run at
+            the same time, if `limit` isn't given. Defaults to 1.
+        limit (asyncio.Semaphore, optional): Process limit shared with other
+            calls.
+        progress_callback (callable, optional): Called with progress reports
+            from every ffmpeg process. See `progress`.
+        cpu_budget (int or resources.CpuBudget, optional): Only picks the
+            threading settings of each resolution, as in
+            `encode.encode_all`. Jobs aren't scheduled against the budget;
+            bound them with `limit` instead.
+
+    Returns:
+        (list of dict of str: any): Stage results of the jobs of the plan,
+            see `trace`. Probes are only passed to active recorders.
+
+    Raises:
+        ffmpeg.Error: If an encode fails. The other encodes are cancelled
+            and their processes killed first.
+    """
+
+    if limit is None:
+        limit = asyncio.Semaphore(max(max_workers, 1))
+    job_plan = await _get_running_loop().run_in_executor(
+        None, trace.propagate(partial(
+            encode.compile_encode_all, input_file, output_dir, norm, muted,
+            skip_resolutions, max_workers, shared_audio=shared_audio,
+            progress_callback=progress_callback, **kwargs)))
+    with trace.recording() as recorder:
+        await run_plan(job_plan, limit, progress_callback)
+    return recorder.results
+
+
+async def run_plan(
+        job_plan: Dict[str, any],
+        limit: asyncio.Semaphore = None,
+        progress_callback: Callable = None) -> List[Dict[str, any]]:
+    """
+    Runs a plan, starting each job as soon as its dependencies have
+    finished. See `plan.run_plan`. A failed ffmpeg job raises; jobs that
+    depend on any other failed job, e.g. a failed validation, are skipped.
+
+    Args:
+        job_plan (dict of str: any): Plan to run.
+        limit (asyncio.Semaphore, optional): Process limit.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg. See `progress`.
+
+    Returns:
+        (list of dict of str: any): Stage results, see `trace`.
+
+    Raises:
+        ffmpeg.Error: If an ffmpeg job fails. The running jobs are
+            cancelled and their processes killed first.
+    """
+    jobs = plan.order(job_plan)
+    values = {}
+    done = set()
+    failed = set()
+    running = {}
+    cancel = threading.Event()
+    with trace.recording() as recorder, tempfile.TemporaryDirectory(
+            prefix='amqencode-') as work_dir:
+        variables = {'work': work_dir}
+        for output_file in job_plan.get('skipped', []):
+            trace.stage_result(
+                'skip', os.path.basename(output_file), [], 0, time.time(),
+                0, output_file=output_file)
+        try:
+            while len(jobs) != 0 or len(running) != 0:
+                for job in list(jobs):
+                    if any(dep in failed for dep in job['deps']):
+                        jobs.remove(job)
+                        failed.add(job['id'])
+                    elif all(dep in done for dep in job['deps']):
+                        jobs.remove(job)
+                        if job['kind'] == 'gain':
+                            variables['gain'] = audio.gain_filter(
+                                audio.merge_levels(
+                                    [values[dep] for dep in job['deps']])
+                                )['volume']
+                            done.add(job['id'])
+                            continue
+                        running[asyncio.ensure_future(_run_job(
+                            job, dict(variables), limit, progress_callback,
+                            cancel))] = job['id']
+                if len(running) == 0:
+                    continue
+                finished, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    job_id = running.pop(task)
+                    ok, values[job_id] = task.result()
+                    (done if ok else failed).add(job_id)
+        except BaseException:
+            cancel.set()
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+    return recorder.results
+
+
+async def _run_job(
+        job: Dict[str, any],
+        variables: Dict[str, str],
+        limit: asyncio.Semaphore,
+        progress_callback: Callable,
+        cancel: threading.Event) -> Tuple[bool, any]:
+    """
+    Runs any job but a `gain` job. See `plan.run_job`.
+
+    Returns:
+        (tuple of bool, any): Whether the job succeeded, and the result of
+            its parser if it has one.
+
+    Raises:
+        ffmpeg.Error: If it is an ffmpeg job and ffmpeg fails.
+    """
+    if job['kind'] == 'ffmpeg' and not job['args'].get('passlog_cache'):
+        job = plan.prepare_job(job, variables)
+        parse = plan.PARSERS.get(job['parse'])
+        result, lines, _ = await run_ffmpeg(
+            job['cmd'], limit, capture_log=parse is not None,
+            job=job['job'], pass_number=job['pass_number'],
+            progress_callback=progress_callback, stage=job['stage'],
+            output_file=job['outputs'][0] if job['outputs'] else None,
+            outputs=job['outputs'])
+        if result['returncode'] != 0:
+            raise _error(job['cmd'][0], lines)
+        return True, parse(lines) if parse is not None else None
+
+    if job['kind'] == 'ffmpeg':
+        await limit.acquire()
+    try:
+        results, value = await _get_running_loop().run_in_executor(
+            None, partial(
+                _run_job_in_thread, job, variables, progress_callback,
+                cancel))
+    finally:
+        if job['kind'] == 'ffmpeg':
+            limit.release()
+    for result in results:
+        trace.record(result)
+    if job['kind'] == 'ffmpeg' and len(trace.failed(results)) != 0:
+        raise _error(job['cmd'][0], [])
+    return len(trace.failed(results)) == 0, value
+
+
+def _run_job_in_thread(
+        job: Dict[str, any],
+        variables: Dict[str, str],
+        progress_callback: Callable,
+        cancel: threading.Event) -> Tuple[List[Dict[str, any]], any]:
+    """
+    Runs `plan.run_job` in an executor thread, stopping its ffmpeg
+    processes once `cancel` is set.
+    """
+    with trace.cancellation(cancel):
+        return plan.run_job(job, variables, progress_callback)
+
+
+async def _gather(*aws) -> list:
+    """
+    Runs awaitables concurrently, like `asyncio.gather`. If one of them
+    raises, or the caller is cancelled, the others are cancelled and awaited
+    before the exception propagates, so that no ffmpeg process outlives the
+    call (see `run_ffmpeg`).
+
+    Args:
+        *aws: Awaitables to run.
+
+    Returns:
+        (list): Their results, in order.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _check(
+        cmd: List[str],
+        limit: asyncio.Semaphore = None,
+        job: str = None,
+        pass_number: int = None,
+        progress_callback: Callable = None,
+        stage: str = None,
+        output_file: str = None) -> Dict[str, any]:
+    """
+    Runs a compiled ffmpeg command, raising if it fails.
+
+    Args:
+        cmd (list of str): Command line to run.
+        limit (asyncio.Semaphore, optional): Process limit.
+        job (str, optional): Job name passed to the progress callback.
+        pass_number (int, optional): Pass number passed to the callback.
+        progress_callback (callable, optional): Progress callback.
+        stage (str, optional): Stage name for the result.
+        output_file (str, optional): File written by the command.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg exits with an error.
+    """
+    result, lines, _ = await run_ffmpeg(
+        cmd, limit, job=job, pass_number=pass_number,
+        progress_callback=progress_callback,
+        stage=stage, output_file=output_file)
+    if result['returncode'] != 0:
+        raise _error(cmd[0], lines)
+    return result
+
+
+def _error(cmd: str, lines: List[str]) -> Exception:
+    """
+    Returns an `ffmpeg.Error` like the one ffmpeg-python raises.
+
+    Args:
+        cmd (str): Name of the failed program.
+        lines (list of str): Captured stderr lines.
+
+    Returns:
+        (ffmpeg.Error): Exception to raise.
+    """
+    return ffmpeg.Error(cmd, None, ''.join(lines).encode('utf-8'))
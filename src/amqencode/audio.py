@@ -10,25 +10,37 @@ __all__ = [
     'MP3_SETTINGS',
     'OPUS_SETTINGS',
     'detect_volume',
+    'compile_volumedetect',
+    'parse_volumedetect',
+    'merge_levels',
     'get_norm_filter',
+    'gain_filter',
     'probe_duration',
+    'duration_from_metadata',
+    'extract_audio',
     'encode_mp3',
+    'compile_mp3',
+    'compile_audio',
+    'encode_opus',
 ]
 
 
+import math
+import os
 import re
-import subprocess
+from functools import partial
 from os import devnull
-from typing import Dict, Union
+from typing import Callable, Dict, Iterable, List, Union
 
-import ffmpeg
-
-from . import common
+from . import common, lazy, probe, progress
 from .video import VP9_SETTINGS
 
+ffmpeg = lazy.import_module('ffmpeg')
+
 
 _MEAN_DB_RE = re.compile(r' mean_volume: (?P<mean>-?[0-9]+\.?[0-9]*)')
 _PEAK_DB_RE = re.compile(r' max_volume: (?P<peak>-?[0-9]+\.?[0-9]*)')
+_N_SAMPLES_RE = re.compile(r' n_samples: (?P<n>[0-9]+)')
 
 _IGNORE_STREAMS = {'vn': None, 'sn': None, 'dn': None}
 """(dict of str: None): Streams to ignore when encoding audio."""
@@ -44,6 +56,12 @@ MP3_SETTINGS = {'c:a': 'libmp3lame'}
 OPUS_SETTINGS = {'c:a': 'libopus'}
 """(dict of str: str): Opus encoding parameters."""
 
+INTERMEDIATE_SETTINGS = {'c:a': 'pcm_f32le'}
+"""(dict of str: str): Lossless parameters for intermediate audio files."""
+
+_STAGES = {'wav': 'extract', 'mp3': 'mp3', 'webm': 'opus'}
+"""(dict of str: str): Stage names of the audio encodes by output format."""
+
 DEFAULT_PEAK_DB = -0.5
 """(float): Target normalization peak volume in decibels."""
 
@@ -53,12 +71,24 @@ DEFAULT_MEAN_DB = -18.5
 
 def detect_volume(
         input_file: str,
+        segments: int = 1,
+        max_workers: int = None,
+        progress_callback: Callable = None,
         **kwargs) -> Dict[str, Union[float, None]]:
     """
     Returns the peak and mean dB for the input file.
 
     Args:
         input_file (str): Path to audio file to detect.
+        segments (int, optional): Number of equal time ranges to analyze in
+            parallel. Results are merged exactly: the peak is the maximum of
+            the segment peaks and the mean is averaged by energy, weighted by
+            sample count. Defaults to 1.
+        max_workers (int, optional): Number of segments to analyze at the
+            same time. Defaults to `segments`.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg, with the job `volumedetect` (and the segment number
+            if segmented). See `progress`. Defaults to None.
         **kwargs: Arbitrary keyword arguments. Includes arguments specific to
         this package, as well as any native ffmpeg parameters you wish to pass.
 
@@ -66,6 +96,95 @@ def detect_volume(
         (dict of str: float): Dictionary with keys `peak_db` and `mean_db`.
     """
 
+    if segments <= 1:
+        levels = _detect_levels(
+            input_file, 'volumedetect', progress_callback, **kwargs)
+        return {
+            'peak_db': levels['peak_db'],
+            'mean_db': levels['mean_db']}
+
+    start = common.parse_timestamp(kwargs.pop('ss', 0))
+    if 't' in kwargs:
+        end = start + common.parse_timestamp(kwargs.pop('t'))
+        kwargs.pop('to', None)
+    elif 'to' in kwargs:
+        end = common.parse_timestamp(kwargs.pop('to'))
+    else:
+        end = probe_duration(input_file)
+    length = (end - start) / segments
+
+    results = common.run_parallel([
+        partial(
+            _detect_levels, input_file,
+            f"volumedetect [{i + 1}/{segments}]", progress_callback,
+            ss=f"{start + i*length:.6f}", t=f"{length:.6f}",
+            **kwargs)
+        for i in range(segments)],
+        max_workers or segments)
+
+    return merge_levels(results)
+
+
+def merge_levels(
+        results: List[Dict[str, Union[float, int, None]]]
+        ) -> Dict[str, Union[float, None]]:
+    """
+    Merges the levels of several segments into the levels of the whole.
+    The peak is the maximum of the segment peaks and the mean is averaged by
+    energy, weighted by sample count.
+
+    Args:
+        results (list of dict of str: float/int):
+            Levels from `parse_volumedetect` for each segment.
+
+    Returns:
+        (dict of str: float): Dictionary with keys `peak_db` and `mean_db`.
+    """
+    peaks = [r['peak_db'] for r in results if r['peak_db'] is not None]
+    n_samples = sum(r['n_samples'] for r in results)
+    energy = sum(
+        r['n_samples'] * 10 ** (r['mean_db'] / 10)
+        for r in results if r['mean_db'] is not None)
+    return {
+        'peak_db': max(peaks) if len(peaks) != 0 else None,
+        'mean_db': (10 * math.log10(energy / n_samples)
+                    if energy > 0 else None)}
+
+
+def _detect_levels(
+        input_file: str,
+        job: str = 'volumedetect',
+        progress_callback: Callable = None,
+        **kwargs) -> Dict[str, Union[float, int, None]]:
+    """
+    Runs volumedetect over the input file, parsing ffmpeg's log as it is
+    written.
+
+    Args:
+        input_file (str): Path to audio file to detect.
+        job (str, optional): Job name for progress and the stage result.
+        progress_callback (callable, optional): Progress callback.
+        **kwargs: Native ffmpeg parameters to pass, including seeking.
+
+    Returns:
+        (dict of str: float/int): See `parse_volumedetect`.
+    """
+
+    return progress.run_and_parse(
+        compile_volumedetect(input_file, **kwargs), parse_volumedetect,
+        job, progress_callback=progress_callback, stage='volumedetect')[1]
+
+
+def compile_volumedetect(
+        input_file: str,
+        **kwargs) -> List[str]:
+    """
+    Returns the ffmpeg command for volume detection without running it.
+    See `detect_volume` for arguments.
+
+    Returns:
+        (list of str): Command line.
+    """
     seek = common.extract_seek(kwargs)
     cmd =  (ffmpeg.input(input_file)
             .filter('volumedetect')
@@ -73,25 +192,38 @@ def detect_volume(
             .compile())
     if len(seek) != 0:
         cmd[1:1] = seek
+    return cmd
+
+
+def parse_volumedetect(
+        lines: Iterable[str]) -> Dict[str, Union[float, int, None]]:
+    """
+    Parses the levels reported by ffmpeg's volumedetect filter.
 
-    proc = subprocess.run(
-        cmd, check=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT)
-    output = proc.stdout.decode('utf-8').splitlines()
+    Args:
+        lines (iterable of str): Lines of ffmpeg's log output.
 
+    Returns:
+        (dict of str: float/int): Dictionary with keys `peak_db`, `mean_db`
+            and `n_samples`.
+    """
     mean_db = None
     peak_db = None
-    for line in output:
+    n_samples = 0
+    for line in lines:
         mean_db_match = _MEAN_DB_RE.search(line)
         peak_db_match = _PEAK_DB_RE.search(line)
+        n_samples_match = _N_SAMPLES_RE.search(line)
         if mean_db_match:
             mean_db = float(mean_db_match.group('mean'))
         if peak_db_match:
             peak_db = float(peak_db_match.group('peak'))
+        if n_samples_match:
+            n_samples = int(n_samples_match.group('n'))
     return {
         'peak_db': peak_db,
-        'mean_db': mean_db}
+        'mean_db': mean_db,
+        'n_samples': n_samples}
 
 
 def get_norm_filter(
@@ -115,7 +247,27 @@ def get_norm_filter(
     Returns:
         (dict of str: str): Filter dictionary for volume adjustment.
     """
-    input_levels = detect_volume(input_file, **kwargs)
+    return gain_filter(
+        detect_volume(input_file, **kwargs),
+        target_peak_db, target_mean_db)
+
+
+def gain_filter(
+        input_levels: Dict[str, float],
+        target_peak_db: float = DEFAULT_PEAK_DB,
+        target_mean_db: float = DEFAULT_MEAN_DB) -> Dict[str, str]:
+    """
+    Returns a filter dictionary for applying gain to audio with known levels.
+    See `get_norm_filter`.
+
+    Args:
+        input_levels (dict of str: float): Levels from `detect_volume`.
+        target_peak_db (float, optional): Defaults to -0.5 dB.
+        target_mean_db (float, optional): Defaults to -18.5 dB.
+
+    Returns:
+        (dict of str: str): Filter dictionary for volume adjustment.
+    """
     diff_peak = target_peak_db - input_levels['peak_db']
     diff_mean = target_mean_db - input_levels['mean_db']
     return {'volume': f"{min(diff_peak, diff_mean):.1f}dB"}
@@ -130,15 +282,71 @@ def probe_duration(input_file: str) -> float:
 
     Returns:
         (float): Duration of audio stream in seconds.
+
+    Raises:
+        ValueError: If there is no audio stream, or no duration is known.
+    """
+    return duration_from_metadata(probe.probe(input_file))
+
+
+def duration_from_metadata(metadata: Dict[str, any]) -> float:
+    """
+    Returns the duration of the first audio stream from probe results, or
+    the duration of the container if the stream doesn't have one.
+    See `probe_duration`.
+
+    Args:
+        metadata (dict of str: any): Probe results from `probe.probe`.
+
+    Returns:
+        (float): Duration in seconds.
+
+    Raises:
+        ValueError: If there is no audio stream, or no duration is known.
     """
-    metadata = ffmpeg.probe(input_file, select_streams='a')['streams'][0]
-    return float(metadata['duration'])
+    stream = probe.first_stream(metadata, 'audio')
+    duration = stream.get('duration') or metadata['format'].get('duration')
+    if duration is None:
+        raise ValueError(
+            f"No duration found in {metadata['format'].get('filename')}")
+    return float(duration)
+
+
+def extract_audio(
+        input_file: str,
+        output_file: str,
+        **kwargs) -> Dict[str, any]:
+    """
+    Decodes and filters the audio of the input file once into a lossless
+    intermediate WAV, so that it can be analyzed and encoded several times
+    without touching the source again.
+
+    Args:
+        input_file (str): Path to media file to extract from.
+        output_file (str): Path to output intermediate file.
+        **kwargs: Arbitrary keyword arguments. Includes arguments specific to
+            this package, as well as any native ffmpeg parameters you wish to
+            pass.
+
+    Keyword Args:
+        af (str or dict of str: str/None):
+            String or dictionary of audio filters to apply.
+        progress_callback (callable):
+            Called with progress reports from ffmpeg, with the output file
+            name as the job. See `progress`.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+    """
+    return _encode_audio(
+        input_file, output_file, 'wav',
+        **dict(kwargs, **INTERMEDIATE_SETTINGS))
 
 
 def encode_mp3(
         input_file: str,
         output_file: str,
-        **kwargs) -> None:
+        **kwargs) -> Dict[str, any]:
     """
     Encodes an mp3 from the supplied input file.
 
@@ -152,10 +360,106 @@ def encode_mp3(
     Keyword Args:
         af (str or dict of str: str/None):
             String or dictionary of audio filters to apply.
+        progress_callback (callable):
+            Called with progress reports from ffmpeg, with the output file
+            name as the job. See `progress`.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+    """
+    return _encode_audio(input_file, output_file, 'mp3', **kwargs)
+
+
+def encode_opus(
+        input_file: str,
+        output_file: str,
+        **kwargs) -> Dict[str, any]:
+    """
+    Encodes an audio-only Opus webm from the supplied input file, suitable for
+    muxing into video webms without re-encoding.
+
+    Args:
+        input_file (str): Path to media file to encode from.
+        output_file (str): Path to output encoded file.
+        **kwargs: Arbitrary keyword arguments. Includes arguments specific to
+            this package, as well as any native ffmpeg parameters you wish to
+            pass.
+
+    Keyword Args:
+        af (str or dict of str: str/None):
+            String or dictionary of audio filters to apply.
+        progress_callback (callable):
+            Called with progress reports from ffmpeg, with the output file
+            name as the job. See `progress`.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+    """
+    return _encode_audio(input_file, output_file, 'webm', **kwargs)
+
+
+def compile_mp3(
+        input_file: str,
+        output_file: str,
+        **kwargs) -> List[str]:
+    """
+    Returns the ffmpeg command for an mp3 encode without running it.
+    See `encode_mp3` for arguments.
+
+    Returns:
+        (list of str): Command line.
+    """
+    return compile_audio(input_file, output_file, 'mp3', **kwargs)
+
+
+def _encode_audio(
+        input_file: str,
+        output_file: str,
+        output_format: str,
+        **kwargs) -> Dict[str, any]:
+    """
+    Encodes the audio of the input file, dropping any video-only parameters.
+
+    Args:
+        input_file (str): Path to media file to encode from.
+        output_file (str): Path to output encoded file.
+        output_format (str): ffmpeg output format name.
+        **kwargs: Arbitrary keyword arguments. See `encode_mp3`.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
     """
 
     common.ensure_dir(output_file)
 
+    progress_callback = kwargs.pop('progress_callback', None)
+    cmd = compile_audio(input_file, output_file, output_format, **kwargs)
+    return progress.run(
+        cmd, os.path.basename(output_file),
+        progress_callback=progress_callback,
+        stage=_STAGES.get(output_format, output_format),
+        output_file=output_file)
+
+
+def compile_audio(
+        input_file: str,
+        output_file: str,
+        output_format: str,
+        **kwargs) -> List[str]:
+    """
+    Returns the ffmpeg command for an audio-only encode without running it.
+    Video-only parameters are dropped.
+
+    Args:
+        input_file (str): Path to media file to encode from.
+        output_file (str): Path to output encoded file.
+        output_format (str): ffmpeg output format name.
+        **kwargs: Arbitrary keyword arguments. See `encode_mp3`.
+
+    Returns:
+        (list of str): Command line.
+    """
+
     audio = common.apply_filters(
         ffmpeg.input(input_file).audio,
         common.parse_filter_string(kwargs.pop('af', {})))
@@ -168,8 +472,7 @@ def encode_mp3(
     seek = common.extract_seek(kwargs)
     cmd = ffmpeg.output(
         audio, output_file,
-        format='mp3', **kwargs).compile()
+        format=output_format, **kwargs).compile()
     if len(seek) != 0:
         cmd[1:1] = seek
-
-    subprocess.run(cmd, check=False)
+    return cmd
@@ -0,0 +1,380 @@
+"""Batch encoding
+
+Functions for running many encodes from a manifest file. Each manifest entry
+becomes an `encode_all` job, optionally followed by `mux_clean_directory`.
+A pool limits how many entries encode at once, and optionally a second pool,
+shared by the plans of every entry, limits how many ffmpeg processes run
+across the batch.
+Job state transitions can be written to a journal (see `journal`), so that an
+interrupted batch can be resumed.
+"""
+
+
+__all__ = [
+    'load_manifest',
+    'normalize_entry',
+    'output_dirs',
+    'run_entry',
+    'run_batch',
+    'format_summary',
+]
+
+
+import csv
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+from . import encode, journal, plan, resources, trace
+
+
+_log = logging.getLogger(__name__)
+
+
+_PATH_KEYS = ('input', 'output_dir', 'clean_audio', 'clean_dir')
+"""(tuple of str): Manifest keys holding paths relative to the manifest."""
+
+_LIST_KEYS = ('resolutions', 'skip_resolutions')
+"""(tuple of str): Manifest keys holding lists of resolutions."""
+
+_BOOL_KEYS = (
+    'norm', 'muted', 'shared_audio', 'incremental', 'passlog_cache',
+    'mezzanine', 'validate')
+"""(tuple of str): Manifest keys holding booleans."""
+
+_INT_KEYS = ('max_workers', 'chunks', 'cpu_budget')
+"""(tuple of str): Manifest keys holding integers."""
+
+
+def load_manifest(manifest_file: str) -> List[Dict[str, any]]:
+    """
+    Reads a JSON or CSV manifest into a list of job entries.
+
+    A JSON manifest is either a list of entries, or an object with a `jobs`
+    list and an optional `defaults` entry merged into every job.
+    A CSV manifest has one entry per row, with column names as keys; empty
+    cells are ignored and resolution lists are separated by spaces.
+
+    Every entry needs an `input`. Optional keys are `output_dir`,
+    `clean_audio` and `clean_dir` (to mux clean audio after encoding), plus
+    any `encode_all` argument such as `ss`, `to`, `norm` or `vf`.
+    Relative paths are resolved against the manifest's folder. Entries
+    can't share an output folder, since their outputs have the same names;
+    see `output_dirs` for the defaults.
+
+    Args:
+        manifest_file (str): Path to `.json` or `.csv` manifest.
+
+    Returns:
+        (list of dict of str: any): Job entries.
+
+    Raises:
+        ValueError: If the manifest is malformed, or two entries write to
+            the same folder.
+    """
+    if manifest_file.lower().endswith('.csv'):
+        with open(manifest_file, newline='') as file:
+            entries = [
+                {k.strip(): v.strip() for k, v in row.items()
+                 if k and v is not None and v.strip() != ''}
+                for row in csv.DictReader(file)]
+    else:
+        with open(manifest_file) as file:
+            data = json.load(file)
+        if isinstance(data, dict):
+            defaults = data.get('defaults', {})
+            entries = [dict(defaults, **entry)
+                       for entry in data.get('jobs', [])]
+        else:
+            entries = data
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    entries = [normalize_entry(entry, base_dir) for entry in entries]
+    seen = {}
+    for entry in entries:
+        output_dir, clean_dir = output_dirs(entry)
+        directories = [output_dir] + (
+            [clean_dir] if 'clean_audio' in entry else [])
+        for directory in directories:
+            directory = os.path.normcase(os.path.abspath(directory))
+            if directory in seen:
+                raise ValueError(
+                    f"{seen[directory]} and {entry['input']} both write to "
+                    f"{directory}; set a different output_dir or clean_dir")
+            seen[directory] = entry['input']
+    return entries
+
+
+def normalize_entry(
+        entry: Dict[str, any],
+        base_dir: str) -> Dict[str, any]:
+    """
+    Converts manifest values to the types `encode_all` expects and resolves
+    relative paths.
+
+    Args:
+        entry (dict of str: any): Raw manifest entry.
+        base_dir (str): Folder to resolve relative paths against.
+
+    Returns:
+        (dict of str: any): Normalized entry.
+
+    Raises:
+        ValueError: If the entry has no `input`.
+    """
+    if not isinstance(entry, dict) or 'input' not in entry:
+        raise ValueError(f"Manifest entry is missing an input: {entry}")
+    entry = dict(entry)
+    for key in _PATH_KEYS:
+        if key in entry:
+            entry[key] = os.path.join(base_dir, entry[key])
+    for key in _LIST_KEYS:
+        if isinstance(entry.get(key), str):
+            entry[key] = [int(x) for x in entry[key].replace(',', ' ').split()]
+    for key in _BOOL_KEYS:
+        if isinstance(entry.get(key), str):
+            entry[key] = entry[key].lower() in ('1', 'true', 'yes', 'y')
+    for key in _INT_KEYS:
+        if isinstance(entry.get(key), str):
+            entry[key] = int(entry[key])
+    return entry
+
+
+def output_dirs(entry: Dict[str, any]) -> Tuple[str, str]:
+    """
+    Returns the folders a manifest entry writes its encodes and clean muxes
+    to. They default to `source` and `clean` in a folder named after the
+    input, next to it, e.g. `ep01/source` and `ep01/clean` for `ep01.mkv`.
+
+    Args:
+        entry (dict of str: any): Normalized manifest entry.
+
+    Returns:
+        (tuple of str): Output folder and clean folder.
+    """
+    input_file = entry['input']
+    base_dir = os.path.join(
+        os.path.dirname(input_file),
+        os.path.splitext(os.path.basename(input_file))[0])
+    return (
+        entry.get('output_dir', os.path.join(base_dir, 'source')),
+        entry.get('clean_dir', os.path.join(base_dir, 'clean')))
+
+
+def run_entry(
+        entry: Dict[str, any],
+        batch_journal: journal.Journal = None,
+        key: str = None) -> Dict[str, any]:
+    """
+    Encodes a single manifest entry, then muxes clean audio if requested.
+
+    Args:
+        entry (dict of str: any): Normalized manifest entry.
+        batch_journal (journal.Journal, optional): Journal to record the
+            entry's state transitions and stages in.
+        key (str, optional): Job key of the entry in the journal.
+
+    Returns:
+        (dict of str: any): Result with keys `input`, `ok`, `seconds`,
+            `bytes` (size of the outputs the entry wrote), `error` and
+            `stages` (stage results, see `trace`).
+            An entry fails if it raises or any ffmpeg process exits with an
+            error.
+    """
+    kwargs = dict(entry)
+    output_dir, clean_dir = output_dirs(kwargs)
+    input_file = kwargs.pop('input')
+    kwargs.pop('output_dir', None)
+    clean_audio = kwargs.pop('clean_audio', None)
+    kwargs.pop('clean_dir', None)
+
+    start = time.monotonic()
+    result = {'input': input_file, 'ok': True, 'error': None}
+    if batch_journal is not None:
+        batch_journal.write(key, 'running', input=input_file)
+    with trace.recording(
+            batch_journal.recorder(key) if batch_journal is not None
+            else None) as recorder:
+        try:
+            encode.encode_all(input_file, output_dir, **kwargs)
+            if clean_audio is not None:
+                encode.mux_clean_directory(
+                    output_dir, clean_audio, clean_dir,
+                    norm=kwargs.get('norm', False),
+                    max_workers=kwargs.get('max_workers', 1),
+                    progress_callback=kwargs.get('progress_callback'),
+                    executor=kwargs.get('executor', 'thread'))
+        except Exception:
+            result['ok'] = False
+            result['error'] = traceback.format_exc(limit=3)
+    result['seconds'] = time.monotonic() - start
+    result['stages'] = recorder.results
+    failed = trace.failed(recorder.results)
+    if result['ok'] and len(failed) != 0:
+        result['ok'] = False
+        result['error'] = '\n'.join(trace.format_failure(r) for r in failed)
+    if batch_journal is not None:
+        batch_journal.write(
+            key, 'done' if result['ok'] else 'failed', error=result['error'])
+
+    # Only count files this entry wrote into its folders, once each, so
+    # that intermediates and outputs left alone aren't included.
+    directories = {os.path.normpath(d) for d in (
+        [output_dir] + ([clean_dir] if clean_audio else []))}
+    written = {
+        r['output']: r['bytes'] for r in recorder.results
+        if r['stage'] != 'skip' and r['output'] is not None
+        and os.path.normpath(os.path.dirname(r['output'])) in directories}
+    result['bytes'] = sum(size or 0 for size in written.values())
+    return result
+
+
+def run_batch(
+        entries: List[Dict[str, any]],
+        max_jobs: int = 1,
+        max_workers: int = 1,
+        cpu_budget: int = None,
+        progress_callback: Callable = None,
+        journal_file: str = None,
+        resume: bool = False,
+        max_processes: int = None) -> Dict[str, any]:
+    """
+    Runs the manifest entries, at most `max_jobs` at a time.
+
+    Args:
+        entries (list of dict of str: any): Entries from `load_manifest`.
+        max_jobs (int, optional): Maximum number of entries encoding at the
+            same time across the whole batch. Defaults to 1.
+        max_workers (int, optional): Default `max_workers` for each entry's
+            `encode_all` call, unless the entry sets its own. Without
+            `max_processes`, the number of concurrent ffmpeg processes is
+            at most `max_jobs * max_workers`. Defaults to 1.
+        cpu_budget (int, optional): Number of CPU threads shared by every
+            encode in the batch. See `encode_all`. Use 0 for all cores.
+            Defaults to None, which uses the fixed VP9 threading settings.
+        progress_callback (callable, optional): Called with progress reports
+            from every ffmpeg process in the batch. See `progress`.
+            Defaults to None.
+        journal_file (str, optional): Path to a journal to record each
+            entry's state transitions in. Journaled entries default to
+            `incremental=True` and `passlog_cache=True`, so that a resumed
+            entry keeps the outputs it finished and picks up after a
+            completed pass 1. Defaults to None.
+        resume (bool, optional): Whether to resume an interrupted batch from
+            its journal, skipping entries that finished. Defaults to False,
+            which starts the journal over.
+        max_processes (int, optional): Maximum number of ffmpeg processes
+            running at the same time across the whole batch. The jobs of
+            every entry's plan run on one shared `plan.ThreadExecutor` of
+            this size (see `encode_all`). Probes and the sample encodes of
+            size caps aren't counted. Defaults to None, which gives each
+            entry its own pool of `max_workers`.
+
+    Returns:
+        (dict of str: any): Summary with keys `results` (one per entry, in
+            manifest order), `succeeded`, `failed`, `skipped`, `seconds` and
+            `bytes`.
+    """
+    keys = [journal.job_key(entry) for entry in entries]
+    states = journal.load_states(journal_file) if (
+        resume and journal_file is not None) else {}
+    defaults = {'max_workers': max_workers}
+    if cpu_budget is not None:
+        defaults['cpu_budget'] = resources.CpuBudget(cpu_budget or None)
+    if progress_callback is not None:
+        defaults['progress_callback'] = progress_callback
+    if journal_file is not None:
+        defaults['incremental'] = True
+        defaults['passlog_cache'] = True
+    pool = None
+    if max_processes is not None:
+        pool = plan.ThreadExecutor(max_workers=max(max_processes, 1))
+        defaults['executor'] = pool
+    entries = [dict(defaults, **entry) for entry in entries]
+    batch_journal = None
+    if journal_file is not None:
+        batch_journal = journal.Journal(journal_file, resume)
+    start = time.monotonic()
+    results = [None] * len(entries)
+    try:
+        with ThreadPoolExecutor(max_workers=max(max_jobs, 1)) as executor:
+            futures = {}
+            for i, (entry, key) in enumerate(zip(entries, keys)):
+                if states.get(key) == 'done':
+                    results[i] = _skipped_result(entry)
+                    _log.info("[skipped] %s", entry['input'])
+                    continue
+                futures[executor.submit(trace.propagate(partial(
+                    run_entry, entry, batch_journal, key)))] = i
+            for future in as_completed(futures):
+                result = future.result()
+                results[futures[future]] = result
+                if result['ok']:
+                    _log.info("[done] %s (%.1fs)",
+                              result['input'], result['seconds'])
+                else:
+                    _log.error("[FAILED] %s (%.1fs)",
+                               result['input'], result['seconds'])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if batch_journal is not None:
+            batch_journal.close()
+    return {
+        'results': results,
+        'succeeded': sum(1 for r in results if r['ok']),
+        'failed': sum(1 for r in results if not r['ok']),
+        'skipped': sum(1 for r in results if r.get('skipped')),
+        'seconds': time.monotonic() - start,
+        'bytes': sum(r['bytes'] for r in results)}
+
+
+def _skipped_result(entry: Dict[str, any]) -> Dict[str, any]:
+    """
+    Returns the result of an entry that already finished in an earlier run.
+
+    Args:
+        entry (dict of str: any): Normalized manifest entry.
+
+    Returns:
+        (dict of str: any): Result, see `run_entry`, with `skipped` set.
+    """
+    return {
+        'input': entry['input'],
+        'ok': True,
+        'skipped': True,
+        'error': None,
+        'seconds': 0,
+        'bytes': 0,
+        'stages': []}
+
+
+def format_summary(summary: Dict[str, any]) -> str:
+    """
+    Formats a batch summary for printing.
+
+    Args:
+        summary (dict of str: any): Summary returned by `run_batch`.
+
+    Returns:
+        (str): Human-readable summary of throughput and failures.
+    """
+    total = summary['succeeded'] + summary['failed']
+    minutes = summary['seconds'] / 60
+    lines = [
+        f"{summary['succeeded']}/{total} jobs succeeded "
+        f"in {summary['seconds']:.1f}s"
+        + (f" ({summary['skipped']} already done)"
+           if summary.get('skipped') else ''),
+        f"throughput: {total / minutes if minutes > 0 else 0:.2f} jobs/min, "
+        f"{summary['bytes'] / 2**20:.1f} MiB written"]
+    for result in summary['results']:
+        if not result['ok']:
+            lines.append(f"failed: {result['input']}")
+            lines.append(result['error'].rstrip())
+    return '\n'.join(lines)
@@ -0,0 +1,152 @@
+"""Caching
+
+Utility functions for locating, keying and evicting on-disk caches.
+"""
+
+
+__all__ = [
+    'CACHE_DIR',
+    'cache_dir',
+    'file_identity',
+    'hash_key',
+    'touch',
+    'evict_lru',
+]
+
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, Union
+
+
+CACHE_DIR = os.environ.get(
+    'AMQENCODE_CACHE_DIR',
+    os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'amqencode'))
+"""(str): Root folder for on-disk caches.
+Set the `AMQENCODE_CACHE_DIR` environment variable to override it.
+"""
+
+
+def cache_dir(*parts: str) -> str:
+    """
+    Returns the path to a cache folder, creating it if it doesn't exist.
+
+    Args:
+        *parts (str): Path components below `CACHE_DIR`.
+
+    Returns:
+        (str): Path to the cache folder.
+    """
+    directory = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def file_identity(path: str) -> Dict[str, Union[str, int]]:
+    """
+    Returns a dictionary identifying the current version of a file.
+    The identity changes whenever the file is replaced or modified.
+
+    Args:
+        path (str): Path to file.
+
+    Returns:
+        (dict of str: str/int): Dictionary with keys `path`, `size` and
+            `mtime_ns`.
+    """
+    stat = os.stat(path)
+    return {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns}
+
+
+def hash_key(*parts: any) -> str:
+    """
+    Returns a stable hex digest of JSON-serializable values.
+
+    Args:
+        *parts: Values to hash. Anything that isn't JSON-serializable is
+            hashed by its string representation.
+
+    Returns:
+        (str): SHA-256 hex digest.
+    """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def touch(path: str) -> None:
+    """
+    Marks a cache entry as recently used.
+
+    Args:
+        path (str): Path to cache entry.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _entry_size(path: str) -> int:
+    """
+    Returns the size in bytes of a cache entry, which may be a folder.
+
+    Args:
+        path (str): Path to cache entry.
+
+    Returns:
+        (int): Total size in bytes.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(path)
+        for file in files)
+
+
+def evict_lru(
+        directory: str,
+        max_entries: int = None,
+        max_bytes: int = None) -> None:
+    """
+    Removes the least recently used entries of a cache folder until it is
+    within the given limits. Entries are the files and folders directly
+    inside `directory`, ordered by modification time (see `touch`).
+
+    Args:
+        directory (str): Path to cache folder.
+        max_entries (int, optional): Maximum number of entries to keep.
+        max_bytes (int, optional): Maximum total size of entries to keep.
+    """
+    try:
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            entries.append((os.path.getmtime(path), path))
+    except OSError:
+        return
+    entries.sort(reverse=True)
+
+    total_bytes = 0
+    for i, (_, path) in enumerate(entries):
+        if max_bytes is not None:
+            try:
+                total_bytes += _entry_size(path)
+            except OSError:
+                continue
+        if ((max_entries is not None and i >= max_entries) or
+                (max_bytes is not None and total_bytes > max_bytes)):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,222 @@
+"""ffmpeg capabilities
+
+Detects what the local ffmpeg build can do: its version, encoders, filters,
+and whether its libvpx-vp9 supports `row-mt`. Detection runs a few short
+ffmpeg commands once per build, and is cached on disk by the path, size and
+modification time of the ffmpeg binary, so that later runs and short-lived
+workers only stat the binary.
+
+Encodes check the encoders and filters they need before anything runs, so
+that a build without `libvpx-vp9`, `libopus` or `libmp3lame` fails right
+away instead of after pass 1.
+"""
+
+
+__all__ = [
+    'FFMPEG',
+    'ENCODERS',
+    'detect',
+    'require',
+    'require_outputs',
+]
+
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict, Iterable, Union
+
+from . import cache, lazy, trace
+
+ffmpeg = lazy.import_module('ffmpeg')
+
+
+FFMPEG = 'ffmpeg'
+"""(str): Name of the ffmpeg binary that commands run, looked up on the
+`PATH`."""
+
+ENCODERS = ('libvpx-vp9', 'libopus', 'libmp3lame')
+"""(tuple of str): Encoders used by a full encode."""
+
+_COMMANDS = {
+    'version': ['-version'],
+    'encoders': ['-encoders'],
+    'filters': ['-filters'],
+    'vp9': ['-h', 'encoder=libvpx-vp9'],
+}
+"""(dict of str: list of str): ffmpeg arguments of each detection command."""
+
+_VERSION_RE = re.compile(r'^ffmpeg version (\S+)')
+_ENCODER_RE = re.compile(r'^ [A-Z.]{6} (\S+)')
+_FILTER_RE = re.compile(r'^ [A-Z.|]{2,3} (\S+) +\S*->\S*')
+
+_detected = {}
+_lock = threading.Lock()
+
+
+def detect(use_cache: bool = True) -> Dict[str, any]:
+    """
+    Returns the capabilities of the ffmpeg build on the `PATH`.
+
+    Args:
+        use_cache (bool, optional): Whether to use results cached in memory
+            or on disk. Defaults to True.
+
+    Returns:
+        (dict of str: any): Dictionary with keys `ffmpeg` (path to the
+            binary), `version`, `encoders` and `filters` (sorted lists of
+            names), and `row_mt` (whether libvpx-vp9 supports `row-mt`).
+
+    Raises:
+        OSError: If ffmpeg can't be found.
+        ffmpeg.Error: If ffmpeg fails to report its version.
+    """
+    path = shutil.which(FFMPEG)
+    if path is None:
+        raise OSError(f"Can't find {FFMPEG} on the PATH")
+    path = os.path.realpath(path)
+    key = cache.hash_key(cache.file_identity(path), _COMMANDS)
+    cache_file = os.path.join(cache.CACHE_DIR, 'capabilities', key + '.json')
+
+    if use_cache:
+        with _lock:
+            if key in _detected:
+                return dict(_detected[key])
+        try:
+            with open(cache_file) as file:
+                capabilities = json.load(file)
+            with _lock:
+                _detected[key] = capabilities
+            return dict(capabilities)
+        except (OSError, ValueError):
+            pass
+
+    capabilities = _run_detection(path)
+    with _lock:
+        _detected[key] = capabilities
+    directory = cache.cache_dir('capabilities')
+    temp_file = os.path.join(
+        directory, f".tmp-{os.getpid()}-{threading.get_ident()}")
+    with open(temp_file, 'w') as file:
+        json.dump(capabilities, file)
+    os.replace(temp_file, cache_file)
+    cache.evict_lru(directory, max_entries=16)
+    return dict(capabilities)
+
+
+def _run_detection(path: str) -> Dict[str, any]:
+    """
+    Runs the detection commands at the same time and parses their output.
+    Each one is recorded as a `capabilities` stage result, see `trace`.
+
+    Args:
+        path (str): Path to the ffmpeg binary.
+
+    Returns:
+        (dict of str: any): Capabilities, see `detect`.
+    """
+    start_time = time.time()
+    start = time.monotonic()
+    procs = {}
+    for name, args in _COMMANDS.items():
+        cmd = [path, '-hide_banner'] + args
+        procs[name] = (cmd, subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True))
+    out = {}
+    for name, (cmd, proc) in procs.items():
+        out[name] = proc.stdout.read()
+        proc.stdout.close()
+        returncode, cpu, max_rss = trace.wait(proc)
+        trace.stage_result(
+            'capabilities', name, cmd, returncode,
+            start_time, time.monotonic() - start, cpu, max_rss=max_rss)
+        if name == 'version' and returncode != 0:
+            raise ffmpeg.Error(FFMPEG, out[name], None)
+
+    version = _VERSION_RE.match(out['version'])
+    return {
+        'ffmpeg': path,
+        'version': version.group(1) if version else None,
+        'encoders': sorted({
+            match.group(1) for match in (
+                _ENCODER_RE.match(line)
+                for line in out['encoders'].splitlines())
+            if match and match.group(1) != '='}),
+        'filters': sorted({
+            match.group(1) for match in (
+                _FILTER_RE.match(line)
+                for line in out['filters'].splitlines())
+            if match}),
+        'row_mt': '-row-mt' in out['vp9'],
+    }
+
+
+def require(
+        encoders: Iterable[str] = (),
+        filters: Iterable[str] = ()) -> Dict[str, any]:
+    """
+    Checks that the ffmpeg build has the given encoders and filters.
+
+    Args:
+        encoders (iterable of str, optional): Encoder names, e.g.
+            `libvpx-vp9`.
+        filters (iterable of str, optional): Filter names, e.g.
+            `volumedetect`.
+
+    Returns:
+        (dict of str: any): Capabilities, see `detect`.
+
+    Raises:
+        RuntimeError: If any of them is missing.
+        OSError: If ffmpeg can't be found.
+    """
+    capabilities = detect()
+    missing = (
+        [f"encoder {name}" for name in encoders
+         if name not in capabilities['encoders']] +
+        [f"filter {name}" for name in filters
+         if name not in capabilities['filters']])
+    if len(missing) != 0:
+        raise RuntimeError(
+            f"{capabilities['ffmpeg']} (version {capabilities['version']}) "
+            f"is missing {', '.join(missing)}")
+    return capabilities
+
+
+def require_outputs(
+        outputs: Dict[str, Union[dict, None]],
+        muted: bool = False,
+        norm: bool = False) -> Dict[str, any]:
+    """
+    Checks that the ffmpeg build can encode the planned outputs.
+
+    Args:
+        outputs (dict of str: dict/None): Outputs from
+            `encode.plan_outputs`: video filters for each webm, or None for
+            the mp3.
+        muted (bool, optional): Whether the webms have no audio.
+        norm (bool, optional): Whether volume is detected for
+            normalization.
+
+    Returns:
+        (dict of str: any): Capabilities, see `detect`.
+
+    Raises:
+        RuntimeError: If an encoder or filter is missing.
+        OSError: If ffmpeg can't be found.
+    """
+    vp9, opus, mp3 = ENCODERS
+    encoders = set()
+    for filters in outputs.values():
+        if filters is None:
+            encoders.add(mp3)
+        else:
+            encoders.add(vp9)
+            if not muted:
+                encoders.add(opus)
+    return require(sorted(encoders), ['volumedetect'] if norm else [])
@@ -6,14 +6,28 @@ Utility functions and settings used across other encoding modules.
 
 __all__ = [
     'MAP_SETTINGS',
+    'STALE_PARTIAL_SECONDS',
     'apply_filters',
     'extract_seek',
-    'parse_filter_string'
+    'finish_outputs',
+    'parse_filter_string',
+    'parse_timestamp',
+    'partial_path',
+    'run_parallel',
+    'stage_outputs',
 ]
 
 
 import os
-from typing import Dict, Union
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Union
+
+from . import trace
 
 
 MAP_SETTINGS = {
@@ -88,14 +102,195 @@ def extract_seek(kwargs: Dict[str, any]) -> list:
     """
     seek = []
     if 'ss' in kwargs:
-        seek.extend(['-ss', kwargs.pop('ss'), '-accurate_seek'])
+        seek.extend(['-ss', str(kwargs.pop('ss')), '-accurate_seek'])
     if 't' in kwargs:
-        seek.extend(['-t', kwargs.pop('t')])
+        seek.extend(['-t', str(kwargs.pop('t'))])
         kwargs.pop('to', None)
     elif 'to' in kwargs:
-        seek.extend(['-to', kwargs.pop('to')])
+        seek.extend(['-to', str(kwargs.pop('to'))])
     return seek
 
+
+_TIMESTAMP_RE = re.compile(
+    r'^(?P<sign>-?)(?:(?:(?P<h>[0-9]+):)?(?P<m>[0-9]+):)?(?P<s>[0-9]*\.?[0-9]+)'
+    r'(?P<unit>s|ms|us)?$')
+_TIMESTAMP_UNITS = {None: 1, 's': 1, 'ms': 1e-3, 'us': 1e-6}
+
+
+def parse_timestamp(timestamp: Union[str, int, float]) -> float:
+    """
+    Converts an ffmpeg time duration string into seconds.
+    Accepts `[-][HH:]MM:SS[.m...]` and `[-]S+[.m...][s|ms|us]` forms.
+
+    Args:
+        timestamp (str/int/float): Timestamp to convert.
+
+    Returns:
+        (float): Timestamp in seconds.
+
+    Raises:
+        ValueError: If the timestamp isn't a valid ffmpeg duration.
+    """
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    match = _TIMESTAMP_RE.match(timestamp.strip())
+    if not match or (match.group('m') and match.group('unit')):
+        raise ValueError(f"Invalid timestamp: {timestamp}")
+    seconds = (
+        int(match.group('h') or 0) * 3600 +
+        int(match.group('m') or 0) * 60 +
+        float(match.group('s')) * _TIMESTAMP_UNITS[match.group('unit')])
+    return -seconds if match.group('sign') else seconds
+
+
+def run_parallel(
+        jobs: List[Callable[[], any]],
+        max_workers: int = 1,
+        budget: object = None,
+        threads: List[int] = None) -> list:
+    """
+    Runs a list of callables, optionally on a thread pool.
+    Threads are sufficient since the actual work happens in ffmpeg
+    subprocesses. Exceptions raised by any job are re-raised, and stage
+    results are recorded by the caller's active recorders (see `trace`).
+
+    Args:
+        jobs (list of callable): Zero-argument callables to run.
+        max_workers (int, optional): Maximum number of jobs to run at the same
+            time. Defaults to 1, which runs the jobs serially in order.
+        budget (resources.CpuBudget, optional): CPU budget each job reserves
+            its threads from before it starts, so that concurrent jobs are
+            packed within the budget.
+        threads (list of int, optional): Number of threads each job uses.
+            Defaults to 1 per job.
+
+    Returns:
+        list: Return values of the jobs, in the same order as `jobs`.
+    """
+    if budget is not None:
+        jobs = [
+            partial(_run_reserved, job, budget, job_threads)
+            for job, job_threads in zip(jobs, threads or [1] * len(jobs))]
+    if max_workers is None or max_workers <= 1 or len(jobs) <= 1:
+        return [job() for job in jobs]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(trace.propagate(job)) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def _run_reserved(
+        job: Callable[[], any],
+        budget: object,
+        threads: int) -> any:
+    """
+    Runs a callable while holding a reservation on a CPU budget.
+
+    Args:
+        job (callable): Zero-argument callable to run.
+        budget (resources.CpuBudget): CPU budget to reserve from.
+        threads (int): Number of threads to reserve.
+
+    Returns:
+        any: Return value of the job.
+    """
+    with budget.reserve(threads):
+        return job()
+
+
+STALE_PARTIAL_SECONDS = 24 * 3600
+"""(float): Seconds after which a partial file nobody writes to any more is
+removed, see `stage_outputs`."""
+
+
+def partial_path(output_file: str) -> str:
+    """
+    Returns the hidden path an output is written to until it is complete.
+    The name is unique to the calling host, process and thread, so that two
+    workers that end up writing the same output (e.g. after a lease ran out,
+    see `jobqueue`) never touch each other's partial files. The extension is
+    kept so that ffmpeg picks the same muxer.
+
+    Args:
+        output_file (str): Path to output file.
+
+    Returns:
+        (str): Path to partial file, in the same folder as the output.
+    """
+    directory, name = os.path.split(output_file)
+    stem, extension = os.path.splitext(name)
+    writer = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+    return os.path.join(
+        directory, f".{stem}.partial-{writer}{extension}")
+
+
+def stage_outputs(cmd: List[str], output_files: List[str]) -> List[str]:
+    """
+    Returns a copy of an ffmpeg command that writes its outputs to partial
+    paths, so that an interrupted command never leaves a truncated file at
+    the final path. Partial files of the same outputs left over by an
+    earlier run are removed: this writer's own, and those of other writers
+    that haven't been modified for `STALE_PARTIAL_SECONDS`.
+    Use `finish_outputs` once the command exits.
+
+    Args:
+        cmd (list of str): Compiled ffmpeg command.
+        output_files (list of str): Paths of the files written by `cmd`.
+
+    Returns:
+        (list of str): Command writing to partial paths.
+    """
+    partials = {f: partial_path(f) for f in output_files}
+    for output_file, partial_file in partials.items():
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        _remove_stale_partials(output_file)
+    return [partials.get(arg, arg) for arg in cmd]
+
+
+def _remove_stale_partials(output_file: str) -> None:
+    """
+    Removes partial files of an output that haven't been modified for
+    `STALE_PARTIAL_SECONDS`, e.g. left by a worker that crashed.
+    """
+    directory, name = os.path.split(output_file)
+    stem, extension = os.path.splitext(name)
+    prefix = f".{stem}.partial-"
+    try:
+        names = os.listdir(directory or '.')
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        if not (name.startswith(prefix) and name.endswith(extension)):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > STALE_PARTIAL_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def finish_outputs(output_files: List[str], success: bool) -> None:
+    """
+    Moves the partial files of a command started with `stage_outputs` into
+    place if it succeeded, replacing existing outputs, or removes them.
+
+    Args:
+        output_files (list of str): Paths of the files written by the
+            command.
+        success (bool): Whether the command exited without error.
+    """
+    for output_file in output_files:
+        partial_file = partial_path(output_file)
+        if not os.path.exists(partial_file):
+            continue
+        if success:
+            os.replace(partial_file, output_file)
+        else:
+            os.remove(partial_file)
+
+
 def ensure_dir(path: str) -> None:
     """
     Creates the folder structure to the specified path if it doesn't already
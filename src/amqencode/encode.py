@@ -8,51 +8,255 @@ separate module).
 
 __all__ = [
     'encode_all',
+    'compile_encode_all',
+    'plan_outputs',
     'mux_clean_directory',
+    'compile_mux_clean_directory',
 ]
 
 
-from typing import Union
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Union
+import logging
 import os
 
-from . import audio, common, mux, video
+from . import (
+    audio, capabilities, common, fingerprints, mezzanine as mezzanine_, mux,
+    plan, probe, ratecontrol, resources, trace, validate as validate_, video)
+
+
+_log = logging.getLogger(__name__)
+
+_WORK_DIR = '{work}'
+"""(str): Plan variable for the temporary folder, see `plan`."""
+
+_GAIN_FILTER = {'volume': '{gain}'}
+"""(dict of str: str): Normalization filter with the plan variable for the
+gain, see `plan`."""
 
 
 def mux_clean_directory(
         input_dir: str,
         input_audio: str,
         output_dir: str = './clean/',
-        norm: bool = False) -> None:
+        norm: bool = False,
+        max_workers: int = 1,
+        progress_callback: Callable = None,
+        executor: Union[str, Executor] = 'thread') -> List[Dict[str, any]]:
     """
     Muxes all webm/mp3 files in the input directory with a clean audio file.
+    The clean audio is analyzed once and encoded once per codec (and once per
+    distinct mp3 duration), then copied into every output without
+    re-encoding. Runs the plan from `compile_mux_clean_directory`.
+
+    Args:
+        input_dir (str): Path containing webm and/or mp3 files to be muxed.
+        input_audio (str): Path to clean audio file to mux.
+        output_dir (str): Path to output muxed files. Defaults to `./clean/`.
+        norm (bool): Whether to normalize audio level of the outputs.
+        max_workers (int, optional): Number of ffmpeg processes to run at
+            the same time, and of segments to measure the levels of.
+            Defaults to 1.
+        progress_callback (callable, optional): Called with progress reports
+            from every ffmpeg process. See `progress`. Defaults to None.
+        executor (str or concurrent.futures.Executor, optional): Executor
+            the plan runs on, see `encode_all`. Defaults to `thread`.
+
+    Returns:
+        (list of dict of str: any): Stage results, see `trace`.
+
+    Raises:
+        RuntimeError: If the ffmpeg build lacks an encoder or filter that
+            the outputs need. See `capabilities`.
+    """
+
+    with trace.recording() as recorder:
+        plan.run_plan(
+            compile_mux_clean_directory(
+                input_dir, input_audio, output_dir, norm, max_workers),
+            executor, max_workers, progress_callback)
+    return recorder.results
+
+
+def compile_mux_clean_directory(
+        input_dir: str,
+        input_audio: str,
+        output_dir: str = './clean/',
+        norm: bool = False,
+        max_workers: int = 1) -> Dict[str, any]:
+    """
+    Returns the jobs of a `mux_clean_directory` call as a plan, without
+    running them. See `plan`.
 
     Args:
         input_dir (str): Path containing webm and/or mp3 files to be muxed.
         input_audio (str): Path to clean audio file to mux.
         output_dir (str): Path to output muxed files. Defaults to `./clean/`.
         norm (bool): Whether to normalize audio level of the outputs.
+        max_workers (int, optional): Number of segments to measure the
+            levels of in parallel. Defaults to 1.
+
+    Returns:
+        (dict of str: any): Plan.
+
+    Raises:
+        RuntimeError: If the ffmpeg build lacks an encoder or filter that
+            the outputs need. See `capabilities`.
     """
-    for file in os.listdir(input_dir):
-        if file.endswith(('.webm', '.mp3')):
-            mux.mux_clean(
-                os.path.join(input_dir, file),
-                input_audio,
-                os.path.join(output_dir, file),
-                norm)
+
+    files = sorted(
+        file for file in os.listdir(input_dir)
+        if file.endswith(('.webm', '.mp3')))
+    _require_mux(files, norm)
+    jobs = []
+    gain = {}
+    gain_deps = []
+    if norm and len(files) != 0:
+        jobs.extend(_compile_volumedetect_jobs(
+            input_audio, max_workers, 0, audio.probe_duration(input_audio),
+            []))
+        gain = _GAIN_FILTER
+        gain_deps = ['gain']
+
+    opus_file = os.path.join(_WORK_DIR, 'clean.webm')
+    if any(file.endswith('.webm') for file in files):
+        jobs.append(plan.make_job(
+            'clean.webm', 'opus', 'clean.webm',
+            audio.compile_audio(
+                input_audio, opus_file, 'webm', af=gain,
+                **audio.AUDIO_SETTINGS, **audio.OPUS_SETTINGS),
+            [input_audio], [opus_file], gain_deps))
+
+    mp3_files = {}
+    for file in files:
+        input_file = os.path.join(input_dir, file)
+        output_file = os.path.join(output_dir, file)
+        if file.endswith('.webm'):
+            jobs.append(plan.make_job(
+                f"{file}:mux", 'mux', file,
+                mux.compile_mux_streams(input_file, opus_file, output_file),
+                [input_file, opus_file], [output_file], ['clean.webm']))
+            continue
+        duration = f"{audio.probe_duration(input_file):.3f}"
+        if duration not in mp3_files:
+            mp3_files[duration] = os.path.join(
+                _WORK_DIR, f"clean-{len(mp3_files)}.mp3")
+            name = os.path.basename(mp3_files[duration])
+            jobs.append(plan.make_job(
+                name, 'mp3', name,
+                audio.compile_mp3(
+                    input_audio, mp3_files[duration], af=gain, t=duration,
+                    **audio.AUDIO_SETTINGS, **audio.MP3_SETTINGS),
+                [input_audio], [mp3_files[duration]], gain_deps))
+        jobs.append(plan.make_job(
+            f"{file}:copy", 'copy', file, None,
+            [mp3_files[duration]], [output_file],
+            [os.path.basename(mp3_files[duration])], kind='copy'))
+    return {'jobs': jobs}
+
+
+def _require_mux(files: List[str], norm: bool) -> None:
+    """
+    Checks that the ffmpeg build has the encoders and filters needed to mux
+    clean audio into the files. See `capabilities.require`.
+    """
+    capabilities.require(
+        [settings['c:a'] for extension, settings in (
+            ('.webm', audio.OPUS_SETTINGS), ('.mp3', audio.MP3_SETTINGS))
+         if any(file.endswith(extension) for file in files)],
+        ['volumedetect'] if norm else [])
 
 
 mux_folder = mux_clean_directory
 
 
+def plan_outputs(
+        output_dir: str,
+        resolutions: list,
+        skip_resolutions: Union[str, list],
+        dimensions: Dict[str, any],
+        video_filters: dict,
+        muted: bool = False) -> Dict[str, Union[dict, None]]:
+    """
+    Returns the output files to encode for the requested resolutions.
+    Resolutions taller than the source are skipped, except for the smallest
+    requested one.
+
+    Args:
+        output_dir (str): Path to output encoded files.
+        resolutions (list of int): Resolutions to encode, in terms of video
+            height. 0 is the mp3.
+        skip_resolutions (str or list of int): Resolutions to leave out.
+        dimensions (dict of str: int/Fraction):
+            Source dimensions from `video.probe_dimensions`.
+        video_filters (dict of str: str/None):
+            Video filters to apply to every webm, before scaling.
+        muted (bool): Whether to leave out the mp3.
+
+    Returns:
+        (dict of str: dict/None): Dictionary mapping each output file to the
+            video filters for that webm, or None for the mp3.
+    """
+
+    if isinstance(skip_resolutions, str):
+        skip_resolutions = [int(x) for x in skip_resolutions.split(',')]
+
+    resolutions = sorted(
+        {res for res
+         in resolutions
+         if res not in skip_resolutions})
+    first_video = next((
+        i for i, x
+        in enumerate(resolutions)
+        if not x in (0, '0')), None)
+
+    outputs = {}
+    for resolution in resolutions:
+
+        resolution = int(resolution)
+
+        if resolution == 0 and muted is not True:  # 0 = mp3
+            outputs[os.path.join(output_dir, f"{resolution}.mp3")] = None
+            continue
+
+        if (resolution > dimensions['height']+16 and
+            resolution > resolutions[first_video]):
+            _log.info(
+                "Skipping %dp due to insufficient video height", resolution)
+            continue
+
+        width = round(dimensions['dar'] * resolution)
+        height = resolution
+        outputs[os.path.join(output_dir, f"{resolution}.webm")] = dict(
+            video_filters, scale=f"{width}x{height}")
+    return outputs
+
+
 def encode_all(
         input_file: str,
         output_dir: str = './source/',
         norm: bool = False,
         muted: bool = False,
         skip_resolutions: Union[str, list] = '360',
-        **kwargs) -> None:
+        max_workers: int = 1,
+        engine: str = 'separate',
+        chunks: int = 1,
+        shared_audio: bool = True,
+        incremental: bool = False,
+        passlog_cache: bool = False,
+        mezzanine: bool = False,
+        cpu_budget: Union[int, resources.CpuBudget] = None,
+        target_size: Union[str, int] = None,
+        target_bitrate: Union[str, int] = None,
+        draft: bool = False,
+        validate: bool = False,
+        executor: Union[str, Executor] = 'thread',
+        progress_callback: Callable = None,
+        **kwargs) -> List[Dict[str, any]]:
     """
-    Encodes a video in all requested resolutions.
+    Encodes a video in all requested resolutions. Compiles the encode into a
+    plan with `compile_encode_all` and runs it with `plan.run_plan`, so every
+    option below is also available in dry runs.
 
     Args:
         input_file (str): Path to video file to encode from.
@@ -62,6 +266,78 @@ def encode_all(
         skip_resolutions (list of int): List of resolutions to skip.
             Use this if you want to use the default list of resolutions and
             skip a specific one. Defaults to including 360.
+        max_workers (int, optional): Number of jobs to run at the same time,
+            i.e. ffmpeg processes, counting each pass and each chunk. Each
+            2-pass encode uses its own pass log file, so concurrent encodes
+            don't interfere with each other. Defaults to 1.
+        engine (str, optional): How to run the webm encodes.
+            `separate` runs a 2-pass encode per resolution.
+            `split` decodes the source once per pass and encodes every
+            resolution from a single ffmpeg process.
+            Defaults to `separate`.
+        chunks (int, optional): Number of keyframe-aligned segments to split
+            each webm into, encoded as separate jobs and concatenated.
+            Only used by the `separate` engine. Defaults to 1.
+        shared_audio (bool, optional): Whether to extract the filtered audio
+            once to an intermediate file, then encode the mp3 and encode Opus
+            a single time from it. The Opus track is muxed into every webm
+            without re-encoding. Defaults to True.
+            Volume detection for `norm` always reads the unfiltered source,
+            split into `max_workers` segments analyzed in parallel.
+        incremental (bool, optional): Whether to skip outputs that are
+            already up to date. Each output gets a sidecar fingerprint of the
+            source file and the planned ffmpeg commands that build it,
+            including those of the jobs it depends on, so that trim,
+            filters, VP9 settings, engine, chunks, shared audio and the
+            measurement of the normalization gain are all covered. Skipped
+            outputs are recorded as `skip` stage results. Defaults to False.
+        passlog_cache (bool, optional): Whether to reuse cached pass 1
+            statistics when the source, trim, video filters, resolution and
+            video settings are unchanged. Only used by the `separate` engine.
+            Defaults to False.
+        mezzanine (bool, optional): Whether to cut the trimmed range of the
+            source once into a lossless intermediate and run every stage
+            from it, instead of seeking through the source each time. Worth
+            it for short cuts of large or remote sources. Intermediates are
+            cached by source and trim, see `mezzanine`. Only used when
+            trimming with `ss`, `to` or `t`. Defaults to False.
+        cpu_budget (int or resources.CpuBudget, optional): Number of CPU
+            threads the encodes may use in total, or a budget shared with
+            other encodes. When set, `threads`, `tile-columns` and `row-mt`
+            are picked per resolution from the frame width (unless set in
+            `vp9_settings`), and jobs only start once their threads fit in
+            the budget. Use 0 for all cores. If `max_workers` is 1, as many
+            jobs run at once as the budget allows. Defaults to None, which
+            uses the fixed `VP9_SETTINGS`.
+        target_size (str or int, optional): Maximum size of each webm, in
+            bytes or with a suffix such as `8M` or `7.5MiB`. The `crf` of
+            each webm is raised as needed, picked by sampling a few short
+            windows of the source (see `ratecontrol`). Defaults to None.
+        target_bitrate (str or int, optional): Maximum overall bitrate of
+            each webm, in bits per second or with a suffix such as `2M`.
+            Works like `target_size`. Defaults to None.
+        draft (bool, optional): Whether to make a quick preview instead, to
+            check trim points and filters. Only the smallest planned webm
+            (pick it with `resolutions`) and the mp3 are encoded, the webm
+            in a single pass with `video.DRAFT_VP9_SETTINGS`. Outputs go to
+            `preview/` inside `output_dir`, apart from the final encodes.
+            `engine`, `chunks`, `target_size` and `target_bitrate` are
+            ignored. Defaults to False.
+        validate (bool, optional): Whether to check the new outputs once
+            they are done, in parallel and without decoding them: container
+            index, codecs, dimensions and duration (see `validate`). Failed
+            checks are recorded as `validate` stage results, listed under
+            their `errors`, and leave the output without a fingerprint. Defaults to False.
+        executor (str or concurrent.futures.Executor, optional): Executor
+            the plan runs on, see `plan.run_plan`. Pass a
+            `plan.ThreadExecutor` shared with other encodes to limit their
+            ffmpeg processes together; `max_workers` then only sets the
+            volume detection segments. Progress reports aren't passed on
+            from the `process` executor. Defaults to `thread`.
+        progress_callback (callable, optional): Called with progress reports
+            from every ffmpeg process, e.g. a `progress.ProgressDisplay`.
+            Jobs are named after their output files. See `progress`.
+            Defaults to None.
         **kwargs: Arbitrary keyword arguments. Includes arguments specific to
             this package, as well as any native ffmpeg parameters you wish to
             pass.
@@ -81,25 +357,547 @@ def encode_all(
         af (str or dict of str: str/None):
             String or dictionary of audio filters to apply.
             Normalization filter will be applied after these, if requested.
+        snap_seek (bool): Whether to move a trim start that falls less than
+            a frame before a source keyframe onto it, which gives the same
+            first frame without decoding the previous GOP. Reads the
+            source's keyframe index once, see `probe.snap_seek`.
+            Defaults to False.
+
+    Returns:
+        (list of dict of str: any): Stage results of every ffmpeg and
+            ffprobe process that ran, with commands, exit codes, timings and
+            output sizes. See `trace`.
+
+    Raises:
+        ValueError: If the engine is unknown, or a size cap is too small
+            for the audio.
+        RuntimeError: If the ffmpeg build lacks an encoder or filter that
+            the outputs need. See `capabilities`.
     """
 
-    common.ensure_dir(output_dir + '/')
+    budget = cpu_budget
+    if isinstance(cpu_budget, int):
+        budget = resources.CpuBudget(cpu_budget or None)
+    with trace.recording() as recorder:
+        job_plan = compile_encode_all(
+            input_file, output_dir, norm, muted, skip_resolutions,
+            max_workers, engine, chunks, shared_audio, incremental,
+            passlog_cache, mezzanine, budget, target_size, target_bitrate,
+            draft, validate, progress_callback=progress_callback, **kwargs)
+        if budget is not None and max_workers <= 1:
+            max_workers = max(len(job_plan['jobs']), 1)
+        plan.run_plan(
+            job_plan, executor, max_workers, progress_callback, budget)
+    return recorder.results
 
-    if isinstance(skip_resolutions, str):
-        skip_resolutions = [int(x) for x in skip_resolutions.split(',')]
 
-    resolutions = sorted(
-        {res for res
-         in kwargs.pop('resolutions', video.RESOLUTIONS)
-         if res not in skip_resolutions})
-    first_video = next((
-        i for i, x
-        in enumerate(resolutions)
-        if not x in (0, '0')), None)
+def compile_encode_all(
+        input_file: str,
+        output_dir: str = './source/',
+        norm: bool = False,
+        muted: bool = False,
+        skip_resolutions: Union[str, list] = '360',
+        max_workers: int = 1,
+        engine: str = 'separate',
+        chunks: int = 1,
+        shared_audio: bool = True,
+        incremental: bool = False,
+        passlog_cache: bool = False,
+        mezzanine: bool = False,
+        cpu_budget: Union[int, resources.CpuBudget] = None,
+        target_size: Union[str, int] = None,
+        target_bitrate: Union[str, int] = None,
+        draft: bool = False,
+        validate: bool = False,
+        progress_callback: Callable = None,
+        **kwargs) -> Dict[str, any]:
+    """
+    Returns the jobs of an `encode_all` call as a plan, without running
+    them. See `plan`. Takes the same arguments as `encode_all`.
+    Nothing is written, but the source is probed, the keyframe index is read
+    for `chunks`, and a size cap runs the sample encodes that pick each
+    `crf` (reported to `progress_callback`; choices are cached, see
+    `ratecontrol`). Volume detection for `norm` is split into `max_workers`
+    segments, and a mezzanine that is already cached is used without a job.
+
+    Returns:
+        (dict of str: any): Plan.
+
+    Raises:
+        ValueError: If the engine is unknown, or a size cap is too small
+            for the audio.
+        RuntimeError: If the ffmpeg build lacks an encoder or filter that
+            the outputs need. See `capabilities`.
+    """
+
+    if engine not in ('separate', 'split'):
+        raise ValueError(f"Unknown encoding engine: {engine}")
+    if draft:
+        output_dir = os.path.join(output_dir, 'preview')
+        engine, chunks = 'separate', 1
+        target_size = target_bitrate = None
+    capped = target_size is not None or target_bitrate is not None
+
+    passes = 1 if draft else 2
+    budget = cpu_budget
+    if isinstance(cpu_budget, int):
+        budget = resources.CpuBudget(cpu_budget or None)
+    outputs, output_settings, audio_filters = _prepare_outputs(
+        input_file, output_dir, muted, skip_resolutions, budget, draft,
+        kwargs)
+    capabilities.require_outputs(outputs, muted, norm)
+
+    jobs = []
+    source_file = input_file
+    source_settings = dict(common.MAP_SETTINGS, **audio.AUDIO_SETTINGS,
+                           **kwargs)
+    source_deps = []
+    start, end = ratecontrol.trim_range(source_file, kwargs)
+    trim = {k: kwargs[k] for k in mezzanine_.TRIM_KEYS if k in kwargs}
+    if mezzanine and len(trim) != 0:
+        input_file, cached = mezzanine_.find_mezzanine(source_file, trim)
+        for key in trim:
+            del kwargs[key]
+        if not cached:
+            jobs.append(plan.make_job(
+                'mezzanine', 'mezzanine', os.path.basename(source_file),
+                mezzanine_.compile_mezzanine(source_file, input_file, **trim),
+                [source_file], [input_file],
+                args={'cache_bytes': mezzanine_.MEZZANINE_CACHE_BYTES}))
+            source_deps = ['mezzanine']
+        measure_start, measure_end = 0, end - start
+    else:
+        measure_start, measure_end = start, end
+
+    if capped:
+        video_bitrate = _video_bitrate_cap(
+            source_file, target_size, target_bitrate, muted, source_settings)
+        for output_file, settings in output_settings.items():
+            settings['crf'] = ratecontrol.select_crf(
+                source_file, video_bitrate,
+                max_workers=max_workers,
+                progress_callback=progress_callback,
+                job=os.path.basename(output_file),
+                vf=outputs[output_file],
+                **settings,
+                **source_settings)
+
+    common_settings = dict(
+        common.MAP_SETTINGS,
+        **audio.AUDIO_SETTINGS,
+        **kwargs)
+    audio_settings = {k: v for k, v in common_settings.items()
+                      if k not in mezzanine_.TRIM_KEYS}
+    shared_audio = shared_audio and not muted and len(outputs) != 0
+
+    audio_file = os.path.join(_WORK_DIR, 'audio.wav')
+    if shared_audio:
+        jobs.append(plan.make_job(
+            'audio.wav', 'extract', 'audio.wav',
+            audio.compile_audio(
+                input_file, audio_file, 'wav', af=audio_filters,
+                **dict(kwargs, **audio.INTERMEDIATE_SETTINGS)),
+            [input_file], [audio_file], source_deps))
+
+    gain = {}
+    gain_deps = []
+    if norm:
+        # Levels are measured on the unfiltered source, as `get_norm_filter`
+        # always has, even when the filtered audio is shared.
+        jobs.extend(_compile_volumedetect_jobs(
+            input_file, max_workers, measure_start, measure_end,
+            source_deps, **kwargs))
+        gain = _GAIN_FILTER
+        gain_deps = ['gain']
+    full_audio_filters = dict(audio_filters, **gain)
+
+    opus_file = os.path.join(_WORK_DIR, 'audio.webm')
+    if shared_audio and len(output_settings) != 0:
+        jobs.append(plan.make_job(
+            'audio.webm', 'opus', 'audio.webm',
+            audio.compile_audio(
+                audio_file, opus_file, 'webm', af=gain,
+                **audio.OPUS_SETTINGS, **audio_settings),
+            [audio_file], [opus_file], ['audio.wav'] + gain_deps))
+
+    # Jobs that finish each output, by output file.
+    finals = {}
+    timing = None
+    split_outputs = {}
+    split_settings = {}
+    for output_file, filters in outputs.items():
+        name = os.path.basename(output_file)
+
+        if filters is None:
+            if shared_audio:
+                cmd = audio.compile_mp3(
+                    audio_file, output_file, af=gain,
+                    **audio.MP3_SETTINGS, **audio_settings)
+                inputs, deps = [audio_file], ['audio.wav'] + gain_deps
+            else:
+                cmd = audio.compile_mp3(
+                    input_file, output_file, af=full_audio_filters,
+                    **audio.MP3_SETTINGS, **common_settings)
+                inputs, deps = [input_file], source_deps + gain_deps
+            jobs.append(plan.make_job(
+                name, 'mp3', name, cmd, inputs, [output_file], deps))
+            finals[output_file] = name
+            continue
+
+        settings = output_settings[output_file]
+        video_file = (os.path.join(_WORK_DIR, name) if shared_audio
+                      else output_file)
+        webm_settings = dict(
+            vf=filters,
+            af=full_audio_filters,
+            muted=muted or shared_audio,
+            **settings,
+            **audio.OPUS_SETTINGS,
+            **common_settings)
+        audio_deps = [] if muted or shared_audio else gain_deps
+        if engine == 'split':
+            split_outputs[video_file] = filters
+            split_settings[video_file] = settings
+            video_job = 'split:pass2'
+        elif passes == 1:
+            video_job = f"{name}:draft"
+            jobs.append(plan.make_job(
+                video_job, 'draft', name,
+                video.compile_webm(
+                    input_file, video_file, passes=1, **webm_settings)[0],
+                [input_file], [video_file], source_deps + audio_deps,
+                threads=settings['threads']))
+        elif chunks > 1:
+            video_job = f"{name}:concat"
+            if len(source_deps) != 0 and timing is None:
+                timing = _mezzanine_keyframes(source_file, start, end)
+            jobs.extend(_compile_chunked_jobs(
+                input_file, video_file, name, passlog_cache, source_deps,
+                audio_deps, chunks, timing, **webm_settings))
+        else:
+            video_job = f"{name}:pass2"
+            jobs.extend(_compile_pass_jobs(
+                input_file, video_file, name, name,
+                os.path.join(_WORK_DIR, os.path.splitext(name)[0]),
+                passlog_cache, source_deps, audio_deps, **webm_settings))
+        finals[output_file] = video_job
+        if shared_audio:
+            finals[output_file] = f"{name}:mux"
+            jobs.append(plan.make_job(
+                f"{name}:mux", 'mux', name,
+                mux.compile_mux_streams(video_file, opus_file, output_file),
+                [video_file, opus_file], [output_file],
+                [video_job, 'audio.webm']))
+
+    if len(split_outputs) != 0:
+        job = '+'.join(os.path.basename(f) for f in split_outputs)
+        threads = sum(s['threads'] for s in split_settings.values())
+        pass_1_cmd, pass_2_cmd = video.compile_webm_split(
+            input_file, split_outputs,
+            muted=muted or shared_audio,
+            passlogfile=os.path.join(_WORK_DIR, 'split'),
+            settings=split_settings,
+            af=full_audio_filters,
+            **audio.OPUS_SETTINGS,
+            **common_settings)
+        jobs.append(plan.make_job(
+            'split:pass1', 'pass 1', job, pass_1_cmd, [input_file], [],
+            source_deps, threads=threads, pass_number=1))
+        jobs.append(plan.make_job(
+            'split:pass2', 'pass 2', job, pass_2_cmd, [input_file],
+            list(split_outputs),
+            ['split:pass1'] + ([] if muted or shared_audio else gain_deps),
+            threads=threads, pass_number=2))
+
+    expected = validate_.expected_outputs(outputs, end - start, muted)
+    for output_file, final in list(finals.items()):
+        name = os.path.basename(output_file)
+        if validate:
+            jobs.append(plan.make_job(
+                f"{name}:validate", 'validate', name, None, [output_file],
+                [], [final], kind='validate',
+                args={'expected': expected[output_file]}))
+            finals[output_file] = f"{name}:validate"
+        if incremental:
+            fingerprint = fingerprints.fingerprint(
+                source_file, _job_commands(jobs, final))
+            jobs.append(plan.make_job(
+                f"{name}:fingerprint", 'fingerprint', name, None,
+                [output_file], [fingerprints.sidecar_path(output_file)],
+                [finals[output_file]], kind='fingerprint',
+                args={'fingerprint': fingerprint}))
+            finals[output_file] = f"{name}:fingerprint"
+
+    skipped = []
+    if incremental:
+        skipped = _up_to_date(jobs, finals)
+        jobs = _prune(jobs, [finals[output_file] for output_file in finals
+                             if output_file not in skipped])
+    return {'jobs': jobs, 'skipped': skipped}
+
+
+def _compile_pass_jobs(
+        input_file: str,
+        output_file: str,
+        job_id: str,
+        job: str,
+        passlogfile: str,
+        passlog_cache: bool,
+        source_deps: List[str],
+        audio_deps: List[str],
+        **kwargs) -> List[Dict[str, any]]:
+    """
+    Returns the pass 1 and pass 2 jobs of a webm, with IDs `{job_id}:pass1`
+    and `{job_id}:pass2`. See `video.compile_webm` for arguments.
 
+    Args:
+        passlog_cache (bool): Whether pass 1 goes through the pass log cache.
+        source_deps (list of str): Jobs that write `input_file`.
+        audio_deps (list of str): Jobs that pass 2's audio waits for.
+
+    Returns:
+        (list of dict of str: any): Jobs.
+    """
+    pass_1_cmd, pass_2_cmd = video.compile_webm(
+        input_file, output_file, passlogfile=passlogfile, **kwargs)
+    threads = kwargs.get('threads', video.VP9_SETTINGS['threads'])
+    return [
+        plan.make_job(
+            f"{job_id}:pass1", 'pass 1', job, pass_1_cmd, [input_file], [],
+            source_deps, threads=threads, pass_number=1,
+            args={'passlog_cache': True} if passlog_cache else None),
+        plan.make_job(
+            f"{job_id}:pass2", 'pass 2', job, pass_2_cmd, [input_file],
+            [output_file], [f"{job_id}:pass1"] + audio_deps,
+            threads=threads, pass_number=2)]
+
+
+def _compile_chunked_jobs(
+        input_file: str,
+        output_file: str,
+        name: str,
+        passlog_cache: bool,
+        source_deps: List[str],
+        audio_deps: List[str],
+        chunks: int,
+        timing: Dict[str, any],
+        **kwargs) -> List[Dict[str, any]]:
+    """
+    Returns the jobs of a chunked webm: the passes of each chunk, its audio
+    track if not muted, and the concat job `{name}:concat`.
+    See `video.compile_webm_chunked` for arguments.
+
+    Returns:
+        (list of dict of str: any): Jobs.
+    """
+    work_dir = os.path.join(_WORK_DIR, os.path.splitext(name)[0])
+    muted = kwargs.pop('muted')
+    planned = video.compile_webm_chunked(
+        input_file, output_file, work_dir, muted, chunks, timing, **kwargs)
+    threads = kwargs.get('threads', video.VP9_SETTINGS['threads'])
+    jobs = []
+    chunk_files = []
+    concat_deps = [f"{name}:list"]
+    for i, chunk in enumerate(planned['chunks']):
+        job_id = f"{name}:chunk-{i + 1}"
+        pass_1_cmd, pass_2_cmd = chunk['cmds']
+        jobs.append(plan.make_job(
+            f"{job_id}:pass1", 'pass 1',
+            f"{name} [{i + 1}/{len(planned['chunks'])}]",
+            pass_1_cmd, [input_file], [], source_deps, threads=threads,
+            pass_number=1,
+            args={'passlog_cache': True} if passlog_cache else None))
+        jobs.append(plan.make_job(
+            f"{job_id}:pass2", 'pass 2',
+            f"{name} [{i + 1}/{len(planned['chunks'])}]",
+            pass_2_cmd, [input_file], [chunk['output']],
+            [f"{job_id}:pass1"], threads=threads, pass_number=2))
+        chunk_files.append(chunk['output'])
+        concat_deps.append(f"{job_id}:pass2")
+    jobs.append(plan.make_job(
+        f"{name}:list", 'list', name, None, chunk_files, [planned['list']],
+        [f"{name}:chunk-{i + 1}:pass2"
+         for i in range(len(planned['chunks']))], kind='list'))
+    concat_inputs = chunk_files
+    if planned['audio'] is not None:
+        jobs.append(plan.make_job(
+            f"{name}:audio", 'opus', f"{name} [audio]",
+            planned['audio']['cmd'], [input_file],
+            [planned['audio']['output']], source_deps + audio_deps))
+        concat_deps.append(f"{name}:audio")
+        concat_inputs = chunk_files + [planned['audio']['output']]
+    jobs.append(plan.make_job(
+        f"{name}:concat", 'concat', name, planned['concat'],
+        concat_inputs + [planned['list']], [output_file], concat_deps))
+    return jobs
+
+
+def _mezzanine_keyframes(
+        source_file: str,
+        start: float,
+        end: float) -> Dict[str, any]:
+    """
+    Returns the chunk timing of a mezzanine that hasn't been cut yet. Every
+    mezzanine frame is a keyframe, so the source's keyframes within the trim
+    are used, shifted to the start of the cut. See `video.probe_keyframes`.
+    """
+    timing = video.probe_keyframes(source_file)
+    return {
+        'keyframes': [keyframe - start for keyframe in timing['keyframes']
+                      if start <= keyframe <= end],
+        'duration': end - start,
+        'fps': timing['fps'],
+    }
+
+
+def _job_commands(
+        jobs: List[Dict[str, any]],
+        job_id: str) -> List[List[str]]:
+    """
+    Returns the commands of a job and of every job it depends on, in plan
+    order, to fingerprint the output it writes. The mezzanine is left out:
+    its path already identifies the source and trim, and it has no job once
+    cached.
+    """
+    by_id = {job['id']: job for job in jobs}
+    needed = set()
+    pending = [job_id]
+    while len(pending) != 0:
+        current = pending.pop()
+        if current in needed or current == 'mezzanine':
+            continue
+        needed.add(current)
+        pending.extend(by_id[current]['deps'])
+    return [job['cmd'] for job in jobs
+            if job['id'] in needed and job['cmd'] is not None]
+
+
+def _up_to_date(
+        jobs: List[Dict[str, any]],
+        finals: Dict[str, str]) -> List[str]:
+    """
+    Returns the outputs whose fingerprint jobs record the fingerprint they
+    already have. An output that a job of another, outdated output rewrites
+    anyway (e.g. a `split` encode) isn't skipped.
+    """
+    by_id = {job['id']: job for job in jobs}
+    skipped = [
+        output_file for output_file, final in finals.items()
+        if fingerprints.is_up_to_date(
+            output_file, by_id[final]['args']['fingerprint'])]
+    while True:
+        needed = _prune(jobs, [finals[output_file] for output_file in finals
+                               if output_file not in skipped])
+        rewritten = {path for job in needed for path in job['outputs']}
+        kept = [output_file for output_file in skipped
+                if output_file not in rewritten]
+        if kept == skipped:
+            return skipped
+        skipped = kept
+
+
+def _prune(
+        jobs: List[Dict[str, any]],
+        job_ids: List[str]) -> List[Dict[str, any]]:
+    """
+    Returns the jobs needed to run the given jobs, in plan order.
+    """
+    by_id = {job['id']: job for job in jobs}
+    needed = set()
+    pending = list(job_ids)
+    while len(pending) != 0:
+        current = pending.pop()
+        if current in needed:
+            continue
+        needed.add(current)
+        pending.extend(by_id[current]['deps'])
+    return [job for job in jobs if job['id'] in needed]
+
+
+def _compile_volumedetect_jobs(
+        input_file: str,
+        segments: int,
+        start: float,
+        end: float,
+        deps: List[str],
+        **kwargs) -> List[Dict[str, any]]:
+    """
+    Returns the plan jobs that measure the levels of an input in `segments`
+    equal time ranges, like `audio.detect_volume`, followed by the `gain`
+    job that merges them.
+
+    Args:
+        input_file (str): Path to file to measure.
+        segments (int): Number of time ranges.
+        start (float): Start of the measured range in seconds.
+        end (float): End of the measured range in seconds.
+        deps (list of str): Jobs that write `input_file`.
+        **kwargs: Native ffmpeg parameters, including trim when measuring a
+            single range.
+
+    Returns:
+        (list of dict of str: any): Jobs.
+    """
+    if segments <= 1:
+        jobs = [plan.make_job(
+            'volumedetect', 'volumedetect', 'volumedetect',
+            audio.compile_volumedetect(input_file, **kwargs),
+            [input_file], [], deps, parse='volumedetect')]
+    else:
+        for key in mezzanine_.TRIM_KEYS:
+            kwargs.pop(key, None)
+        length = (end - start) / segments
+        jobs = [plan.make_job(
+            f"volumedetect-{i + 1}", 'volumedetect',
+            f"volumedetect [{i + 1}/{segments}]",
+            audio.compile_volumedetect(
+                input_file, ss=f"{start + i*length:.6f}", t=f"{length:.6f}",
+                **kwargs),
+            [input_file], [], deps, parse='volumedetect')
+            for i in range(segments)]
+    jobs.append(plan.make_job(
+        'gain', 'gain', 'gain', None, [], [],
+        [job['id'] for job in jobs], kind='gain'))
+    return jobs
+
+
+def _prepare_outputs(
+        input_file: str,
+        output_dir: str,
+        muted: bool,
+        skip_resolutions: Union[str, list],
+        budget: resources.CpuBudget,
+        draft: bool,
+        kwargs: Dict[str, any]) -> tuple:
+    """
+    Plans the outputs of `encode_all` and their VP9 settings, popping the
+    parameters this uses from `kwargs`.
+
+    Args:
+        input_file (str): Path to video file to encode from.
+        output_dir (str): Path to output encoded files.
+        muted (bool): Whether to leave out the mp3.
+        skip_resolutions (str or list of int): Resolutions to leave out.
+        budget (resources.CpuBudget): Budget to tune VP9 threading for, or
+            None.
+        draft (bool): Whether to only keep the smallest webm and the mp3,
+            with `video.DRAFT_VP9_SETTINGS`.
+        kwargs (dict of str: any): Keyword arguments of `encode_all`.
+            Updated in place.
+
+    Returns:
+        (tuple): Outputs from `plan_outputs`, VP9 settings by webm, and the
+            audio filters.
+    """
+    if kwargs.pop('snap_seek', False) and 'ss' in kwargs:
+        kwargs.update(probe.snap_seek(
+            kwargs, probe.keyframe_index(input_file)))
+
+    vp9_overrides = kwargs.pop('vp9_settings', {})
     vp9_settings = dict(
         video.VP9_SETTINGS,
-        **kwargs.pop('vp9_settings', {}))
+        **(video.DRAFT_VP9_SETTINGS if draft else {}),
+        **vp9_overrides)
 
     probe_data = dict(
         video.probe_dimensions(input_file),
@@ -109,41 +907,70 @@ def encode_all(
     video_filters = dict(
         video.INIT_VIDEO_FILTERS,
         **common.parse_filter_string(kwargs.pop('vf', {})))
-    audio_filters = dict(
-        common.parse_filter_string(kwargs.pop('af', {})),
-        **(audio.get_norm_filter(input_file, **kwargs) if norm else {}))
+    audio_filters = common.parse_filter_string(kwargs.pop('af', {}))
 
-    common_settings = dict(
-        common.MAP_SETTINGS,
-        **audio.AUDIO_SETTINGS,
-        **kwargs)
+    outputs = plan_outputs(
+        output_dir, kwargs.pop('resolutions', video.RESOLUTIONS),
+        skip_resolutions, probe_data, video_filters, muted)
+    if draft:
+        # Outputs are planned in ascending resolution.
+        webms = [output_file for output_file, filters in outputs.items()
+                 if filters is not None][:1]
+        outputs = {output_file: filters
+                   for output_file, filters in outputs.items()
+                   if filters is None or output_file in webms}
 
-    for resolution in resolutions:
+    output_settings = {}
+    for output_file, filters in outputs.items():
+        if filters is None:
+            continue
+        output_settings[output_file] = dict(vp9_settings)
+        if budget is not None:
+            width = int(filters['scale'].split('x')[0])
+            output_settings[output_file].update(
+                resources.tune_vp9(width, budget.total),
+                **vp9_overrides)
+    if len(output_settings) != 0 and not capabilities.detect()['row_mt']:
+        # libvpx builds older than 1.7 don't have row-mt.
+        for settings in output_settings.values():
+            settings.pop('row-mt', None)
+    return outputs, output_settings, audio_filters
 
-        resolution = int(resolution)
 
-        if resolution == 0 and muted is not True:  # 0 = mp3
-            output_file = os.path.join(output_dir, f"{resolution}.mp3")
-            audio.encode_mp3(
-                input_file, output_file,
-                af=audio_filters,
-                **audio.MP3_SETTINGS,
-                **common_settings)
-            continue
+def _video_bitrate_cap(
+        input_file: str,
+        target_size: Union[str, int],
+        target_bitrate: Union[str, int],
+        muted: bool,
+        settings: Dict[str, any]) -> float:
+    """
+    Returns the video bitrate that keeps a webm within a size and/or overall
+    bitrate cap, leaving room for the Opus track.
 
-        if (resolution > probe_data['height']+16 and
-            resolution > resolutions[first_video]):
-            print(f"Skipping {resolution}p due to insufficient video height")
-            continue
+    Args:
+        input_file (str): Path to video file to encode from.
+        target_size (str or int): Maximum size, or None.
+        target_bitrate (str or int): Maximum overall bitrate, or None.
+        muted (bool): Whether the webm has no audio.
+        settings (dict of str: any): Encode parameters, including trim and
+            audio bitrate.
 
-        output_file = os.path.join(output_dir, f"{resolution}.webm")
-        width = round(probe_data['dar'] * resolution)
-        height = resolution
-        video_filters.update(scale=f"{width}x{height}")
-        video.encode_webm(
-            input_file, output_file,
-            vf=video_filters, af=audio_filters,
-            muted=muted,
-            **vp9_settings,
-            **audio.OPUS_SETTINGS,
-            **common_settings)
+    Returns:
+        (float): Maximum video bitrate in bits per second.
+
+    Raises:
+        ValueError: If the cap doesn't even leave room for the audio.
+    """
+    caps = []
+    if target_bitrate is not None:
+        caps.append(ratecontrol.parse_bitrate(target_bitrate))
+    if target_size is not None:
+        start, end = ratecontrol.trim_range(input_file, settings)
+        caps.append(ratecontrol.parse_size(target_size) * 8 / (end - start))
+    video_bitrate = min(caps)
+    if not muted:
+        video_bitrate -= ratecontrol.parse_bitrate(
+            settings.get('b:a', audio.AUDIO_SETTINGS['b:a']))
+    if video_bitrate <= 0:
+        raise ValueError("Target size or bitrate is too small for the audio")
+    return video_bitrate
@@ -0,0 +1,101 @@
+"""Output fingerprints
+
+Functions for fingerprinting outputs so that unchanged outputs can be skipped
+on later runs. A fingerprint hashes the identity of the source file together
+with the compiled ffmpeg commands that produce an output, including those of
+the jobs it depends on (see `encode.compile_encode_all`), and is stored in a
+hidden sidecar file next to the output.
+"""
+
+
+__all__ = [
+    'fingerprint',
+    'sidecar_path',
+    'is_up_to_date',
+    'write_fingerprint',
+    'clear_fingerprint',
+]
+
+
+import os
+from typing import List
+
+from . import cache
+
+
+def fingerprint(input_file: str, cmds: List[List[str]]) -> str:
+    """
+    Returns a fingerprint for an output built from the input file.
+
+    Args:
+        input_file (str): Path to source file.
+        cmds (list of list of str): Compiled ffmpeg commands that produce the
+            output. Temporary paths and measured values should be left as
+            plan variables, see `plan`.
+
+    Returns:
+        (str): Fingerprint hex digest.
+    """
+    return cache.hash_key(cache.file_identity(input_file), cmds)
+
+
+def sidecar_path(output_file: str) -> str:
+    """
+    Returns the path of the fingerprint sidecar file for an output.
+
+    Args:
+        output_file (str): Path to output file.
+
+    Returns:
+        (str): Path to sidecar file.
+    """
+    directory, name = os.path.split(output_file)
+    return os.path.join(directory, f".{name}.fingerprint")
+
+
+def is_up_to_date(output_file: str, output_fingerprint: str) -> bool:
+    """
+    Returns whether an output exists and was built with the same fingerprint.
+
+    Args:
+        output_file (str): Path to output file.
+        output_fingerprint (str): Fingerprint the output should have.
+
+    Returns:
+        (bool): True if the output can be skipped.
+    """
+    try:
+        if os.path.getsize(output_file) == 0:
+            return False
+        with open(sidecar_path(output_file)) as file:
+            return file.read().strip() == output_fingerprint
+    except OSError:
+        return False
+
+
+def write_fingerprint(output_file: str, output_fingerprint: str) -> None:
+    """
+    Records the fingerprint of a successfully built output.
+    Nothing is recorded if the output is missing or empty.
+
+    Args:
+        output_file (str): Path to output file.
+        output_fingerprint (str): Fingerprint to record.
+    """
+    if not os.path.isfile(output_file) or os.path.getsize(output_file) == 0:
+        return
+    with open(sidecar_path(output_file), 'w') as file:
+        file.write(output_fingerprint + '\n')
+
+
+def clear_fingerprint(output_file: str) -> None:
+    """
+    Removes the fingerprint of an output that is about to be rebuilt.
+
+    Args:
+        output_file (str): Path to output file.
+    """
+    try:
+        os.remove(sidecar_path(output_file))
+    except OSError:
+        pass
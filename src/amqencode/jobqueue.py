@@ -0,0 +1,442 @@
+"""Job queues
+
+A job queue stored in a sqlite database, so that encodes can be spread over
+several workers and hosts that share a volume. A job is a serialized call: a
+kind (see `JOB_KINDS`) and its JSON keyword arguments. Paths in jobs should
+be absolute and reachable under the same name from every host.
+
+Workers claim jobs with a lease that they renew with heartbeats while the job
+runs. A job whose lease runs out, because its worker died or lost the
+volume, goes back to the queue, and fails for good after `max_attempts`
+claims. A worker that loses its lease, or can't renew it in time, kills the
+job's ffmpeg processes, so that it never writes outputs alongside the worker
+that took the job over.
+
+Workers report what they do through the `amqencode.jobqueue` logger.
+
+sqlite locking relies on the file system; use a volume with working POSIX
+locks (e.g. NFSv4 or SMB with locking enabled).
+"""
+
+
+__all__ = [
+    'JOB_KINDS',
+    'JobQueue',
+    'run_worker',
+]
+
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Union
+
+from . import batch, encode, mux, resources, trace
+
+
+JOB_KINDS = {
+    'entry': lambda args: batch.run_entry(args),
+    'encode_all': lambda args: encode.encode_all(**args),
+    'mux_clean_directory': lambda args: encode.mux_clean_directory(**args),
+    'mux_clean': lambda args: mux.mux_clean(**args),
+}
+"""(dict of str: callable): Functions run for each kind of job, called with
+the job's arguments. `entry` jobs are batch manifest entries, see
+`batch.run_entry`."""
+
+_log = logging.getLogger(__name__)
+
+_BUDGET_KINDS = ('entry', 'encode_all')
+"""(tuple of str): Kinds of jobs that take `max_workers` and `cpu_budget`."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+
+class JobQueue:
+    """
+    A job queue in a sqlite database. Safe to use from several threads,
+    processes and hosts at once.
+
+    Args:
+        db_file (str): Path to database. Created if it doesn't exist.
+        lease (float, optional): Seconds a claim lasts without a heartbeat.
+            Defaults to 60.
+        max_attempts (int, optional): Number of claims before a job whose
+            lease keeps running out is failed. Defaults to 3.
+    """
+
+    def __init__(
+            self,
+            db_file: str,
+            lease: float = 60,
+            max_attempts: int = 3):
+        self.db_file = db_file
+        self.lease = lease
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self, timeout: float = 60):
+        """
+        Context manager that opens a connection and commits on exit.
+        Connections aren't shared between threads.
+
+        Args:
+            timeout (float, optional): Seconds to wait for a lock held by
+                another connection. Defaults to 60.
+        """
+        conn = sqlite3.connect(self.db_file, timeout=timeout)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def submit(self, kind: str, **kwargs) -> int:
+        """
+        Adds a job to the queue.
+
+        Args:
+            kind (str): Kind of job, see `JOB_KINDS`.
+            **kwargs: Arguments of the call. Must be JSON-serializable.
+
+        Returns:
+            (int): Job id.
+
+        Raises:
+            ValueError: If the kind is unknown.
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO jobs (kind, args, created, updated) '
+                'VALUES (?, ?, ?, ?)',
+                (kind, json.dumps(kwargs), now, now))
+            return cursor.lastrowid
+
+    def claim(self, worker: str) -> Union[Dict[str, any], None]:
+        """
+        Claims the oldest queued job, or a job whose lease ran out.
+
+        Args:
+            worker (str): Name of the claiming worker.
+
+        Returns:
+            (dict of str: any): Job with keys `id`, `kind`, `args` and
+                `attempts`, or None if there is nothing to do.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            # Take the write lock up front so that two workers can't claim
+            # the same job.
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', updated = ?, "
+                "error = 'lease ran out ' || attempts || ' times' "
+                "WHERE state = 'running' AND lease_expires < ? "
+                "AND attempts >= ?",
+                (now, now, self.max_attempts))
+            row = conn.execute(
+                "SELECT id, kind, args, attempts FROM jobs "
+                "WHERE state = 'queued' "
+                "OR (state = 'running' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, "
+                "lease_expires = ?, attempts = attempts + 1, updated = ? "
+                "WHERE id = ?",
+                (worker, now + self.lease, now, row['id']))
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'args': json.loads(row['args']),
+            'attempts': row['attempts'] + 1}
+
+    def heartbeat(self, job_id: int, worker: str) -> bool:
+        """
+        Renews the lease on a claimed job.
+
+        Args:
+            job_id (int): Job id.
+            worker (str): Name of the worker holding the claim.
+
+        Returns:
+            (bool): Whether the worker still holds the claim.
+
+        Raises:
+            sqlite3.Error: If the database can't be updated, e.g. because
+                it stays locked for a sixth of the lease.
+        """
+        now = time.time()
+        with self._connect(timeout=self.lease / 6) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND state = 'running'",
+                (now + self.lease, now, job_id, worker))
+            return cursor.rowcount == 1
+
+    def finish(
+            self,
+            job_id: int,
+            worker: str,
+            ok: bool,
+            error: str = None) -> bool:
+        """
+        Marks a claimed job as done or failed.
+
+        Args:
+            job_id (int): Job id.
+            worker (str): Name of the worker holding the claim.
+            ok (bool): Whether the job succeeded.
+            error (str, optional): Error message of a failed job.
+
+        Returns:
+            (bool): Whether the worker still held the claim. If not, the job
+                was given to another worker and is left alone.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated = ?, "
+                "lease_expires = NULL "
+                "WHERE id = ? AND worker = ? AND state = 'running'",
+                ('done' if ok else 'failed', error, time.time(),
+                 job_id, worker))
+            return cursor.rowcount == 1
+
+    def retry(self, states: List[str] = ('failed',)) -> int:
+        """
+        Puts finished jobs back in the queue.
+
+        Args:
+            states (list of str, optional): States of the jobs to requeue.
+                Defaults to failed jobs only.
+
+        Returns:
+            (int): Number of requeued jobs.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'queued', attempts = 0, "
+                "error = NULL, updated = ? WHERE state IN ({})".format(
+                    ', '.join('?' * len(states))),
+                (time.time(), *states))
+            return cursor.rowcount
+
+    def jobs(self) -> List[Dict[str, any]]:
+        """
+        Returns every job in the queue.
+
+        Returns:
+            (list of dict of str: any): Jobs with keys `id`, `kind`, `args`,
+                `state`, `attempts`, `worker`, `updated` and `error`.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id, kind, args, state, attempts, worker, updated, '
+                'error FROM jobs ORDER BY id').fetchall()
+        return [dict(row, args=json.loads(row['args'])) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Returns the number of jobs in each state.
+
+        Returns:
+            (dict of str: int): Dictionary mapping states to job counts.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return {state: count for state, count in rows}
+
+
+def run_worker(
+        job_queue: JobQueue,
+        max_jobs: int = 1,
+        max_workers: int = 1,
+        cpu_budget: int = None,
+        poll_interval: float = 5,
+        exit_when_idle: bool = False,
+        progress_callback: Callable = None,
+        stop: threading.Event = None) -> None:
+    """
+    Claims and runs jobs from a queue until stopped.
+
+    Args:
+        job_queue (JobQueue): Queue to take jobs from.
+        max_jobs (int, optional): Number of jobs to run at the same time.
+            Defaults to 1.
+        max_workers (int, optional): Default `max_workers` for `entry` and
+            `encode_all` jobs. Defaults to 1.
+        cpu_budget (int, optional): Number of CPU threads shared by the
+            worker's encodes. See `encode_all`. Use 0 for all cores.
+            Defaults to None.
+        poll_interval (float, optional): Seconds to wait before checking an
+            empty queue again. Defaults to 5.
+        exit_when_idle (bool, optional): Whether to return once the queue
+            has no more jobs to claim. Defaults to False.
+        progress_callback (callable, optional): Called with progress reports
+            from every ffmpeg process. See `progress`. Defaults to None.
+        stop (threading.Event, optional): Event that stops claiming jobs once
+            set. Running jobs are finished first. Defaults to None.
+    """
+    stop = stop or threading.Event()
+    defaults = {'max_workers': max_workers}
+    if cpu_budget is not None:
+        defaults['cpu_budget'] = resources.CpuBudget(cpu_budget or None)
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(
+            target=trace.propagate(lambda i=i: _work(
+                job_queue, f"{name}:{i}", defaults, poll_interval,
+                exit_when_idle, progress_callback, stop)),
+            daemon=True)
+        for i in range(max(max_jobs, 1))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _work(
+        job_queue: JobQueue,
+        worker: str,
+        defaults: Dict[str, any],
+        poll_interval: float,
+        exit_when_idle: bool,
+        progress_callback: Callable,
+        stop: threading.Event) -> None:
+    """
+    Runs jobs from the queue one at a time. See `run_worker`.
+    """
+    while not stop.is_set():
+        job = job_queue.claim(worker)
+        if job is None:
+            if exit_when_idle:
+                return
+            stop.wait(poll_interval)
+            continue
+        args = job['args']
+        if job['kind'] in _BUDGET_KINDS:
+            args = dict(defaults, **args)
+        if progress_callback is not None:
+            args['progress_callback'] = progress_callback
+        _log.info(
+            "[%s] claimed job %s (%s, attempt %s)",
+            worker, job['id'], job['kind'], job['attempts'])
+
+        done = threading.Event()
+        cancel = threading.Event()
+        beat = threading.Thread(
+            target=_heartbeat,
+            args=(job_queue, job['id'], worker, done, cancel),
+            daemon=True)
+        beat.start()
+        with trace.cancellation(cancel):
+            ok, error = _run_job(job['kind'], args)
+        done.set()
+        beat.join()
+        if not job_queue.finish(job['id'], worker, ok, error):
+            _log.warning(
+                "[%s] job %s was given to another worker", worker, job['id'])
+            continue
+        if ok:
+            _log.info("[%s] job %s done", worker, job['id'])
+        else:
+            _log.error(
+                "[%s] job %s FAILED\n%s", worker, job['id'], error.rstrip())
+
+
+def _run_job(kind: str, args: Dict[str, any]) -> tuple:
+    """
+    Runs a job, recording its stages to tell whether any ffmpeg process
+    failed.
+
+    Args:
+        kind (str): Kind of job.
+        args (dict of str: any): Arguments of the call.
+
+    Returns:
+        (tuple of bool, str): Whether the job succeeded, and its error.
+    """
+    with trace.recording() as recorder:
+        try:
+            value = JOB_KINDS[kind](args)
+        except Exception:
+            return False, traceback.format_exc(limit=3)
+    if isinstance(value, dict) and value.get('ok') is False:
+        return False, value['error']
+    failed = trace.failed(recorder.results)
+    if len(failed) != 0:
+        return False, '\n'.join(trace.format_failure(r) for r in failed)
+    return True, None
+
+
+def _heartbeat(
+        job_queue: JobQueue,
+        job_id: int,
+        worker: str,
+        done: threading.Event,
+        cancel: threading.Event) -> None:
+    """
+    Renews a job's lease every third of the lease until it is done. Sets
+    `cancel` if the lease was taken over, or if renewing it keeps failing
+    until there's no time left to retry before it runs out, since another
+    worker may then claim the job.
+    """
+    renewed = time.monotonic()
+    interval = job_queue.lease / 3
+    while not done.wait(interval):
+        try:
+            held = job_queue.heartbeat(job_id, worker)
+        except sqlite3.Error as error:
+            # A heartbeat takes at most a sixth of the lease, so one more
+            # retry fits while less than half of it has passed.
+            if time.monotonic() - renewed < job_queue.lease / 2:
+                _log.warning("[%s] heartbeat failed: %s", worker, error)
+                interval = job_queue.lease / 6
+                continue
+            _log.error(
+                "[%s] couldn't renew the lease on job %s, stopping it: %s",
+                worker, job_id, error)
+            cancel.set()
+            return
+        if not held:
+            _log.error(
+                "[%s] lost the lease on job %s, stopping it", worker, job_id)
+            cancel.set()
+            return
+        renewed = time.monotonic()
+        interval = job_queue.lease / 3
@@ -0,0 +1,139 @@
+"""Batch journals
+
+An append-only JSON lines log of the state transitions of batch jobs, so that
+an interrupted batch can tell which jobs finished and resume the rest.
+
+Each line is an object with keys `time` (epoch seconds), `job` (a key
+identifying the manifest entry, see `job_key`), `state` and any extra fields.
+Jobs go through `running` to either `done` or `failed`; every ffmpeg stage a
+job runs is logged in between with the state `stage`. Lines are flushed to
+disk as they are written, and a line torn by a crash is ignored when the
+journal is read back.
+"""
+
+
+__all__ = [
+    'Journal',
+    'job_key',
+    'load_states',
+]
+
+
+import json
+import os
+import threading
+import time
+from typing import Dict
+
+from . import cache, trace
+
+
+def job_key(entry: Dict[str, any]) -> str:
+    """
+    Returns a key identifying a manifest entry by its settings, so that
+    entries are matched across runs even if the manifest is reordered.
+
+    Args:
+        entry (dict of str: any): Normalized manifest entry.
+
+    Returns:
+        (str): Job key.
+    """
+    return cache.hash_key(entry)
+
+
+def load_states(journal_file: str) -> Dict[str, str]:
+    """
+    Returns the last recorded state of every job in a journal.
+
+    Args:
+        journal_file (str): Path to journal.
+
+    Returns:
+        (dict of str: str): Dictionary mapping job keys to states.
+            Empty if the journal doesn't exist.
+    """
+    states = {}
+    if not os.path.isfile(journal_file):
+        return states
+    with open(journal_file) as file:
+        for line in file:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('state') != 'stage':
+                states[event['job']] = event['state']
+    return states
+
+
+class Journal:
+    """
+    A thread-safe writer for a batch journal.
+
+    Args:
+        journal_file (str): Path to journal.
+        resume (bool, optional): Whether to append to an existing journal.
+            Otherwise it is started over. Defaults to False.
+    """
+
+    def __init__(self, journal_file: str, resume: bool = False):
+        directory = os.path.dirname(journal_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(journal_file, 'a' if resume else 'w')
+        self._lock = threading.Lock()
+
+    def write(self, job: str, state: str, **fields) -> None:
+        """
+        Appends a state transition and flushes it to disk.
+
+        Args:
+            job (str): Job key.
+            state (str): New state.
+            **fields: Extra values to record.
+        """
+        line = json.dumps(dict(
+            {'time': time.time(), 'job': job, 'state': state}, **fields))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def recorder(self, job: str) -> trace.Recorder:
+        """
+        Returns a recorder that journals every stage result it receives.
+        See `trace.recording`.
+
+        Args:
+            job (str): Job key.
+
+        Returns:
+            (trace.Recorder): Journaling recorder.
+        """
+        return _JournalRecorder(self, job)
+
+    def close(self) -> None:
+        """
+        Closes the journal.
+        """
+        with self._lock:
+            self._file.close()
+
+
+class _JournalRecorder(trace.Recorder):
+    """
+    A recorder that also writes each stage result to a journal.
+    """
+
+    def __init__(self, journal: Journal, job: str):
+        super().__init__()
+        self._journal = journal
+        self._job = job
+
+    def add(self, result: Dict[str, any]) -> None:
+        super().add(result)
+        self._journal.write(
+            self._job, 'stage',
+            stage=result['stage'], name=result['job'],
+            returncode=result['returncode'], output=result['output'])
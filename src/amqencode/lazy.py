@@ -0,0 +1,43 @@
+"""Lazy imports
+
+Modules that are only loaded once one of their attributes is used, so that
+commands which never build an ffmpeg command don't pay for importing
+ffmpeg-python and its dependencies.
+"""
+
+
+__all__ = [
+    'import_module',
+]
+
+
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def import_module(name: str) -> ModuleType:
+    """
+    Returns a module that is loaded on first attribute access, or the module
+    itself if it was already imported.
+
+    Args:
+        name (str): Absolute module name.
+
+    Returns:
+        (module): Module.
+
+    Raises:
+        ImportError: If the module can't be found.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
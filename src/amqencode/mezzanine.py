@@ -0,0 +1,133 @@
+"""Trimmed mezzanines
+
+Functions for cutting the trimmed range of a source once into a fast-decoding
+lossless intermediate (FFV1 video and PCM audio in Matroska), so that every
+later stage of an encode reads a small local file instead of seeking through
+a large, possibly remote, source.
+
+Mezzanines are cached by source identity and trim, and evicted least recently
+used first once the cache exceeds `MEZZANINE_CACHE_BYTES`, just before a new
+one is cut (see `plan.prepare_job`). Set the
+`AMQENCODE_MEZZANINE_DIR` environment variable to keep them on a fast local
+disk or tmpfs.
+"""
+
+
+__all__ = [
+    'MEZZANINE_CACHE_BYTES',
+    'MEZZANINE_DIR',
+    'MEZZANINE_SETTINGS',
+    'TRIM_KEYS',
+    'mezzanine_path',
+    'find_mezzanine',
+    'compile_mezzanine',
+]
+
+
+import os
+from typing import Dict, List, Tuple
+
+from . import cache, common, lazy, probe
+
+ffmpeg = lazy.import_module('ffmpeg')
+
+
+MEZZANINE_CACHE_BYTES = 20 << 30
+"""(int): Maximum total size of the mezzanine cache in bytes."""
+
+MEZZANINE_DIR = os.environ.get(
+    'AMQENCODE_MEZZANINE_DIR',
+    os.path.join(cache.CACHE_DIR, 'mezzanine'))
+"""(str): Folder mezzanines are cached in."""
+
+MEZZANINE_SETTINGS = {
+    'c:v': 'ffv1',
+    'level': 3,
+    'g': 1,
+    'slices': 16,
+    'slicecrc': 0,
+    'coder': 0,
+    'context': 0,
+    'c:a': 'pcm_f32le',
+}
+"""(dict of str: str/int): Intra-only lossless parameters for mezzanines.
+Slices let FFV1 decode on several threads, and Golomb-Rice coding with a
+small context model decodes faster than the range coder."""
+
+TRIM_KEYS = ('ss', 'to', 't')
+"""(tuple of str): Encode parameters that select the trimmed range."""
+
+
+def mezzanine_path(input_file: str, trim: Dict[str, any]) -> str:
+    """
+    Returns the cache path of the mezzanine for a source and trim, without
+    creating it.
+
+    Args:
+        input_file (str): Path to source file.
+        trim (dict of str: any): Trim parameters (`ss`, `to`, `t`).
+
+    Returns:
+        (str): Path to mezzanine.
+    """
+    key = cache.hash_key(
+        cache.file_identity(input_file),
+        {k: str(v) for k, v in trim.items() if k in TRIM_KEYS},
+        MEZZANINE_SETTINGS)
+    return os.path.join(MEZZANINE_DIR, key + '.mkv')
+
+
+def find_mezzanine(
+        input_file: str,
+        trim: Dict[str, any]) -> Tuple[str, bool]:
+    """
+    Returns the cache path of the mezzanine for a source and trim, and
+    whether it is already cached. A cached mezzanine is marked as recently
+    used.
+
+    Args:
+        input_file (str): Path to source file.
+        trim (dict of str: any): Trim parameters (`ss`, `to`, `t`).
+
+    Returns:
+        (tuple of str, bool): Path to mezzanine, and whether it exists.
+    """
+    output_file = mezzanine_path(input_file, trim)
+    if not os.path.isfile(output_file):
+        return output_file, False
+    cache.touch(output_file)
+    return output_file, True
+
+
+def compile_mezzanine(
+        input_file: str,
+        output_file: str,
+        **kwargs) -> List[str]:
+    """
+    Returns the ffmpeg command that cuts a mezzanine without running it.
+    The first video stream and the first audio stream, if any, are kept,
+    without filters.
+
+    Args:
+        input_file (str): Path to source file.
+        output_file (str): Path to output mezzanine.
+        **kwargs: Trim parameters (`ss`, `to`, `t`).
+
+    Returns:
+        (list of str): Command line.
+    """
+    input_stream = ffmpeg.input(input_file)
+    streams = [input_stream['v:0']]
+    codec_types = [
+        stream.get('codec_type')
+        for stream in probe.probe(input_file)['streams']]
+    if 'audio' in codec_types:
+        streams.append(input_stream['a:0'])
+
+    seek = common.extract_seek(
+        {k: v for k, v in kwargs.items() if k in TRIM_KEYS})
+    cmd = ffmpeg.output(
+        *streams, output_file, format='matroska',
+        **common.MAP_SETTINGS, **MEZZANINE_SETTINGS).compile()
+    cmd[1:1] = seek
+    return cmd
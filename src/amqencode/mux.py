@@ -5,19 +5,26 @@ Functions for muxing clean audio with video files.
 
 __all__ = [
     'mux_clean',
+    'compile_mux_clean',
+    'mux_streams',
+    'compile_mux_streams',
 ]
 
 
-import ffmpeg
+import os
+from typing import Callable, Dict, List, Union
 
-from . import audio, common
+from . import audio, common, lazy, progress
+
+ffmpeg = lazy.import_module('ffmpeg')
 
 
 def mux_clean(
         input_video: str,
         input_audio: str,
         output_file: str,
-        norm: bool = False) -> None:
+        norm: bool = False,
+        progress_callback: Callable = None) -> Dict[str, any]:
     """
     Muxes an input file with a clean audio file.
 
@@ -26,17 +33,55 @@ def mux_clean(
         input_audio (str): Path to clean audio file to mux.
         output_file (str): Path to output muxed file.
         norm (bool): Whether to normalize audio level of the output.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg, with the output file name as the job. See
+            `progress`. Defaults to None.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg fails.
     """
 
     common.ensure_dir(output_file)
 
-    audio_stream = ffmpeg.input(input_audio).audio
-    args = dict(audio.AUDIO_SETTINGS)
+    cmd = compile_mux_clean(
+        input_video, input_audio, output_file,
+        audio.get_norm_filter(input_audio) if norm else {})
+    result = progress.run(
+        cmd, os.path.basename(output_file),
+        progress_callback=progress_callback,
+        stage='mux', output_file=output_file)
+    if result['returncode'] != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+    return result
+
 
-    if norm:
-        audio_stream = common.apply_filters(
-            audio_stream,
-            audio.get_norm_filter(input_audio))
+def compile_mux_clean(
+        input_video: str,
+        input_audio: str,
+        output_file: str,
+        af: Union[str, dict] = None) -> List[str]:
+    """
+    Returns the ffmpeg command for `mux_clean` without running it.
+
+    Args:
+        input_video (str): Path to video file to mux.
+        input_audio (str): Path to clean audio file to mux.
+        output_file (str): Path to output muxed file.
+        af (str or dict of str: str/None, optional):
+            String or dictionary of audio filters to apply, e.g. the gain
+            from `audio.get_norm_filter`.
+
+    Returns:
+        (list of str): Command line.
+    """
+
+    audio_stream = common.apply_filters(
+        ffmpeg.input(input_audio).audio,
+        af or {})
+    args = dict(audio.AUDIO_SETTINGS)
 
     if input_video.endswith('.mp3'):
         duration = audio.probe_duration(input_video)
@@ -52,4 +97,62 @@ def mux_clean(
             **args, **audio.OPUS_SETTINGS)
         stream = ffmpeg.output(video_stream, audio_stream, output_file, **args)
 
-    stream.run(overwrite_output=True)
+    return stream.compile(overwrite_output=True)
+
+
+def mux_streams(
+        input_video: str,
+        input_audio: str,
+        output_file: str,
+        progress_callback: Callable = None) -> Dict[str, any]:
+    """
+    Muxes the video of one file with the audio of another without
+    re-encoding either of them.
+
+    Args:
+        input_video (str): Path to video file to mux.
+        input_audio (str): Path to audio file to mux.
+        output_file (str): Path to output muxed file.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg, with the output file name as the job. See
+            `progress`. Defaults to None.
+
+    Returns:
+        (dict of str: any): Stage result, see `trace`.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg fails.
+    """
+
+    common.ensure_dir(output_file)
+
+    cmd = compile_mux_streams(input_video, input_audio, output_file)
+    result = progress.run(
+        cmd, os.path.basename(output_file),
+        progress_callback=progress_callback,
+        stage='mux', output_file=output_file)
+    if result['returncode'] != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+    return result
+
+
+def compile_mux_streams(
+        input_video: str,
+        input_audio: str,
+        output_file: str) -> List[str]:
+    """
+    Returns the ffmpeg command for `mux_streams` without running it.
+
+    Args:
+        input_video (str): Path to video file to mux.
+        input_audio (str): Path to audio file to mux.
+        output_file (str): Path to output muxed file.
+
+    Returns:
+        (list of str): Command line.
+    """
+    return ffmpeg.output(
+        ffmpeg.input(input_video).video,
+        ffmpeg.input(input_audio).audio,
+        output_file,
+        c='copy', **common.MAP_SETTINGS).compile(overwrite_output=True)
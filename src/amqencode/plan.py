@@ -0,0 +1,426 @@
+"""Job plans
+
+An encode compiled ahead of time into a graph of jobs, so that it can be
+printed, inspected, serialized as JSON, or reordered and run by another tool.
+`encode.encode_all` and `encode.mux_clean_directory` run the plans built by
+`encode.compile_encode_all` and `encode.compile_mux_clean_directory`.
+
+A plan is a dictionary with the key `jobs`, a list of jobs, and optionally
+`skipped`, a list of outputs left out because they are up to date. Each job
+is a dictionary with keys:
+
+- `id` (str): Unique name within the plan.
+- `kind` (str): `ffmpeg` to run `cmd`, `copy` to copy its only input to its
+  only output, `list` to write its inputs to its only output as a concat
+  list (see `video.write_concat_list`), `validate` to check its only input
+  (see `validate.validate_output`), `fingerprint` to record the fingerprint
+  of its only input (see `fingerprints`), or `gain` to turn the levels
+  measured by its dependencies into the `gain` variable (see
+  `audio.gain_filter`).
+- `stage` (str): Stage name of its result, see `trace`.
+- `job` (str): Job name passed to the progress callback.
+- `pass_number` (int): Pass number passed to the progress callback, or None.
+- `cmd` (list of str): Compiled ffmpeg command, or None.
+- `inputs` (list of str): Files the job reads.
+- `outputs` (list of str): Files the job writes.
+- `deps` (list of str): IDs of the jobs that must finish first.
+- `threads` (int): Encoder threads the job uses, for scheduling.
+- `parse` (str): `volumedetect` if the job measures levels, or None.
+- `args` (dict of str: any): Options of the job: `passlog_cache` (bool) for
+  a pass 1 `ffmpeg` job whose logs go through the pass log cache (see
+  `video.run_pass_1_cached`), `expected` for a `validate` job (see
+  `validate.expected_outputs`), `fingerprint` (str) for a `fingerprint`
+  job, and `cache_bytes` (int) for a job whose only output is a new entry
+  of an LRU cache folder, such as a mezzanine, to evict older entries of
+  the folder down to that size before it runs (see `cache.evict_lru`).
+
+Jobs that write outputs first remove their fingerprints, so that an output
+rebuilt by an interrupted run is never taken as up to date.
+
+Commands and paths may refer to variables that are only known while the plan
+runs, written as `{name}`: `{work}` is a private temporary folder for
+intermediate files, and `{gain}` is the normalization volume.
+"""
+
+
+__all__ = [
+    'EXECUTORS',
+    'PARSERS',
+    'ThreadExecutor',
+    'make_job',
+    'order',
+    'format_plan',
+    'resolve',
+    'prepare_job',
+    'run_job',
+    'run_plan',
+]
+
+
+import os
+import shlex
+import shutil
+import tempfile
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED, Executor, Future, ThreadPoolExecutor, wait)
+from functools import partial
+from typing import Callable, Dict, List, Tuple, Union
+
+from . import (
+    audio, cache, common, fingerprints, progress, resources, trace,
+    validate as validate_, video)
+
+
+EXECUTORS = ('serial', 'thread', 'process')
+"""(tuple of str): Names of the built-in executors, see `run_plan`."""
+
+PARSERS = {'volumedetect': audio.parse_volumedetect}
+"""(dict of str: callable): Log parsers of jobs, by `parse` name."""
+
+
+def make_job(
+        job_id: str,
+        stage: str,
+        job: str,
+        cmd: List[str],
+        inputs: List[str],
+        outputs: List[str],
+        deps: List[str] = (),
+        kind: str = 'ffmpeg',
+        threads: int = 1,
+        pass_number: int = None,
+        parse: str = None,
+        args: Dict[str, any] = None) -> Dict[str, any]:
+    """
+    Returns a job for a plan. See the keys of the same names above.
+
+    Returns:
+        (dict of str: any): Job.
+    """
+    return {
+        'id': job_id,
+        'kind': kind,
+        'stage': stage,
+        'job': job,
+        'pass_number': pass_number,
+        'cmd': cmd,
+        'inputs': list(inputs),
+        'outputs': list(outputs),
+        'deps': list(deps),
+        'threads': threads,
+        'parse': parse,
+        'args': dict(args or {}),
+    }
+
+
+def order(plan: Dict[str, any]) -> List[Dict[str, any]]:
+    """
+    Returns the jobs of a plan in an order that runs every job after its
+    dependencies, keeping the plan's order otherwise.
+
+    Args:
+        plan (dict of str: any): Plan to order.
+
+    Returns:
+        (list of dict of str: any): Jobs in dependency order.
+
+    Raises:
+        ValueError: If a job depends on an unknown job, or on itself through
+            a cycle.
+    """
+    jobs = {job['id']: job for job in plan['jobs']}
+    for job in plan['jobs']:
+        for dep in job['deps']:
+            if dep not in jobs:
+                raise ValueError(f"Job {job['id']} depends on unknown {dep}")
+    ordered = []
+    done = set()
+    while len(ordered) != len(jobs):
+        ready = [job for job in plan['jobs'] if job['id'] not in done
+                 and all(dep in done for dep in job['deps'])]
+        if len(ready) == 0:
+            raise ValueError('Plan has a dependency cycle')
+        ordered.extend(ready)
+        done.update(job['id'] for job in ready)
+    return ordered
+
+
+def format_plan(plan: Dict[str, any]) -> str:
+    """
+    Returns a plan as a shell-like script for dry runs: a comment line for
+    each skipped output, then each job in dependency order as a comment
+    line, followed by its quoted command if it has one.
+
+    Args:
+        plan (dict of str: any): Plan to format.
+
+    Returns:
+        (str): Formatted plan.
+    """
+    lines = [f"# {output_file} is up to date"
+             for output_file in plan.get('skipped', [])]
+    for job in order(plan):
+        header = f"# [{job['id']}] {job['stage']}"
+        if len(job['deps']) != 0:
+            header += f" after {', '.join(job['deps'])}"
+        lines.append(header)
+        if job['kind'] == 'ffmpeg':
+            lines.append(' '.join(shlex.quote(arg) for arg in job['cmd']))
+        elif job['kind'] == 'copy':
+            lines.append(' '.join(
+                shlex.quote(arg)
+                for arg in ['cp'] + job['inputs'] + job['outputs']))
+    return '\n'.join(lines)
+
+
+def resolve(
+        job: Dict[str, any],
+        variables: Dict[str, str]) -> Dict[str, any]:
+    """
+    Returns a copy of a job with variables substituted into its command and
+    paths.
+
+    Args:
+        job (dict of str: any): Job to resolve.
+        variables (dict of str: str): Variable values by name.
+
+    Returns:
+        (dict of str: any): Resolved job.
+    """
+
+    def substitute(value):
+        for name, replacement in variables.items():
+            value = value.replace('{' + name + '}', replacement)
+        return value
+
+    return dict(
+        job,
+        cmd=[substitute(arg) for arg in job['cmd']]
+        if job['cmd'] is not None else None,
+        inputs=[substitute(path) for path in job['inputs']],
+        outputs=[substitute(path) for path in job['outputs']])
+
+
+def prepare_job(
+        job: Dict[str, any],
+        variables: Dict[str, str]) -> Dict[str, any]:
+    """
+    Resolves a job, creates the folders of its outputs and pass logs,
+    removes the fingerprints of its outputs before they are rewritten, and
+    makes room in the cache folder of a `cache_bytes` job. Evicting before
+    the job runs never removes the new entry, even if it alone is over the
+    limit.
+
+    Args:
+        job (dict of str: any): Job to prepare.
+        variables (dict of str: str): Variable values by name.
+
+    Returns:
+        (dict of str: any): Resolved job.
+    """
+    job = resolve(job, variables)
+    for output_file in job['outputs']:
+        common.ensure_dir(output_file)
+        fingerprints.clear_fingerprint(output_file)
+    if job['cmd'] is not None and '-passlogfile' in job['cmd']:
+        common.ensure_dir(job['cmd'][job['cmd'].index('-passlogfile') + 1])
+    if job.get('args', {}).get('cache_bytes') is not None:
+        cache.evict_lru(
+            os.path.dirname(job['outputs'][0]),
+            max_bytes=job['args']['cache_bytes'])
+    return job
+
+
+def run_job(
+        job: Dict[str, any],
+        variables: Dict[str, str],
+        progress_callback: Callable = None
+        ) -> Tuple[List[Dict[str, any]], any]:
+    """
+    Runs any job but a `gain` job. Safe to run in another process.
+
+    Args:
+        job (dict of str: any): Job to run.
+        variables (dict of str: str): Variable values by name.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg. See `progress`. Defaults to None.
+
+    Returns:
+        (tuple of list of dict of str: any, any): Stage results of the job,
+            see `trace`, and the result of its parser if it has one.
+    """
+    job = prepare_job(job, variables)
+    args = job.get('args', {})
+    value = None
+    with trace.recording(isolated=True) as recorder:
+        if job['kind'] == 'copy':
+            shutil.copyfile(job['inputs'][0], job['outputs'][0])
+        elif job['kind'] == 'list':
+            video.write_concat_list(job['outputs'][0], job['inputs'])
+        elif job['kind'] == 'fingerprint':
+            fingerprints.write_fingerprint(
+                job['inputs'][0], args['fingerprint'])
+        elif job['kind'] == 'validate':
+            value = validate_.validate_output(
+                job['inputs'][0], args.get('expected'))
+        elif args.get('passlog_cache'):
+            cmd = job['cmd']
+            video.run_pass_1_cached(
+                job['inputs'][0], cmd,
+                cmd[cmd.index('-passlogfile') + 1],
+                partial(
+                    progress.run, job=job['job'],
+                    pass_number=job['pass_number'],
+                    progress_callback=progress_callback,
+                    stage=job['stage']))
+        else:
+            _, value = progress.run_and_parse(
+                job['cmd'], PARSERS.get(job['parse']), job['job'],
+                job['pass_number'], progress_callback, job['stage'],
+                job['outputs'][0] if len(job['outputs']) != 0 else None,
+                job['outputs'])
+    return recorder.results, value
+
+
+def run_plan(
+        plan: Dict[str, any],
+        executor: Union[str, Executor] = 'serial',
+        max_workers: int = 1,
+        progress_callback: Callable = None,
+        budget: resources.CpuBudget = None) -> List[Dict[str, any]]:
+    """
+    Runs a plan, starting each job as soon as its dependencies have
+    finished. Jobs that depend on a failed job are skipped. Skipped outputs
+    of the plan are recorded as `skip` stage results.
+
+    Args:
+        plan (dict of str: any): Plan to run.
+        executor (str or concurrent.futures.Executor, optional): `serial`
+            to run one job at a time in the calling thread, `thread` or
+            `process` for a pool of `max_workers` threads or processes, or
+            an executor to submit `run_job` calls to. Progress reports
+            aren't passed on from `process` pools. Defaults to `serial`.
+        max_workers (int, optional): Number of jobs to run at the same time
+            in a new pool. Defaults to 1.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg. See `progress`. Defaults to None.
+        budget (resources.CpuBudget, optional): CPU budget each job reserves
+            its `threads` from before it is submitted, so that concurrent
+            jobs are packed within the budget. Defaults to None.
+
+    Returns:
+        (list of dict of str: any): Stage results of every ffmpeg process
+            that ran, see `trace`.
+
+    Raises:
+        ValueError: If the executor is unknown or the plan can't be ordered.
+    """
+    jobs = order(plan)
+    if isinstance(executor, str):
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor: {executor}")
+        if executor == 'process':
+            # Imported here, since it loads multiprocessing.
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=max(max_workers, 1))
+            progress_callback = None
+        elif executor == 'thread':
+            pool = ThreadExecutor(max_workers=max(max_workers, 1))
+        else:
+            pool = _SerialExecutor()
+    else:
+        pool = executor
+
+    values = {}
+    done = set()
+    failed = set()
+    running = {}
+    with trace.recording() as recorder, tempfile.TemporaryDirectory(
+            prefix='amqencode-') as work_dir:
+        variables = {'work': work_dir}
+        for output_file in plan.get('skipped', []):
+            trace.stage_result(
+                'skip', os.path.basename(output_file), [], 0, time.time(),
+                0, output_file=output_file)
+        try:
+            while len(jobs) != 0 or len(running) != 0:
+                for job in list(jobs):
+                    if any(dep in failed for dep in job['deps']):
+                        jobs.remove(job)
+                        failed.add(job['id'])
+                    elif all(dep in done for dep in job['deps']):
+                        jobs.remove(job)
+                        if job['kind'] == 'gain':
+                            variables['gain'] = audio.gain_filter(
+                                audio.merge_levels(
+                                    [values[dep] for dep in job['deps']])
+                                )['volume']
+                            done.add(job['id'])
+                            continue
+                        running[_submit(
+                            pool, budget, job, dict(variables),
+                            progress_callback)] = job['id']
+                if len(running) == 0:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job_id = running.pop(future)
+                    results, values[job_id] = future.result()
+                    for result in results:
+                        trace.record(result)
+                    if len(trace.failed(results)) == 0:
+                        done.add(job_id)
+                    else:
+                        failed.add(job_id)
+        finally:
+            if pool is not executor:
+                pool.shutdown()
+    return recorder.results
+
+
+def _submit(
+        pool: Executor,
+        budget: resources.CpuBudget,
+        job: Dict[str, any],
+        variables: Dict[str, str],
+        progress_callback: Callable) -> Future:
+    """
+    Submits a `run_job` call, holding a reservation of the job's threads on
+    the budget until it is done.
+    """
+    if budget is None:
+        return pool.submit(run_job, job, variables, progress_callback)
+    threads = budget.acquire(job['threads'])
+    try:
+        future = pool.submit(run_job, job, variables, progress_callback)
+    except BaseException:
+        budget.release(threads)
+        raise
+    future.add_done_callback(lambda _: budget.release(threads))
+    return future
+
+
+class ThreadExecutor(ThreadPoolExecutor):
+    """
+    A thread pool that runs each call with the recorders and cancellation
+    events of the thread that submitted it, see `trace.propagate`. Pass one
+    to several `run_plan` calls to limit their jobs together.
+    """
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return super().submit(trace.propagate(partial(fn, *args, **kwargs)))
+
+
+class _SerialExecutor(Executor):
+    """
+    Runs each submitted call right away in the calling thread.
+    """
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+        return future
@@ -0,0 +1,358 @@
+"""Media probing
+
+A single ffprobe layer shared by the other modules. Each file is probed once
+for all of its streams and format info, and the result is memoized in
+process and in an on-disk cache keyed by the file's path, size and mtime.
+
+Keyframe indexes of video files are built the same way, once per version of
+a file, from packet flags only.
+"""
+
+
+__all__ = [
+    'PROBE_CACHE_ENTRIES',
+    'probe',
+    'keyframe_index',
+    'plan_seek',
+    'snap_seek',
+    'compile_probe',
+    'run_probe',
+    'load_cached',
+    'store_cached',
+    'first_stream',
+]
+
+
+import bisect
+import copy
+import json
+import os
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from fractions import Fraction
+from typing import Dict, List, Union
+
+from . import cache, common, lazy, trace
+
+ffmpeg = lazy.import_module('ffmpeg')
+
+
+PROBE_CACHE_ENTRIES = 10000
+"""(int): Maximum number of probe results kept in the on-disk cache."""
+
+_MEMO_ENTRIES = 256
+"""(int): Maximum number of probe results kept in process."""
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def probe(input_file: str, use_cache: bool = True) -> Dict[str, any]:
+    """
+    Returns ffprobe's stream and format info for the input file.
+
+    Args:
+        input_file (str): Path to media file to probe.
+        use_cache (bool, optional): Whether to use cached results.
+            Defaults to True.
+
+    Returns:
+        (dict of str: any): Dictionary with keys `streams` and `format`, as
+            returned by `ffprobe -show_streams -show_format`.
+
+    Raises:
+        ffmpeg.Error: If ffprobe fails.
+    """
+    if not use_cache:
+        return run_probe(compile_probe(input_file))
+    metadata = load_cached(input_file)
+    if metadata is None:
+        metadata = run_probe(compile_probe(input_file))
+        store_cached(input_file, metadata)
+    return copy.deepcopy(metadata)
+
+
+def keyframe_index(
+        input_file: str,
+        use_cache: bool = True) -> Union[Dict[str, any], None]:
+    """
+    Returns the keyframe index of the first video stream of the input file.
+    Reads packet flags only, so the source isn't decoded.
+
+    Args:
+        input_file (str): Path to media file to index.
+        use_cache (bool, optional): Whether to use cached results.
+            Defaults to True.
+
+    Returns:
+        (dict of str: any or None): Dictionary with keys `keyframes` (sorted
+            list of keyframe timestamps in seconds), `positions` (byte
+            offset of each keyframe, or None), `duration` (seconds, of the
+            container or else of the video stream) and `frame_rate`
+            (fraction string). None if there's no video stream.
+
+    Raises:
+        ffmpeg.Error: If ffprobe fails.
+        ValueError: If no duration is known.
+    """
+    if use_cache:
+        index = load_cached(input_file, 'keyframes')
+        if index is not None:
+            return copy.deepcopy(index)
+
+    metadata = probe(input_file, use_cache)
+    try:
+        stream = first_stream(metadata, 'video')
+    except ValueError:
+        return None
+    packets = run_probe(compile_probe(
+        input_file,
+        '-select_streams', f"{stream['index']}",
+        '-show_entries', 'packet=pts_time,pos,flags'),
+        stage='keyframes').get('packets', [])
+    keyframes = sorted(
+        (float(packet['pts_time']), packet.get('pos', 'N/A'))
+        for packet in packets
+        if 'K' in packet.get('flags', '')
+        and packet.get('pts_time', 'N/A') != 'N/A')
+    duration = metadata['format'].get('duration') or stream.get('duration')
+    if duration is None:
+        raise ValueError(
+            f"No duration found in {metadata['format'].get('filename')}")
+    frame_rate = stream.get('avg_frame_rate', '0/0')
+    if frame_rate.endswith('/0'):
+        frame_rate = stream.get('r_frame_rate', '0/1')
+    index = {
+        'keyframes': [time for time, _ in keyframes],
+        'positions': [
+            None if pos == 'N/A' else int(pos) for _, pos in keyframes],
+        'duration': float(duration),
+        'frame_rate': frame_rate,
+    }
+    if use_cache:
+        store_cached(input_file, index, 'keyframes')
+    return copy.deepcopy(index)
+
+
+def plan_seek(index: Dict[str, any], start: float) -> Dict[str, float]:
+    """
+    Plans an accurate input seek with a keyframe index.
+
+    ffmpeg decodes from the keyframe before the trim start and drops frames
+    until it. When a keyframe falls less than a frame after the trim start,
+    the same first video frame is reached by seeking straight to that
+    keyframe, which skips decoding the whole previous GOP.
+
+    Args:
+        index (dict of str: any): Index from `keyframe_index`.
+        start (float): Requested trim start in seconds.
+
+    Returns:
+        (dict of str: float): Dictionary with keys `start` (seek target in
+            seconds, at least the requested start), `keyframe` (keyframe
+            decoding starts from) and `preroll` (seconds decoded and
+            dropped before `start`).
+    """
+    keyframes = index['keyframes']
+    frame_rate = Fraction(index['frame_rate'])
+    frame = float(1 / frame_rate) if frame_rate > 0 else 0
+    position = bisect.bisect_left(keyframes, start)
+    if position < len(keyframes) and (
+            keyframes[position] == start or
+            keyframes[position] - start < frame):
+        start = keyframes[position]
+        position += 1
+    keyframe = keyframes[position - 1] if position > 0 else 0.0
+    return {
+        'start': start,
+        'keyframe': keyframe,
+        'preroll': max(start - keyframe, 0.0),
+    }
+
+
+def snap_seek(
+        kwargs: Dict[str, any],
+        index: Dict[str, any]) -> Dict[str, any]:
+    """
+    Returns the trim parameters of an encode with the start planned by
+    `plan_seek`: a start less than a frame before a keyframe is moved onto
+    it, and `t` is shortened to keep the same end.
+
+    Args:
+        kwargs (dict of str: any): Keyword arguments with `ss`, and `t` or
+            `to`.
+        index (dict of str: any): Index from `keyframe_index`, or None.
+
+    Returns:
+        (dict of str: any): Updated `ss` and `t`, to apply to `kwargs`.
+            Empty if the start stays the same.
+    """
+    if index is None or 'ss' not in kwargs:
+        return {}
+    requested = common.parse_timestamp(kwargs['ss'])
+    planned = plan_seek(index, requested)['start']
+    if planned <= requested:
+        return {}
+    snapped = {'ss': f"{planned:.6f}"}
+    if 't' in kwargs:
+        duration = common.parse_timestamp(kwargs['t']) - (planned - requested)
+        snapped['t'] = f"{max(duration, 0):.6f}"
+    return snapped
+
+
+def compile_probe(input_file: str, *args: str) -> List[str]:
+    """
+    Returns the ffprobe command used by `probe` without running it.
+    Its JSON output can be passed to `store_cached`.
+
+    Args:
+        input_file (str): Path to media file to probe.
+        *args (str): Extra ffprobe options, e.g. to show packets.
+
+    Returns:
+        (list of str): Command line.
+    """
+    return [
+        'ffprobe', '-show_format', '-show_streams', '-of', 'json',
+        *args, input_file]
+
+
+def run_probe(cmd: List[str], stage: str = 'probe') -> Dict[str, any]:
+    """
+    Runs an ffprobe command with JSON output and records its stage result.
+    See `trace`.
+
+    Args:
+        cmd (list of str): Command line from `compile_probe`.
+        stage (str, optional): Stage name. Defaults to `probe`.
+
+    Returns:
+        (dict of str: any): Parsed ffprobe output.
+
+    Raises:
+        ffmpeg.Error: If ffprobe fails.
+    """
+    start_time = time.time()
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = []
+    reader = threading.Thread(
+        target=lambda: err.append(proc.stderr.read()), daemon=True)
+    reader.start()
+    out = proc.stdout.read()
+    reader.join()
+    returncode, cpu, max_rss = trace.wait(proc)
+    trace.stage_result(
+        stage, os.path.basename(cmd[-1]), cmd, returncode,
+        start_time, time.monotonic() - start, cpu, max_rss=max_rss)
+    if returncode != 0:
+        raise ffmpeg.Error('ffprobe', out, err[0])
+    return json.loads(out.decode('utf-8'))
+
+
+def load_cached(
+        input_file: str,
+        kind: str = 'probe') -> Union[Dict[str, any], None]:
+    """
+    Returns cached probe results for the current version of a file.
+
+    Args:
+        input_file (str): Path to media file.
+        kind (str, optional): `probe`, or `keyframes` for keyframe indexes.
+
+    Returns:
+        (dict of str: any or None): Probe results, or None on a cache miss.
+    """
+    key = _cache_key(input_file, kind)
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+
+    cache_file = os.path.join(cache.cache_dir(kind), key + '.json')
+    try:
+        with open(cache_file) as file:
+            metadata = json.load(file)
+    except (OSError, ValueError):
+        return None
+    cache.touch(cache_file)
+    _remember(key, metadata)
+    return metadata
+
+
+def store_cached(
+        input_file: str,
+        metadata: Dict[str, any],
+        kind: str = 'probe') -> None:
+    """
+    Stores probe results for the current version of a file, evicting the
+    least recently used entries past `PROBE_CACHE_ENTRIES`.
+
+    Args:
+        input_file (str): Path to media file.
+        metadata (dict of str: any): Probe results.
+        kind (str, optional): `probe`, or `keyframes` for keyframe indexes.
+    """
+    key = _cache_key(input_file, kind)
+    _remember(key, metadata)
+
+    directory = cache.cache_dir(kind)
+    cache_file = os.path.join(directory, key + '.json')
+    temp_file = f"{cache_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, 'w') as file:
+            json.dump(metadata, file)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    cache.evict_lru(directory, max_entries=PROBE_CACHE_ENTRIES)
+
+
+def _cache_key(input_file: str, kind: str = 'probe') -> str:
+    """
+    Returns the cache key for the current version of a file.
+    """
+    identity = cache.file_identity(input_file)
+    if kind == 'probe':
+        return cache.hash_key(
+            identity['path'], identity['size'], identity['mtime_ns'])
+    return cache.hash_key(
+        kind, identity['path'], identity['size'], identity['mtime_ns'])
+
+
+def _remember(key: str, metadata: Dict[str, any]) -> None:
+    """
+    Adds probe results to the in-process cache.
+    """
+    with _memo_lock:
+        _memo[key] = metadata
+        _memo.move_to_end(key)
+        while len(_memo) > _MEMO_ENTRIES:
+            _memo.popitem(last=False)
+
+
+def first_stream(
+        metadata: Dict[str, any],
+        codec_type: str) -> Dict[str, any]:
+    """
+    Returns the first stream of a given type from probe results.
+
+    Args:
+        metadata (dict of str: any): Probe results from `probe`.
+        codec_type (str): Stream type, e.g. `video` or `audio`.
+
+    Returns:
+        (dict of str: any): Stream info.
+
+    Raises:
+        ValueError: If there is no stream of that type.
+    """
+    for stream in metadata['streams']:
+        if stream.get('codec_type') == codec_type:
+            return stream
+    raise ValueError(
+        f"No {codec_type} stream found in {metadata['format']['filename']}")
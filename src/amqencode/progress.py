@@ -0,0 +1,309 @@
+"""Progress reporting
+
+Runs ffmpeg with `-progress pipe:1` and reads its progress reports as they
+are written, passing each one to a callback. Log output on stderr can be
+parsed line by line at the same time, without buffering the whole log.
+Every process is recorded as a stage result, see `trace`. Outputs are written
+under partial names and only moved into place once ffmpeg succeeds, see
+`common.stage_outputs`.
+
+A progress callback is called as
+`progress_callback(job, pass_number, out_time, fps, speed)` with the job name
+(usually the output file name), the pass number (1 or 2 for 2-pass encodes,
+None otherwise), the position reached in the output in seconds, and the
+current encoding fps and speed (None while ffmpeg doesn't know them yet).
+"""
+
+
+__all__ = [
+    'run',
+    'run_and_parse',
+    'progress_args',
+    'parse_progress',
+    'ProgressDisplay',
+]
+
+
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+from . import common, trace
+
+
+def run(
+        cmd: List[str],
+        job: str = None,
+        pass_number: int = None,
+        progress_callback: Callable = None,
+        stage: str = 'ffmpeg',
+        output_file: str = None,
+        outputs: List[str] = None) -> Dict[str, any]:
+    """
+    Runs an ffmpeg command, reporting its progress and recording its stage
+    result. See `trace`.
+
+    Args:
+        cmd (list of str): Compiled ffmpeg command.
+        job (str, optional): Job name passed to the callback.
+        pass_number (int, optional): Pass number passed to the callback.
+        progress_callback (callable, optional): Called with each progress
+            report. ffmpeg's own status line and info messages are turned
+            off when set.
+        stage (str, optional): Stage name for the result. Defaults to
+            `ffmpeg`.
+        output_file (str, optional): File written by the command, to record
+            its size and bitrate.
+        outputs (list of str, optional): Every file written by the command.
+            Defaults to `output_file`.
+
+    Returns:
+        (dict of str: any): Stage result.
+    """
+    return run_and_parse(
+        cmd, None, job, pass_number, progress_callback,
+        stage, output_file, outputs)[0]
+
+
+def run_and_parse(
+        cmd: List[str],
+        parser: Callable[[Iterator[str]], any] = None,
+        job: str = None,
+        pass_number: int = None,
+        progress_callback: Callable = None,
+        stage: str = 'ffmpeg',
+        output_file: str = None,
+        outputs: List[str] = None) -> Tuple[Dict[str, any], any]:
+    """
+    Runs an ffmpeg command, reporting its progress and feeding its log
+    output to a parser as it is written.
+
+    Args:
+        cmd (list of str): Compiled ffmpeg command.
+        parser (callable, optional): Called with an iterator over stderr
+            lines; it should consume the iterator. If not set, stderr goes
+            to the terminal.
+        job (str, optional): Job name passed to the callback.
+        pass_number (int, optional): Pass number passed to the callback.
+        progress_callback (callable, optional): Called with each progress
+            report. See `progress_args` for the effect on ffmpeg's log.
+        stage (str, optional): Stage name for the result. Defaults to
+            `ffmpeg`.
+        output_file (str, optional): File written by the command, to record
+            its size and bitrate.
+        outputs (list of str, optional): Every file written by the command.
+            They are written to partial paths and moved into place only if
+            the command succeeds. Defaults to `output_file`.
+
+    Returns:
+        (tuple of dict of str: any, any): Stage result and the parser's
+            result.
+
+    Raises:
+        RuntimeError: If the work was cancelled, see `trace.cancellation`.
+            A running process is killed first, and its result recorded.
+    """
+    events = trace.cancel_events()
+    if any(event.is_set() for event in events):
+        raise RuntimeError(f"{stage} {job} was cancelled")
+    if outputs is None:
+        outputs = [output_file] if output_file is not None else []
+    full_cmd = common.stage_outputs(cmd, outputs)
+    full_cmd[1:1] = progress_args(
+        progress_callback is not None, parser is not None)
+    start_time = time.time()
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        full_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if parser is not None else None)
+    exited = threading.Event()
+    if len(events) != 0:
+        threading.Thread(
+            target=_kill_when_cancelled, args=(proc, events, exited),
+            daemon=True).start()
+    out_time = [None]
+
+    def report():
+        for fields in parse_progress(_lines(proc.stdout)):
+            if fields['out_time'] is not None:
+                out_time[0] = fields['out_time']
+            if progress_callback is not None:
+                progress_callback(
+                    job, pass_number,
+                    fields['out_time'], fields['fps'], fields['speed'])
+
+    parsed = None
+    if parser is None:
+        report()
+    else:
+        reader = threading.Thread(target=report, daemon=True)
+        reader.start()
+        parsed = parser(_lines(proc.stderr))
+        # Drain anything the parser left so ffmpeg can't block on stderr.
+        for _ in proc.stderr:
+            pass
+        reader.join()
+    returncode, cpu, max_rss = trace.wait(proc)
+    exited.set()
+    common.finish_outputs(outputs, returncode == 0)
+    result = trace.stage_result(
+        stage, job, cmd, returncode, start_time, time.monotonic() - start,
+        cpu, output_file, out_time[0], max_rss)
+    if any(event.is_set() for event in events) and returncode != 0:
+        raise RuntimeError(f"{stage} {job} was cancelled")
+    return result, parsed
+
+
+def _kill_when_cancelled(
+        proc: subprocess.Popen,
+        events: List[threading.Event],
+        exited: threading.Event) -> None:
+    """
+    Kills a process as soon as any of the events is set, unless it exits
+    first.
+    """
+    while not exited.wait(0.2):
+        if any(event.is_set() for event in events):
+            proc.kill()
+            return
+
+
+def progress_args(callback: bool, parse_log: bool) -> List[str]:
+    """
+    Returns the ffmpeg global options that send progress reports to stdout.
+    ffmpeg's status line is turned off when progress or the log is consumed
+    by the caller, and its info messages are turned off when progress is
+    reported to a callback and the log isn't parsed.
+
+    Args:
+        callback (bool): Whether progress goes to a callback.
+        parse_log (bool): Whether the log on stderr is parsed.
+
+    Returns:
+        (list of str): Options to insert after the program name.
+    """
+    args = ['-progress', 'pipe:1']
+    if callback or parse_log:
+        args.append('-nostats')
+    if callback and not parse_log:
+        args += ['-hide_banner', '-loglevel', 'warning']
+    return args
+
+
+def _lines(stream) -> Iterator[str]:
+    """
+    Yields decoded lines from a binary stream as they arrive.
+    """
+    for line in stream:
+        yield line.decode('utf-8', 'replace')
+
+
+def parse_progress(
+        lines: Iterable[str]) -> Iterator[Dict[str, Union[float, None]]]:
+    """
+    Parses the key=value reports written by `ffmpeg -progress`.
+
+    Args:
+        lines (iterable of str): Lines of progress output.
+
+    Yields:
+        (dict of str: float/bool): Dictionary with keys `out_time` (seconds),
+            `fps`, `speed` and `end` (True for the final report).
+    """
+    fields = {}
+    for line in lines:
+        key, sep, value = line.strip().partition('=')
+        if sep == '':
+            continue
+        if key != 'progress':
+            fields[key] = value
+            continue
+        out_time = _to_float(fields.get('out_time_us'))
+        speed = fields.get('speed', '').rstrip('x')
+        yield {
+            'out_time': out_time / 1e6 if out_time is not None else None,
+            'fps': _to_float(fields.get('fps')),
+            'speed': _to_float(speed),
+            'end': value == 'end'}
+        fields = {}
+
+
+def _to_float(value: str) -> Union[float, None]:
+    """
+    Converts a progress value to a float, or None if it isn't known yet.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProgressDisplay:
+    """
+    A progress callback that keeps a compact status line on the terminal,
+    with the position, fps and speed of every running job.
+
+    Args:
+        stream (file, optional): Where to write. Defaults to `sys.stderr`.
+        interval (float, optional): Minimum seconds between redraws.
+            Defaults to 0.5.
+    """
+
+    def __init__(self, stream=None, interval: float = 0.5):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_draw = 0
+        self._width = 0
+
+    def __call__(
+            self,
+            job: str,
+            pass_number: int,
+            out_time: float,
+            fps: float,
+            speed: float) -> None:
+        with self._lock:
+            self._jobs[job] = (pass_number, out_time, fps, speed)
+            now = time.monotonic()
+            if now - self._last_draw >= self.interval:
+                self._last_draw = now
+                self._draw()
+
+    def _draw(self) -> None:
+        """
+        Rewrites the status line.
+        """
+        parts = []
+        for job, (pass_number, out_time, fps, speed) in self._jobs.items():
+            part = job
+            if pass_number is not None:
+                part += f" p{pass_number}"
+            if out_time is not None:
+                minutes, seconds = divmod(out_time, 60)
+                part += f" {int(minutes)}:{seconds:04.1f}"
+            if fps is not None:
+                part += f" {fps:.0f}fps"
+            if speed is not None:
+                part += f" {speed:.2f}x"
+            parts.append(part)
+        line = ' | '.join(parts)
+        self.stream.write('\r' + line.ljust(self._width))
+        self.stream.flush()
+        self._width = len(line)
+
+    def close(self) -> None:
+        """
+        Ends the status line.
+        """
+        with self._lock:
+            if self._width != 0:
+                self._draw()
+                self.stream.write('\n')
+                self.stream.flush()
+            self._jobs = {}
+            self._width = 0
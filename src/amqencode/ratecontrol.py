@@ -0,0 +1,346 @@
+"""Rate control
+
+Functions for picking the VP9 `crf` that keeps an encode under a size or
+bitrate cap, by encoding a few short windows of the source instead of the
+whole thing.
+
+Bitrate falls roughly exponentially as `crf` rises, so the sampled bitrates
+are interpolated on a log scale. The first candidate is the configured `crf`:
+if it already fits, nothing else is sampled. Pass 1 only analyzes the source,
+so it runs once per window and its statistics are shared by every candidate.
+"""
+
+
+__all__ = [
+    'SAMPLE_WINDOWS',
+    'SAMPLE_SECONDS',
+    'MAX_CRF',
+    'parse_bitrate',
+    'parse_size',
+    'trim_range',
+    'sample_windows',
+    'select_crf',
+]
+
+
+import logging
+import math
+import os
+import re
+import tempfile
+from functools import partial
+from typing import Callable, Dict, List, Tuple, Union
+
+from . import cache, common, lazy, probe, progress, video
+
+ffmpeg = lazy.import_module('ffmpeg')
+
+_log = logging.getLogger(__name__)
+
+
+SAMPLE_WINDOWS = 4
+"""(int): Default number of windows sampled from the source."""
+
+SAMPLE_SECONDS = 2
+"""(float): Default length of each sampled window in seconds."""
+
+MAX_CRF = 63
+"""(int): Highest `crf` libvpx-vp9 accepts."""
+
+_CONTAINER_OVERHEAD = 0.01
+"""(float): Fraction of a webm's size taken by the container."""
+
+_SIZE_RE = re.compile(r'^\s*([0-9]*\.?[0-9]+)\s*([kmg]?)(i?)b?\s*$', re.I)
+
+
+def parse_size(size: Union[str, int]) -> int:
+    """
+    Converts a file size such as `8M`, `7.5MiB` or `500k` to bytes.
+    Suffixes are decimal, or binary with an `i`.
+
+    Args:
+        size (str/int): Size to convert.
+
+    Returns:
+        (int): Size in bytes.
+
+    Raises:
+        ValueError: If the size isn't valid.
+    """
+    return int(_parse(size, 'size'))
+
+
+def parse_bitrate(bitrate: Union[str, int]) -> float:
+    """
+    Converts an ffmpeg-style bitrate such as `320k` or `1.5M` to bits per
+    second.
+
+    Args:
+        bitrate (str/int): Bitrate to convert.
+
+    Returns:
+        (float): Bits per second.
+
+    Raises:
+        ValueError: If the bitrate isn't valid.
+    """
+    return _parse(bitrate, 'bitrate')
+
+
+def _parse(value: Union[str, int, float], name: str) -> float:
+    """
+    Converts a number with an optional `k`, `M` or `G` suffix.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _SIZE_RE.match(value)
+    if not match:
+        raise ValueError(f"Invalid {name}: {value}")
+    number, suffix, binary = match.groups()
+    base = 1024 if binary else 1000
+    return float(number) * base ** ' kmg'.index(suffix.lower() or ' ')
+
+
+def trim_range(
+        input_file: str,
+        kwargs: Dict[str, any]) -> Tuple[float, float]:
+    """
+    Returns the time range of the source that an encode covers.
+
+    Args:
+        input_file (str): Path to media file to encode from.
+        kwargs (dict of str: any): Encode parameters, including any of
+            `ss`, `to` and `t`.
+
+    Returns:
+        (tuple of float): Start and end in seconds.
+    """
+    start = common.parse_timestamp(kwargs.get('ss', 0))
+    duration = float(probe.probe(input_file)['format']['duration'])
+    if 't' in kwargs:
+        end = start + common.parse_timestamp(kwargs['t'])
+    elif 'to' in kwargs:
+        end = common.parse_timestamp(kwargs['to'])
+    else:
+        end = duration
+    return start, min(end, duration)
+
+
+def sample_windows(
+        start: float,
+        end: float,
+        windows: int = SAMPLE_WINDOWS,
+        length: float = SAMPLE_SECONDS) -> List[Tuple[float, float]]:
+    """
+    Returns evenly spaced windows covering a time range, each centered in
+    an equal share of the range.
+
+    Args:
+        start (float): Start of the range in seconds.
+        end (float): End of the range in seconds.
+        windows (int, optional): Number of windows.
+        length (float, optional): Length of each window in seconds.
+
+    Returns:
+        (list of tuple of float): List of `(start, end)` windows in seconds.
+            A single window covering the whole range if it's too short.
+    """
+    span = end - start
+    if span <= windows * length:
+        return [(start, end)]
+    share = span / windows
+    return [
+        (start + share * (i + 0.5) - length / 2,
+         start + share * (i + 0.5) + length / 2)
+        for i in range(windows)]
+
+
+def select_crf(
+        input_file: str,
+        target_bitrate: float,
+        windows: int = SAMPLE_WINDOWS,
+        window_length: float = SAMPLE_SECONDS,
+        max_workers: int = 1,
+        progress_callback: Callable = None,
+        job: str = None,
+        **kwargs) -> int:
+    """
+    Returns the lowest `crf` whose video bitrate is predicted to stay under
+    the target, and at least the `crf` in `kwargs`. Choices are cached by
+    source, settings and target.
+
+    Args:
+        input_file (str): Path to video file to encode from.
+        target_bitrate (float): Maximum video bitrate in bits per second.
+        windows (int, optional): Number of windows to sample.
+        window_length (float, optional): Length of each window in seconds.
+        max_workers (int, optional): Number of samples to encode at the same
+            time. Defaults to 1.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg. See `progress`. Defaults to None.
+        job (str, optional): Job name for stage results, e.g. the output
+            file name.
+        **kwargs: Video settings, filters (`vf`) and trim (`ss`, `to`, `t`)
+            of the encode, as passed to `video.encode_webm`. Audio settings
+            are ignored.
+
+    Returns:
+        (int): Chosen `crf`.
+
+    Raises:
+        ffmpeg.Error: If a sample encode fails.
+    """
+    kwargs = {k: v for k, v in kwargs.items()
+              if k not in ('af', 'ac', 'ar', 'passlogfile')
+              and not k.endswith(':a')}
+    min_crf = int(kwargs.get('crf', video.VP9_SETTINGS['crf']))
+    key = cache.hash_key(
+        cache.file_identity(input_file), kwargs, target_bitrate,
+        windows, window_length)
+    cache_file = os.path.join(cache.cache_dir('crf'), key)
+    if os.path.isfile(cache_file):
+        cache.touch(cache_file)
+        with open(cache_file) as file:
+            return int(file.read())
+
+    ranges = sample_windows(
+        *trim_range(input_file, kwargs), windows, window_length)
+    common.extract_seek(kwargs)
+    job = job or os.path.basename(input_file)
+
+    with tempfile.TemporaryDirectory(prefix='amqencode-') as work_dir:
+        sampler = _Sampler(
+            input_file, ranges, work_dir, max_workers, progress_callback,
+            job, kwargs)
+        sampler.run_pass_1(min_crf)
+        samples = {min_crf: sampler.bitrate(min_crf)}
+        crf = min_crf
+        if samples[min_crf] > target_bitrate:
+            # Bracket the target, then refine once at the interpolated crf.
+            high = min(min_crf + 16, MAX_CRF)
+            samples[high] = sampler.bitrate(high)
+            crf = _clamp(_interpolate(samples, target_bitrate), min_crf)
+            if crf not in samples:
+                samples[crf] = sampler.bitrate(crf)
+                crf = _clamp(_interpolate(samples, target_bitrate), min_crf)
+            if crf == MAX_CRF:
+                _log.warning(
+                    "Warning: %s may not fit the target even at crf %d",
+                    job, MAX_CRF)
+
+    with open(cache_file, 'w') as file:
+        file.write(f"{crf}\n")
+    cache.evict_lru(cache.cache_dir('crf'), max_entries=10000)
+    return crf
+
+
+def _clamp(crf: int, min_crf: int) -> int:
+    """
+    Limits a predicted `crf` to the usable range.
+    """
+    return max(min(crf, MAX_CRF), min_crf)
+
+
+def _interpolate(samples: Dict[int, float], target_bitrate: float) -> int:
+    """
+    Returns the lowest integer `crf` predicted to stay under the target,
+    interpolating log bitrate linearly between the two sampled `crf` values
+    closest to it.
+
+    Args:
+        samples (dict of int: float): Bitrate sampled at each `crf`.
+        target_bitrate (float): Maximum bitrate.
+
+    Returns:
+        (int): Predicted `crf`.
+    """
+    points = sorted(samples.items())
+    fitting = [crf for crf, bitrate in points if bitrate <= target_bitrate]
+    if len(fitting) == 0:
+        # Even the highest sample is too big: extrapolate from the last two.
+        (crf_a, rate_a), (crf_b, rate_b) = points[-2:]
+    else:
+        i = next(i for i, (crf, _) in enumerate(points) if crf == fitting[0])
+        if i == 0:
+            return fitting[0]
+        (crf_a, rate_a), (crf_b, rate_b) = points[i - 1], points[i]
+    slope = (math.log(rate_b) - math.log(rate_a)) / (crf_b - crf_a)
+    if slope >= 0:
+        return crf_b if rate_b <= target_bitrate else MAX_CRF
+    return math.ceil(
+        crf_a + (math.log(target_bitrate) - math.log(rate_a)) / slope)
+
+
+class _Sampler:
+    """
+    Encodes the sampled windows of a source at a given `crf`, reusing one
+    set of pass 1 statistics per window.
+    """
+
+    def __init__(
+            self,
+            input_file: str,
+            ranges: List[Tuple[float, float]],
+            work_dir: str,
+            max_workers: int,
+            progress_callback: Callable,
+            job: str,
+            kwargs: Dict[str, any]):
+        self.input_file = input_file
+        self.ranges = ranges
+        self.work_dir = work_dir
+        self.max_workers = max_workers
+        self.progress_callback = progress_callback
+        self.job = job
+        self.kwargs = kwargs
+
+    def _compile(self, i: int, crf: int) -> List[List[str]]:
+        """
+        Returns the pass 1 and pass 2 commands for a window.
+        """
+        window_start, window_end = self.ranges[i]
+        return video.compile_webm(
+            self.input_file,
+            os.path.join(self.work_dir, f"sample-{i}-{crf}.webm"),
+            muted=True,
+            passlogfile=os.path.join(self.work_dir, f"sample-{i}"),
+            ss=f"{window_start:.6f}", to=f"{window_end:.6f}",
+            **dict(self.kwargs, crf=crf))
+
+    def _run(self, cmds: List[Tuple[List[str], str, int, str]]) -> list:
+        """
+        Runs commands in parallel and raises if any fails, with the log of
+        the first failed command as stderr.
+        """
+        runs = common.run_parallel([
+            partial(
+                progress.run_and_parse, cmd, list,
+                f"{self.job} [crf {crf} @ {self.ranges[i][0]:.0f}s]",
+                progress_callback=self.progress_callback,
+                stage='crf sample', output_file=output_file)
+            for cmd, output_file, i, crf in cmds], self.max_workers)
+        for result, lines in runs:
+            if result['returncode'] != 0:
+                raise ffmpeg.Error(
+                    'ffmpeg', None, ''.join(lines).encode('utf-8'))
+        return [result for result, _ in runs]
+
+    def run_pass_1(self, crf: int) -> None:
+        """
+        Analyzes every window.
+        """
+        self._run([
+            (self._compile(i, crf)[0], None, i, crf)
+            for i in range(len(self.ranges))])
+
+    def bitrate(self, crf: int) -> float:
+        """
+        Encodes every window at a `crf` and returns the combined bitrate.
+        """
+        results = self._run([
+            (self._compile(i, crf)[1],
+             os.path.join(self.work_dir, f"sample-{i}-{crf}.webm"), i, crf)
+            for i in range(len(self.ranges))])
+        size = sum(result['bytes'] or 0 for result in results)
+        seconds = sum(end - start for start, end in self.ranges)
+        return size * 8 * (1 - _CONTAINER_OVERHEAD) / seconds
@@ -0,0 +1,127 @@
+"""CPU resources
+
+Functions for sizing VP9 threading to the frame width and the machine, and a
+CPU budget that concurrent encodes reserve threads from so that the total
+thread count stays within the available cores.
+"""
+
+
+__all__ = [
+    'MIN_TILE_WIDTH',
+    'cpu_count',
+    'tune_vp9',
+    'CpuBudget',
+]
+
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+
+MIN_TILE_WIDTH = 256
+"""(int): Minimum width in pixels of a VP9 tile column."""
+
+
+def cpu_count() -> int:
+    """
+    Returns the number of CPU cores this process may run on.
+    Set the `AMQENCODE_CPU_BUDGET` environment variable to override it, e.g.
+    on shared hosts.
+
+    Returns:
+        (int): Number of usable cores.
+    """
+    if 'AMQENCODE_CPU_BUDGET' in os.environ:
+        return max(int(os.environ['AMQENCODE_CPU_BUDGET']), 1)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def tune_vp9(width: int, max_threads: int = None) -> Dict[str, int]:
+    """
+    Returns VP9 threading parameters suited to a frame width.
+    Uses as many tile columns as the width allows (up to 4, i.e.
+    `tile-columns` 2 for 720p and 1080p), and two threads per tile column
+    with row-based multithreading, capped at `max_threads`.
+
+    Args:
+        width (int): Output frame width in pixels.
+        max_threads (int, optional): Maximum number of threads to use.
+            Defaults to `cpu_count()`.
+
+    Returns:
+        (dict of str: int): Dictionary with keys `threads`, `tile-columns`
+            and `row-mt`.
+    """
+    if max_threads is None:
+        max_threads = cpu_count()
+    tile_columns = 0
+    while (tile_columns < 2 and
+           width >= MIN_TILE_WIDTH * 2 ** (tile_columns + 1)):
+        tile_columns += 1
+    return {
+        'threads': max(min(2 ** (tile_columns + 1), max_threads), 1),
+        'tile-columns': tile_columns,
+        'row-mt': 1}
+
+
+class CpuBudget:
+    """
+    A pool of CPU threads that concurrent encodes reserve from.
+    A reservation larger than the whole budget is capped to the budget, so
+    every job can eventually run.
+
+    Args:
+        total (int, optional): Number of threads in the budget.
+            Defaults to `cpu_count()`.
+    """
+
+    def __init__(self, total: int = None):
+        self.total = max(total or cpu_count(), 1)
+        self._available = self.total
+        self._condition = threading.Condition()
+
+    def acquire(self, threads: int) -> int:
+        """
+        Blocks until the requested number of threads is free, then takes them.
+
+        Args:
+            threads (int): Number of threads to reserve.
+
+        Returns:
+            (int): Number of threads actually reserved.
+        """
+        threads = min(max(threads, 1), self.total)
+        with self._condition:
+            while self._available < threads:
+                self._condition.wait()
+            self._available -= threads
+        return threads
+
+    def release(self, threads: int) -> None:
+        """
+        Returns threads taken by `acquire` to the budget.
+
+        Args:
+            threads (int): Number of threads returned by `acquire`.
+        """
+        with self._condition:
+            self._available += threads
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, threads: int):
+        """
+        Context manager that holds a reservation for its duration.
+
+        Args:
+            threads (int): Number of threads to reserve.
+        """
+        reserved = self.acquire(threads)
+        try:
+            yield reserved
+        finally:
+            self.release(reserved)
@@ -0,0 +1,336 @@
+"""Stage results and timing traces
+
+Every ffmpeg and ffprobe process is recorded as a stage result: a dict with
+keys `stage` (e.g. `probe`, `volumedetect`, `mp3`, `pass 1`, `pass 2`, `mux`),
+`job` (usually the output file name), `cmd`, `returncode`, `start` (epoch
+seconds), `wall` and `cpu` (seconds), `max_rss` (peak resident memory in
+bytes), `output`, `bytes` and `bitrate` (bits per second of output, or None).
+Outputs that an incremental encode leaves alone are recorded as `skip` results
+with an empty command, see `plan.run_plan`. `validate` results also have a key
+`errors` listing the checks that failed, see `validate.validate_output`.
+
+Results are passed to every `Recorder` that is active in the calling thread,
+and `common.run_parallel` carries the active recorders over to its worker
+threads. Recorders can be written out as Chrome trace-event JSON, viewable as
+a timeline in `chrome://tracing` or Perfetto.
+
+Cancellation events are carried over the same way, so that every ffmpeg
+process started on behalf of a job can be stopped, see `cancellation`.
+"""
+
+
+__all__ = [
+    'Recorder',
+    'recording',
+    'record',
+    'propagate',
+    'cancellation',
+    'cancel_events',
+    'wait',
+    'stage_result',
+    'failed',
+    'format_failure',
+    'write_chrome_trace',
+]
+
+
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple, Union
+
+
+_local = threading.local()
+
+
+class Recorder:
+    """
+    A thread-safe list of stage results.
+    """
+
+    def __init__(self):
+        self.results = []
+        self._lock = threading.Lock()
+
+    def add(self, result: Dict[str, any]) -> None:
+        """
+        Adds a stage result.
+
+        Args:
+            result (dict of str: any): Result from `stage_result`.
+        """
+        with self._lock:
+            self.results.append(result)
+
+    def write_chrome_trace(self, trace_file: str) -> None:
+        """
+        Writes the recorded results as Chrome trace-event JSON.
+        See `write_chrome_trace`.
+        """
+        with self._lock:
+            results = list(self.results)
+        write_chrome_trace(results, trace_file)
+
+
+def _active() -> List[Recorder]:
+    """
+    Returns the recorders active in the calling thread.
+    """
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+@contextmanager
+def recording(recorder: Recorder = None, isolated: bool = False):
+    """
+    Context manager that records the results of every stage run by the
+    calling thread (and jobs it runs through `common.run_parallel`) until it
+    exits. Recorders nest: outer recorders still receive every result.
+
+    Args:
+        recorder (Recorder, optional): Recorder to use. Defaults to a new one.
+        isolated (bool, optional): Whether to keep the results from outer
+            recorders, e.g. to pass them on later. Defaults to False.
+
+    Yields:
+        (Recorder): The active recorder.
+    """
+    recorder = recorder or Recorder()
+    outer = _active()
+    if isolated:
+        _local.recorders = []
+    _active().append(recorder)
+    try:
+        yield recorder
+    finally:
+        _active().remove(recorder)
+        if isolated:
+            _local.recorders = outer
+
+
+def record(result: Dict[str, any]) -> Dict[str, any]:
+    """
+    Passes a stage result to every recorder active in the calling thread.
+
+    Args:
+        result (dict of str: any): Result from `stage_result`.
+
+    Returns:
+        (dict of str: any): The same result.
+    """
+    for recorder in _active():
+        recorder.add(result)
+    return result
+
+
+def propagate(job: Callable[[], any]) -> Callable[[], any]:
+    """
+    Returns a callable that runs `job` with the recorders and cancellation
+    events active in the calling thread, for running it in another thread.
+
+    Args:
+        job (callable): Zero-argument callable.
+
+    Returns:
+        (callable): Wrapped callable.
+    """
+    recorders = list(_active())
+    events = cancel_events()
+
+    def run():
+        previous = getattr(_local, 'recorders', None)
+        previous_events = getattr(_local, 'events', None)
+        _local.recorders = list(recorders)
+        _local.events = list(events)
+        try:
+            return job()
+        finally:
+            _local.recorders = previous or []
+            _local.events = previous_events or []
+    return run
+
+
+@contextmanager
+def cancellation(event: threading.Event):
+    """
+    Context manager that stops the ffmpeg processes run by the calling
+    thread (and jobs it runs through `common.run_parallel`) once `event` is
+    set: running processes are killed and no new ones start. See
+    `progress.run_and_parse`.
+
+    Args:
+        event (threading.Event): Event that cancels the work.
+    """
+    if not hasattr(_local, 'events'):
+        _local.events = []
+    _local.events.append(event)
+    try:
+        yield event
+    finally:
+        _local.events.remove(event)
+
+
+def cancel_events() -> List[threading.Event]:
+    """
+    Returns the cancellation events active in the calling thread.
+
+    Returns:
+        (list of threading.Event): Events, see `cancellation`.
+    """
+    return list(getattr(_local, 'events', []))
+
+
+def wait(proc) -> Tuple[int, Union[float, None], Union[int, None]]:
+    """
+    Waits for a subprocess to exit and returns its own CPU time and peak
+    memory, from the child's rusage where the platform provides it.
+
+    Args:
+        proc (subprocess.Popen): Process to wait for.
+
+    Returns:
+        (tuple of int, float/None, int/None): Exit code, user+system CPU
+            seconds and peak resident set size in bytes, or None if
+            unavailable.
+    """
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None, None
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        return proc.wait(), None, None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    max_rss = rusage.ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    return proc.returncode, rusage.ru_utime + rusage.ru_stime, max_rss
+
+
+def stage_result(
+        stage: str,
+        job: str,
+        cmd: List[str],
+        returncode: int,
+        start: float,
+        wall: float,
+        cpu: float = None,
+        output_file: str = None,
+        duration: float = None,
+        max_rss: int = None,
+        errors: List[str] = None) -> Dict[str, any]:
+    """
+    Builds a stage result and passes it to the active recorders.
+
+    Args:
+        stage (str): Stage name.
+        job (str): Job name.
+        cmd (list of str): Command line that ran.
+        returncode (int): Exit code.
+        start (float): Start time in epoch seconds.
+        wall (float): Elapsed seconds.
+        cpu (float, optional): CPU seconds used by the process.
+        output_file (str, optional): File written by the stage.
+        duration (float, optional): Seconds of media written, to compute the
+            bitrate.
+        max_rss (int, optional): Peak resident memory of the process in
+            bytes.
+        errors (list of str, optional): Reasons the stage failed, added to
+            the result under `errors` if set.
+
+    Returns:
+        (dict of str: any): Stage result.
+    """
+    size = None
+    if output_file is not None and os.path.isfile(output_file):
+        size = os.path.getsize(output_file)
+    result = {
+        'stage': stage,
+        'job': job,
+        'cmd': list(cmd),
+        'returncode': returncode,
+        'start': start,
+        'wall': wall,
+        'cpu': cpu,
+        'max_rss': max_rss,
+        'output': output_file,
+        'bytes': size,
+        'bitrate': (size * 8 / duration
+                    if size is not None and duration else None)}
+    if errors is not None:
+        result['errors'] = errors
+    return record(result)
+
+
+def failed(results: List[Dict[str, any]]) -> List[Dict[str, any]]:
+    """
+    Returns the stage results with a nonzero exit code.
+
+    Args:
+        results (list of dict of str: any): Stage results.
+
+    Returns:
+        (list of dict of str: any): Failed stage results.
+    """
+    return [r for r in results if r['returncode'] != 0]
+
+
+def format_failure(result: Dict[str, any]) -> str:
+    """
+    Describes a failed stage result, with one indented line per error if it
+    has any.
+
+    Args:
+        result (dict of str: any): Failed stage result.
+
+    Returns:
+        (str): Description.
+    """
+    return '\n'.join(
+        [f"{result['stage']} {result['job']} exited with code "
+         f"{result['returncode']}"]
+        + [f"  {error}" for error in result.get('errors', [])])
+
+
+def write_chrome_trace(
+        results: List[Dict[str, any]],
+        trace_file: str) -> None:
+    """
+    Writes stage results as Chrome trace-event JSON. Each stage is a complete
+    event, laid out in lanes so that overlapping stages don't share a lane.
+
+    Args:
+        results (list of dict of str: any): Stage results.
+        trace_file (str): Path to output JSON file.
+    """
+    lanes = []
+    events = []
+    for result in sorted(results, key=lambda r: r['start']):
+        end = result['start'] + result['wall']
+        lane = next(
+            (i for i, lane_end in enumerate(lanes)
+             if lane_end <= result['start']), len(lanes))
+        if lane == len(lanes):
+            lanes.append(end)
+        lanes[lane] = end
+        events.append({
+            'name': f"{result['stage']} {result['job'] or ''}".strip(),
+            'cat': result['stage'],
+            'ph': 'X',
+            'ts': result['start'] * 1e6,
+            'dur': result['wall'] * 1e6,
+            'pid': 1,
+            'tid': lane,
+            'args': {k: v for k, v in result.items()
+                     if k not in ('stage', 'job', 'start', 'wall')}})
+    directory = os.path.dirname(trace_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(trace_file, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
@@ -0,0 +1,366 @@
+"""Output validation
+
+Cheap checks that encoded outputs are complete and match what was intended,
+without decoding them. Each output is probed for its container, streams and
+duration, and its index is checked against the file size: the Matroska
+segment size and Cues of a webm, or the Xing/Info frame of an mp3. A
+truncated or unfinalized file fails these even when ffprobe can still read
+its header. An optional deep check also decodes a few short samples.
+"""
+
+
+__all__ = [
+    'DURATION_TOLERANCE',
+    'SAMPLE_SECONDS',
+    'expected_outputs',
+    'validate_output',
+    'validate_outputs',
+    'validate_directory',
+]
+
+
+import os
+import time
+from os import devnull
+from typing import Dict, List, Union
+
+from . import common, lazy, probe, progress, trace
+
+ffmpeg = lazy.import_module('ffmpeg')
+
+
+DURATION_TOLERANCE = 0.25
+"""(float): Seconds an output's duration may differ from the intended one,
+to allow for codec delay and padding."""
+
+SAMPLE_SECONDS = 1
+"""(float): Length of each window decoded by the deep check."""
+
+_EBML_ID = b'\x1a\x45\xdf\xa3'
+_SEGMENT_ID = b'\x18\x53\x80\x67'
+_SEEK_HEAD_ID = b'\x11\x4d\x9b\x74'
+_SEEK_ID = b'\x4d\xbb'
+_SEEK_ID_ID = b'\x53\xab'
+_SEEK_POSITION_ID = b'\x53\xac'
+_CUES_ID = b'\x1c\x53\xbb\x6b'
+_VOID_ID = b'\xec'
+
+_CODECS = {
+    '.webm': {'video': 'vp9', 'audio': 'opus'},
+    '.mp3': {'video': None, 'audio': 'mp3'},
+}
+"""(dict of str: dict of str: str/None): Codecs of each output type."""
+
+
+def expected_outputs(
+        outputs: Dict[str, Union[dict, None]],
+        duration: float = None,
+        muted: bool = False) -> Dict[str, Dict[str, any]]:
+    """
+    Returns what each planned output should contain.
+
+    Args:
+        outputs (dict of str: dict/None): Outputs from
+            `encode.plan_outputs`.
+        duration (float, optional): Intended duration in seconds.
+        muted (bool, optional): Whether the webms have no audio.
+
+    Returns:
+        (dict of str: dict of str: any): Dictionary mapping each output file
+            to its expectations, with keys `width`, `height` (None for the
+            mp3), `duration` and `audio`.
+    """
+    expected = {}
+    for output_file, filters in outputs.items():
+        width = height = None
+        if filters is not None:
+            width, height = (
+                int(x) for x in filters['scale'].split('x'))
+        expected[output_file] = {
+            'width': width,
+            'height': height,
+            'duration': duration,
+            'audio': filters is None or not muted,
+        }
+    return expected
+
+
+def validate_output(
+        output_file: str,
+        expected: Dict[str, any] = None,
+        deep: bool = False) -> Dict[str, any]:
+    """
+    Checks a webm or mp3 output, and records a `validate` stage result that
+    failed if any check did, with the failed checks under `errors`. See
+    `trace`.
+
+    Args:
+        output_file (str): Path to output file.
+        expected (dict of str: any, optional): Expectations from
+            `expected_outputs`. Without them, only the container, codecs
+            and index are checked.
+        deep (bool, optional): Whether to also decode short windows at the
+            start, middle and end. Defaults to False.
+
+    Returns:
+        (dict of str: any): Dictionary with keys `output`, `ok` and
+            `errors` (list of str).
+    """
+    start_time = time.time()
+    start = time.monotonic()
+    expected = expected or {}
+    try:
+        errors = _check(output_file, expected)
+        if deep and len(errors) == 0:
+            errors = _decode_samples(output_file)
+    except (OSError, ffmpeg.Error) as error:
+        errors = [f"Can't read file: {error}"]
+    trace.stage_result(
+        'validate', os.path.basename(output_file), [],
+        0 if len(errors) == 0 else 1,
+        start_time, time.monotonic() - start, output_file=output_file,
+        errors=errors)
+    return {'output': output_file, 'ok': len(errors) == 0, 'errors': errors}
+
+
+def validate_outputs(
+        expected: Dict[str, Dict[str, any]],
+        max_workers: int = 1,
+        deep: bool = False) -> List[Dict[str, any]]:
+    """
+    Checks several outputs in parallel. See `validate_output`.
+
+    Args:
+        expected (dict of str: dict of str: any): Expectations by output
+            file, e.g. from `expected_outputs`.
+        max_workers (int, optional): Number of outputs to check at the same
+            time. Defaults to 1.
+        deep (bool, optional): Whether to decode samples. Defaults to False.
+
+    Returns:
+        (list of dict of str: any): Reports in the order of `expected`.
+    """
+    return common.run_parallel([
+        lambda output_file=output_file, output=output: validate_output(
+            output_file, output, deep)
+        for output_file, output in expected.items()], max_workers)
+
+
+def validate_directory(
+        output_dir: str,
+        max_workers: int = 1,
+        deep: bool = False) -> List[Dict[str, any]]:
+    """
+    Checks every webm and mp3 in a folder in parallel. See
+    `validate_output`.
+
+    Args:
+        output_dir (str): Folder to check.
+        max_workers (int, optional): Number of outputs to check at the same
+            time. Defaults to 1.
+        deep (bool, optional): Whether to decode samples. Defaults to False.
+
+    Returns:
+        (list of dict of str: any): Reports in file name order.
+    """
+    return validate_outputs({
+        os.path.join(output_dir, name): {}
+        for name in sorted(os.listdir(output_dir))
+        if name.endswith(tuple(_CODECS)) and not name.startswith('.')},
+        max_workers, deep)
+
+
+def _check(output_file: str, expected: Dict[str, any]) -> List[str]:
+    """
+    Returns the problems found by probing an output.
+    """
+    if os.path.getsize(output_file) == 0:
+        return ['File is empty']
+    extension = os.path.splitext(output_file)[1].lower()
+    codecs = _CODECS.get(extension)
+    if codecs is None:
+        return [f"Unknown output type {extension}"]
+
+    errors = (_check_matroska(output_file) if extension == '.webm'
+              else _check_mp3(output_file))
+    metadata = probe.probe(output_file, use_cache=False)
+    streams = {}
+    for stream in metadata['streams']:
+        streams.setdefault(stream.get('codec_type'), []).append(stream)
+
+    for codec_type in ('video', 'audio'):
+        wanted = codecs[codec_type]
+        if codec_type == 'audio' and not expected.get('audio', True):
+            wanted = None
+        found = [s.get('codec_name') for s in streams.get(codec_type, [])]
+        if wanted is None and len(found) != 0:
+            errors.append(f"Unexpected {codec_type} stream")
+        elif wanted is not None and found != [wanted]:
+            errors.append(
+                f"Expected one {wanted} {codec_type} stream, found "
+                f"{', '.join(found) or 'none'}")
+
+    video = streams.get('video', [{}])[0]
+    for key in ('width', 'height'):
+        if (expected.get(key) is not None and
+                video.get(key) != expected[key]):
+            errors.append(
+                f"Expected {key} {expected[key]}, found {video.get(key)}")
+
+    duration = metadata['format'].get('duration')
+    if duration in (None, 'N/A'):
+        errors.append('Duration is missing')
+    elif (expected.get('duration') is not None and
+            abs(float(duration) - expected['duration']) > DURATION_TOLERANCE):
+        errors.append(
+            f"Expected duration {expected['duration']:.3f}s, found "
+            f"{float(duration):.3f}s")
+    return errors
+
+
+def _check_matroska(output_file: str) -> List[str]:
+    """
+    Returns problems with the segment size and Cues of a webm. ffmpeg
+    writes both once the file is complete, so a truncated or interrupted
+    file fails.
+    """
+    size = os.path.getsize(output_file)
+    with open(output_file, 'rb') as file:
+        head = file.read(4096)
+        position = 0
+        element_id, data_size, position = _read_element(head, position)
+        if element_id != _EBML_ID:
+            return ['Not a Matroska file']
+        position += data_size
+        element_id, data_size, position = _read_element(head, position)
+        if element_id != _SEGMENT_ID:
+            return ['Segment is missing']
+        segment_start = position
+        if data_size is None:
+            return ['Segment size is unknown; file was not finalized']
+        if segment_start + data_size > size:
+            return [f"File is truncated: {size} of "
+                    f"{segment_start + data_size} bytes"]
+
+        element_id, data_size, position = _read_element(head, position)
+        while element_id == _VOID_ID:
+            element_id, data_size, position = _read_element(
+                head, position + data_size)
+        if element_id != _SEEK_HEAD_ID:
+            return ['SeekHead is missing']
+        cues = _seek_positions(
+            head[position:position + data_size]).get(_CUES_ID)
+        if cues is None:
+            return ['Cues are missing']
+        file.seek(segment_start + cues)
+        if file.read(4) != _CUES_ID:
+            return ['Cues are missing']
+    return []
+
+
+def _read_element(data: bytes, position: int) -> tuple:
+    """
+    Reads the ID and data size of the EBML element at a position.
+
+    Returns:
+        (tuple): ID bytes, data size (None if unknown), and the position of
+            the element's data.
+    """
+    id_length = _vint_length(data[position])
+    element_id = data[position:position + id_length]
+    position += id_length
+    size_length = _vint_length(data[position])
+    value = data[position] & (0xff >> size_length)
+    for byte in data[position + 1:position + size_length]:
+        value = (value << 8) | byte
+    if value == (1 << (7 * size_length)) - 1:
+        value = None
+    return element_id, value, position + size_length
+
+
+def _vint_length(first_byte: int) -> int:
+    """
+    Returns the length of an EBML variable-size integer from its first byte.
+    """
+    for length in range(1, 9):
+        if first_byte & (0x80 >> (length - 1)):
+            return length
+    raise ValueError('Invalid EBML data')
+
+
+def _seek_positions(data: bytes) -> Dict[bytes, int]:
+    """
+    Returns the segment positions listed in a SeekHead, by element ID.
+    """
+    positions = {}
+    position = 0
+    while position < len(data):
+        element_id, data_size, position = _read_element(data, position)
+        end = position + (data_size or 0)
+        if element_id == _SEEK_ID:
+            seek_id = seek_position = None
+            while position < end:
+                child_id, child_size, position = _read_element(
+                    data, position)
+                value = data[position:position + child_size]
+                if child_id == _SEEK_ID_ID:
+                    seek_id = value
+                elif child_id == _SEEK_POSITION_ID:
+                    seek_position = int.from_bytes(value, 'big')
+                position += child_size
+            if seek_id is not None and seek_position is not None:
+                positions[seek_id] = seek_position
+        position = end
+    return positions
+
+
+def _check_mp3(output_file: str) -> List[str]:
+    """
+    Returns problems with the Xing/Info frame of an mp3. It records the
+    stream's byte count once the file is complete, so a truncated file
+    fails.
+    """
+    size = os.path.getsize(output_file)
+    with open(output_file, 'rb') as file:
+        head = file.read(8192)
+    offset = 0
+    if head[:3] == b'ID3':
+        # ID3v2 sizes are syncsafe: 7 bits per byte.
+        offset = 10 + sum(
+            (head[6 + i] & 0x7f) << (7 * (3 - i)) for i in range(4))
+    position = max(head.find(b'Xing', offset), head.find(b'Info', offset))
+    if position < 0:
+        return ['Xing/Info frame is missing']
+    flags = int.from_bytes(head[position + 4:position + 8], 'big')
+    if not flags & 0x2:
+        return []
+    field = position + 8 + (4 if flags & 0x1 else 0)
+    stream_bytes = int.from_bytes(head[field:field + 4], 'big')
+    if offset + stream_bytes > size:
+        return [f"File is truncated: {size} of {offset + stream_bytes} "
+                "bytes"]
+    return []
+
+
+def _decode_samples(output_file: str) -> List[str]:
+    """
+    Decodes short windows at the start, middle and end of an output, and
+    returns an error for each window that fails.
+    """
+    duration = float(
+        probe.probe(output_file, use_cache=False)['format']['duration'])
+    starts = sorted({
+        0.0,
+        max(duration / 2 - SAMPLE_SECONDS / 2, 0),
+        max(duration - SAMPLE_SECONDS, 0)})
+    errors = []
+    for start in starts:
+        cmd = ffmpeg.output(
+            ffmpeg.input(output_file, ss=f"{start:.3f}", t=SAMPLE_SECONDS),
+            devnull, format='null'
+            ).global_args('-v', 'error', '-xerror').compile()
+        result = progress.run(
+            cmd, os.path.basename(output_file), stage='validate decode')
+        if result['returncode'] != 0:
+            errors.append(f"Decoding failed at {start:.3f}s")
+    return errors
@@ -7,21 +7,35 @@ an input video file's dimensions.
 
 __all__ = [
     'VP9_SETTINGS',
+    'DRAFT_VP9_SETTINGS',
     'RESOLUTIONS',
+    'PASSLOG_CACHE_BYTES',
     'probe_dimensions',
-    'encode_webm'
+    'dimensions_from_stream',
+    'probe_keyframes',
+    'plan_chunks',
+    'encode_webm',
+    'compile_webm',
+    'run_pass_1_cached',
+    'compile_webm_chunked',
+    'write_concat_list',
+    'encode_webm_split',
+    'compile_webm_split',
 ]
 
 
+import os
 from os import devnull
 
 from fractions import Fraction
-import subprocess
-from typing import Dict
+from functools import partial
+import shutil
+import tempfile
+from typing import Callable, Dict, List, Tuple, Union
 
-import ffmpeg
+from . import cache, common, lazy, probe, progress
 
-from . import common
+ffmpeg = lazy.import_module('ffmpeg')
 
 
 VP9_SETTINGS = {
@@ -40,6 +54,16 @@ VP9_SETTINGS = {
 }
 """(dict of str: str/int): Default VP9 parameters."""
 
+DRAFT_VP9_SETTINGS = {
+    'deadline': 'realtime',
+    'cpu-used': 8,
+}
+"""(dict of str: str/int): VP9 parameters overridden for single-pass
+draft encodes."""
+
+PASSLOG_CACHE_BYTES = 1 << 30
+"""(int): Maximum total size of the pass log cache in bytes."""
+
 RESOLUTIONS = [0, 360, 480, 720]
 """(list of int): Default set of resolutions to encode."""
 
@@ -51,6 +75,10 @@ INIT_VIDEO_FILTERS = {
 Includes SAR of 1:1.
 """
 
+_AUDIO_ENCODER_KEYS = ('c:a', 'b:a', 'ac', 'ar')
+"""(tuple of str): Audio encoding parameters, left out where audio is only
+stream copied."""
+
 
 def probe_dimensions(input_file: str) -> Dict[str, any]:
     """
@@ -66,7 +94,22 @@ def probe_dimensions(input_file: str) -> Dict[str, any]:
             Defaults to `sar` = 1 and `dar` = `width`/`height` if those aren't
             set in the file.
     """
-    metadata = ffmpeg.probe(input_file, select_streams='v')['streams'][0]
+    return dimensions_from_stream(
+        probe.first_stream(probe.probe(input_file), 'video'))
+
+
+def dimensions_from_stream(metadata: Dict[str, any]) -> Dict[str, any]:
+    """
+    Returns a dict of dimensional info from probed video stream info.
+    See `probe_dimensions`.
+
+    Args:
+        metadata (dict of str: any): Video stream info from `probe.probe`.
+
+    Returns:
+        (dict of str: int/Fraction): Dictionary with keys `width`, `height`,
+            `sar`, and `dar`.
+    """
     return {
         'width': int(metadata['width']),
         'height': int(metadata['height']),
@@ -80,11 +123,78 @@ def probe_dimensions(input_file: str) -> Dict[str, any]:
         }
 
 
+def probe_keyframes(input_file: str) -> Dict[str, any]:
+    """
+    Returns the keyframe timestamps, duration and frame rate of the first
+    video stream of the input file, from its cached keyframe index.
+    See `probe.keyframe_index`.
+
+    Args:
+        input_file (str): Path to video file to probe.
+
+    Returns:
+        (dict of str: list/float/Fraction):
+            Dictionary with keys `keyframes` (sorted list of keyframe
+            timestamps in seconds), `duration` (seconds) and `fps`.
+
+    Raises:
+        ValueError: If there is no video stream.
+    """
+    index = probe.keyframe_index(input_file)
+    if index is None:
+        raise ValueError(f"No video stream found in {input_file}")
+    return {
+        'keyframes': index['keyframes'],
+        'duration': index['duration'],
+        'fps': Fraction(index['frame_rate'])
+        }
+
+
+def plan_chunks(
+        keyframes: List[float],
+        start: float,
+        end: float,
+        chunks: int,
+        min_duration: float = 0) -> List[Tuple[float, float]]:
+    """
+    Splits a time range into roughly equal chunks whose boundaries fall on
+    source keyframes, so that each chunk can be seeked to and encoded
+    independently.
+
+    Args:
+        keyframes (list of float): Sorted keyframe timestamps in seconds.
+        start (float): Start of the range to split, in seconds.
+        end (float): End of the range to split, in seconds.
+        chunks (int): Desired number of chunks.
+            Fewer are returned if there aren't enough usable keyframes.
+        min_duration (float, optional): Minimum length of a chunk in seconds.
+            Use this to keep chunks at least one GOP long.
+
+    Returns:
+        (list of tuple of float): List of `(start, end)` ranges in seconds.
+    """
+    spacing = max((end - start) / max(chunks, 1), min_duration)
+    boundaries = [start]
+    for keyframe in keyframes:
+        if (keyframe - boundaries[-1] >= spacing and
+                end - keyframe >= min_duration and
+                len(boundaries) < chunks):
+            boundaries.append(keyframe)
+    boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
 def encode_webm(
         input_file: str,
         output_file: str,
         muted: bool = False,
-        **kwargs) -> None:
+        chunks: int = 1,
+        chunk_workers: int = None,
+        passlog_cache: bool = False,
+        passes: int = 2,
+        progress_callback: Callable = None,
+        job: str = None,
+        **kwargs) -> List[Dict[str, any]]:
     """
     Encodes a webm from the supplied input file. Uses 2-pass VP9 encoding.
 
@@ -100,9 +210,165 @@ def encode_webm(
             String or dictionary of video filters to apply.
         af (str or dict of str: str/None):
             String or dictionary of audio filters to apply.
+        passlogfile (str):
+            Prefix for the 2-pass log files. Defaults to a file in a private
+            temporary directory, so that concurrent encodes in the same
+            working directory don't overwrite each other's logs.
+        chunks (int, optional): Number of segments to split the video into.
+            Segments start on source keyframes, are at least one GOP (`g`)
+            long, and are encoded independently then concatenated.
+            Audio is encoded once for the whole output. Defaults to 1.
+        chunk_workers (int, optional): Number of segments to encode at the
+            same time. Defaults to `chunks`.
+        passlog_cache (bool, optional): Whether to reuse pass 1 statistics
+            from the pass log cache. Pass 1 only depends on the source, trim,
+            video filters and video settings, so changes to audio filters or
+            the output path go straight to pass 2. Defaults to False.
+        passes (int, optional): 2, or 1 for a single-pass encode, e.g. with
+            `DRAFT_VP9_SETTINGS`. Single-pass encodes ignore `chunks` and
+            `passlog_cache`. Defaults to 2.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg. See `progress`. Defaults to None.
+        job (str, optional): Job name for progress reports and stage results.
+            Defaults to the output file name.
+
+    Returns:
+        (list of dict of str: any): Stage results of the ffmpeg processes
+            that ran, see `trace`. Pass 1 is left out when restored from the
+            pass log cache.
     """
 
     common.ensure_dir(output_file)
+    job = job or os.path.basename(output_file)
+
+    if passes == 1:
+        cmd, = compile_webm(
+            input_file, output_file, muted, passes=1, **kwargs)
+        return [progress.run(
+            cmd, job, progress_callback=progress_callback,
+            stage='draft', output_file=output_file)]
+
+    if chunks > 1:
+        return _encode_webm_chunked(
+            input_file, output_file, muted,
+            chunks, chunk_workers or chunks, passlog_cache,
+            progress_callback, job, **kwargs)
+
+    if 'passlogfile' not in kwargs:
+        with tempfile.TemporaryDirectory(prefix='amqencode-') as log_dir:
+            return encode_webm(
+                input_file, output_file, muted=muted,
+                passlog_cache=passlog_cache,
+                progress_callback=progress_callback, job=job,
+                passlogfile=os.path.join(log_dir, 'ffmpeg2pass'),
+                **kwargs)
+
+    return _run_passes(
+        input_file, compile_webm(input_file, output_file, muted, **kwargs),
+        kwargs['passlogfile'], output_file, passlog_cache,
+        progress_callback, job)
+
+
+def _run_passes(
+        input_file: str,
+        cmds: List[List[str]],
+        passlogfile: str,
+        output_file: str,
+        passlog_cache: bool,
+        progress_callback: Callable,
+        job: str) -> List[Dict[str, any]]:
+    """
+    Runs the pass 1 and pass 2 commands of a webm, restoring pass 1 from the
+    pass log cache if requested. See `encode_webm`.
+    """
+    pass_1_cmd, pass_2_cmd = cmds
+    run_pass_1 = partial(
+        progress.run, job=job, pass_number=1,
+        progress_callback=progress_callback, stage='pass 1')
+    if passlog_cache:
+        results = run_pass_1_cached(
+            input_file, pass_1_cmd, passlogfile, run_pass_1)
+    else:
+        results = [run_pass_1(pass_1_cmd)]
+    results.append(progress.run(
+        pass_2_cmd, job, 2, progress_callback,
+        stage='pass 2', output_file=output_file))
+    return results
+
+
+def run_pass_1_cached(
+        input_file: str,
+        cmd: List[str],
+        passlogfile: str,
+        run: Callable[[List[str]], Dict[str, any]] = progress.run
+        ) -> List[Dict[str, any]]:
+    """
+    Restores pass 1 logs from the pass log cache, or runs pass 1 and stores
+    its logs in the cache. Entries are keyed by the source file identity and
+    the pass 1 command without its log location, and are evicted least
+    recently used first once the cache exceeds `PASSLOG_CACHE_BYTES`.
+
+    Args:
+        input_file (str): Path to video file being encoded.
+        cmd (list of str): Compiled pass 1 command.
+        passlogfile (str): Prefix for the pass log files used by `cmd`.
+        run (callable, optional): Runs a command and returns its stage
+            result. Defaults to `progress.run`.
+
+    Returns:
+        (list of dict of str: any): Stage result of pass 1, or an empty list
+            if it was restored from the cache.
+    """
+    i = cmd.index('-passlogfile')
+    key = cache.hash_key(
+        cache.file_identity(input_file), cmd[:i] + cmd[i+2:])
+    directory = cache.cache_dir('passlog')
+    entry = os.path.join(directory, key)
+
+    if os.path.isdir(entry) and len(os.listdir(entry)) != 0:
+        for name in os.listdir(entry):
+            shutil.copyfile(
+                os.path.join(entry, name),
+                passlogfile + name[len('pass'):])
+        cache.touch(entry)
+        return []
+
+    result = run(cmd)
+    log_dir, prefix = os.path.split(passlogfile)
+    logs = [name for name in os.listdir(log_dir or '.')
+            if name.startswith(prefix + '-')]
+    if result['returncode'] != 0 or len(logs) == 0:
+        return [result]
+
+    temp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=directory)
+    for name in logs:
+        shutil.copyfile(
+            os.path.join(log_dir, name),
+            os.path.join(temp_entry, 'pass' + name[len(prefix):]))
+    try:
+        os.rename(temp_entry, entry)
+    except OSError:
+        shutil.rmtree(temp_entry, ignore_errors=True)
+    cache.evict_lru(directory, max_bytes=PASSLOG_CACHE_BYTES)
+    return [result]
+
+
+def compile_webm(
+        input_file: str,
+        output_file: str,
+        muted: bool = False,
+        passes: int = 2,
+        **kwargs) -> List[List[str]]:
+    """
+    Returns the ffmpeg commands for a 2-pass VP9 encode without running them.
+    See `encode_webm` for arguments.
+    If `passlogfile` isn't supplied, the commands use ffmpeg's default pass log
+    location.
+
+    Returns:
+        (list of list of str): Pass 1 and pass 2 command lines, or the single
+            command line if `passes` is 1.
+    """
 
     input_stream = ffmpeg.input(input_file)
     audio_stream = common.apply_filters(
@@ -114,6 +380,14 @@ def encode_webm(
 
     seek = common.extract_seek(kwargs)
     output_stream = [video_stream]
+    if passes == 1:
+        kwargs.pop('passlogfile', None)
+        if not muted:
+            output_stream.append(audio_stream)
+        cmd = ffmpeg.output(
+            *output_stream, output_file, format='webm', **kwargs).compile()
+        cmd[1:1] = seek
+        return [cmd]
     pass_1_cmd = ffmpeg.output(
         *output_stream,
         devnull, format='null',
@@ -127,6 +401,303 @@ def encode_webm(
     if len(seek) != 0:
         pass_1_cmd[1:1] = seek
         pass_2_cmd[1:1] = seek
+    return [pass_1_cmd, pass_2_cmd]
 
-    subprocess.run(pass_1_cmd, check=False)
-    subprocess.run(pass_2_cmd, check=False)
+
+def _encode_webm_chunked(
+        input_file: str,
+        output_file: str,
+        muted: bool,
+        chunks: int,
+        max_workers: int,
+        passlog_cache: bool,
+        progress_callback: Callable = None,
+        job: str = None,
+        **kwargs) -> List[Dict[str, any]]:
+    """
+    Encodes a webm by splitting the video into keyframe-aligned segments,
+    encoding them in parallel, and concatenating the results without
+    re-encoding. See `encode_webm` for arguments.
+    """
+
+    job = job or os.path.basename(output_file)
+    with tempfile.TemporaryDirectory(prefix='amqencode-') as work_dir:
+        planned = compile_webm_chunked(
+            input_file, output_file, work_dir, muted, chunks, **kwargs)
+        jobs = [
+            partial(
+                _run_passes,
+                input_file, chunk['cmds'], chunk['passlogfile'],
+                chunk['output'], passlog_cache, progress_callback,
+                f"{job} [{i + 1}/{len(planned['chunks'])}]")
+            for i, chunk in enumerate(planned['chunks'])]
+        if planned['audio'] is not None:
+            jobs.append(partial(
+                progress.run,
+                planned['audio']['cmd'], f"{job} [audio]",
+                progress_callback=progress_callback, stage='opus',
+                output_file=planned['audio']['output']))
+        results = [
+            result for job_results in common.run_parallel(jobs, max_workers)
+            for result in (job_results if isinstance(job_results, list)
+                           else [job_results])]
+
+        write_concat_list(
+            planned['list'], [chunk['output'] for chunk in planned['chunks']])
+        results.append(progress.run(
+            planned['concat'], job, progress_callback=progress_callback,
+            stage='concat', output_file=output_file))
+    return results
+
+
+def compile_webm_chunked(
+        input_file: str,
+        output_file: str,
+        work_dir: str,
+        muted: bool = False,
+        chunks: int = 2,
+        timing: Dict[str, any] = None,
+        **kwargs) -> Dict[str, any]:
+    """
+    Returns the ffmpeg commands of a chunked 2-pass encode without running
+    them. Chunk boundaries are planned with the source's keyframe index, see
+    `plan_chunks`. See `encode_webm` for arguments.
+
+    Args:
+        work_dir (str): Folder for the chunks, their pass logs, the audio
+            track and the concat list.
+        timing (dict of str: any, optional): Keyframes, duration and frame
+            rate to plan with, as returned by `probe_keyframes`, e.g. for an
+            input that hasn't been written yet. Defaults to probing the
+            input file.
+
+    Returns:
+        (dict of str: any): Dictionary with keys `chunks` (list of dicts
+            with keys `output`, `passlogfile` and `cmds`, the pass 1 and pass
+            2 command lines of each chunk), `audio` (dict with keys `output`
+            and `cmd` for the audio track, or None if muted), `list` (path of
+            the concat list to write with `write_concat_list`) and `concat`
+            (command line that joins the chunks and the audio track).
+    """
+
+    timing = timing or probe_keyframes(input_file)
+    start = common.parse_timestamp(kwargs.get('ss', 0))
+    if 't' in kwargs:
+        end = start + common.parse_timestamp(kwargs['t'])
+    elif 'to' in kwargs:
+        end = common.parse_timestamp(kwargs['to'])
+    else:
+        end = timing['duration']
+    end = min(end, timing['duration'])
+    min_duration = 0
+    if timing['fps'] > 0:
+        min_duration = float(kwargs.get('g', VP9_SETTINGS['g']) / timing['fps'])
+    ranges = plan_chunks(
+        timing['keyframes'], start, end, chunks, min_duration)
+
+    audio_filters = kwargs.pop('af', {})
+    audio_kwargs = {k: v for k, v in kwargs.items()
+                    if k not in VP9_SETTINGS
+                    and k not in ('vf', 'passlogfile')}
+    video_kwargs = {k: v for k, v in kwargs.items()
+                    if k not in ('ss', 'to', 't', 'passlogfile')}
+
+    planned_chunks = []
+    for i, (chunk_start, chunk_end) in enumerate(ranges):
+        chunk_file = os.path.join(work_dir, f"chunk-{i:04d}.webm")
+        passlogfile = os.path.join(work_dir, f"chunk-{i:04d}")
+        planned_chunks.append({
+            'output': chunk_file,
+            'passlogfile': passlogfile,
+            'cmds': compile_webm(
+                input_file, chunk_file, muted=True,
+                passlogfile=passlogfile,
+                ss=f"{chunk_start:.6f}", to=f"{chunk_end:.6f}",
+                **video_kwargs),
+        })
+
+    audio_track = None
+    list_file = os.path.join(work_dir, 'concat.txt')
+    output_stream = [ffmpeg.input(
+        list_file, format='concat', safe=0).video]
+    if not muted:
+        audio_file = os.path.join(work_dir, 'audio.webm')
+        audio_track = {
+            'output': audio_file,
+            'cmd': _compile_audio_track(
+                input_file, audio_file, af=audio_filters, **audio_kwargs),
+        }
+        output_stream.append(ffmpeg.input(audio_file).audio)
+    return {
+        'chunks': planned_chunks,
+        'audio': audio_track,
+        'list': list_file,
+        'concat': ffmpeg.output(
+            *output_stream, output_file,
+            format='webm', c='copy', **common.MAP_SETTINGS).compile(),
+    }
+
+
+def write_concat_list(list_file: str, input_files: List[str]) -> None:
+    """
+    Writes a list of files for ffmpeg's concat demuxer.
+
+    Args:
+        list_file (str): Path to list file.
+        input_files (list of str): Paths of the files to join, in order.
+    """
+    with open(list_file, 'w') as file:
+        for input_file in input_files:
+            file.write(f"file '{input_file}'\n")
+
+
+def _compile_audio_track(
+        input_file: str,
+        output_file: str,
+        **kwargs) -> List[str]:
+    """
+    Returns the ffmpeg command that encodes only the audio of the input file
+    into an audio-only webm.
+
+    Args:
+        input_file (str): Path to media file to encode from.
+        output_file (str): Path to output encoded file.
+        **kwargs: Native ffmpeg parameters to pass, including seeking.
+
+    Keyword Args:
+        af (str or dict of str: str/None):
+            String or dictionary of audio filters to apply.
+
+    Returns:
+        (list of str): Command line.
+    """
+    audio_stream = common.apply_filters(
+        ffmpeg.input(input_file).audio,
+        common.parse_filter_string(kwargs.pop('af', {})))
+    seek = common.extract_seek(kwargs)
+    cmd = ffmpeg.output(
+        audio_stream, output_file,
+        format='webm', vn=None, **kwargs).compile()
+    if len(seek) != 0:
+        cmd[1:1] = seek
+    return cmd
+
+
+def encode_webm_split(
+        input_file: str,
+        outputs: Dict[str, Union[str, dict]],
+        muted: bool = False,
+        progress_callback: Callable = None,
+        **kwargs) -> List[Dict[str, any]]:
+    """
+    Encodes several webms from the supplied input file using 2-pass VP9,
+    decoding the source only once per pass.
+    The decoded video is split into one filter chain per output, and each pass
+    writes all of its outputs from a single ffmpeg process.
+
+    Args:
+        input_file (str): Path to video file to encode from.
+        outputs (dict of str: str or dict):
+            Dictionary mapping each output file path to the string or
+            dictionary of video filters to apply for that output,
+            e.g. its `scale`.
+        muted (bool): Whether to leave audio out of the outputs.
+        progress_callback (callable, optional): Called with progress reports
+            from ffmpeg, with the output file names joined by `+` as the
+            job. See `progress`. Defaults to None.
+        **kwargs: Arbitrary keyword arguments. Includes arguments specific to
+            this package, as well as any native ffmpeg parameters you wish to
+            pass. These are applied to every output.
+
+    Keyword Args:
+        af (str or dict of str: str/None):
+            String or dictionary of audio filters to apply.
+        settings (dict of str: dict of str: any):
+            VP9 settings of each output, by output file path, applied over
+            `kwargs`, e.g. its `crf` or `threads`.
+
+    Returns:
+        (list of dict of str: any): Stage results of both passes, see
+            `trace`.
+    """
+
+    if len(outputs) == 0:
+        return []
+    for output_file in outputs:
+        common.ensure_dir(output_file)
+    kwargs.pop('passlogfile', None)
+
+    with tempfile.TemporaryDirectory(prefix='amqencode-') as log_dir:
+        pass_1_cmd, pass_2_cmd = compile_webm_split(
+            input_file, outputs, muted,
+            passlogfile=os.path.join(log_dir, 'ffmpeg2pass'), **kwargs)
+        job = '+'.join(os.path.basename(f) for f in outputs)
+        return [
+            progress.run(
+                pass_1_cmd, job, 1, progress_callback, stage='pass 1'),
+            progress.run(
+                pass_2_cmd, job, 2, progress_callback, stage='pass 2',
+                outputs=list(outputs))]
+
+
+def compile_webm_split(
+        input_file: str,
+        outputs: Dict[str, Union[str, dict]],
+        muted: bool = False,
+        **kwargs) -> List[List[str]]:
+    """
+    Returns the pass 1 and pass 2 commands of a split encode without running
+    them. See `encode_webm_split` for arguments. Output `i` writes its pass
+    log to `{passlogfile}-{i}`; `passlogfile` defaults to ffmpeg's default
+    pass log name.
+
+    Returns:
+        (list of list of str): Pass 1 and pass 2 command lines.
+    """
+
+    settings = kwargs.pop('settings', None) or {}
+    input_stream = ffmpeg.input(input_file)
+    video_split = input_stream.video.filter_multi_output('split', len(outputs))
+    audio_split = common.apply_filters(
+        input_stream.audio,
+        common.parse_filter_string(kwargs.pop('af', {}))
+        ).filter_multi_output('asplit', len(outputs))
+    kwargs.pop('vf', None)
+    passlogfile = kwargs.pop('passlogfile', 'ffmpeg2pass')
+    seek = common.extract_seek(kwargs)
+
+    pass_1_outputs = []
+    pass_2_outputs = []
+    for i, (output_file, filters) in enumerate(outputs.items()):
+        video_stream = common.apply_filters(
+            video_split[i],
+            common.parse_filter_string(filters))
+        output_args = dict(
+            kwargs, passlogfile=f"{passlogfile}-{i}",
+            **settings.get(output_file, {}))
+        output_stream = [video_stream]
+        pass_1_stream = [video_stream]
+        if not muted:
+            output_stream.append(audio_split[i])
+            # ffmpeg names pass logs after the global output stream index,
+            # so pass 1 must map as many streams as pass 2. Copying the
+            # source audio to the null muxer keeps the count without
+            # decoding or filtering it.
+            pass_1_stream.append(input_stream.audio)
+        pass_1_args = {k: v for k, v in output_args.items()
+                       if k not in _AUDIO_ENCODER_KEYS}
+        pass_1_outputs.append(ffmpeg.output(
+            *pass_1_stream,
+            devnull, format='null',
+            **dict(pass_1_args, **{'pass': 1, 'c:a': 'copy'})))
+        pass_2_outputs.append(ffmpeg.output(
+            *output_stream,
+            output_file, format='webm',
+            **dict({'pass': 2}, **output_args)))
+
+    pass_1_cmd = ffmpeg.merge_outputs(*pass_1_outputs).compile()
+    pass_2_cmd = ffmpeg.merge_outputs(*pass_2_outputs).compile()
+    if len(seek) != 0:
+        pass_1_cmd[1:1] = seek
+        pass_2_cmd[1:1] = seek
+    return [pass_1_cmd, pass_2_cmd]
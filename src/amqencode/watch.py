@@ -0,0 +1,387 @@
+"""Watch folders
+
+Runs as a daemon that encodes every source video dropped into a folder.
+A drop is a video plus, optionally, clean audio with the same name (`.wav` or
+`.flac`) and a JSON sidecar with the same name holding manifest entry keys,
+e.g. `{"ss": "1:39", "to": "3:09", "norm": true}`. See `batch.load_manifest`.
+
+Drops are picked up once their files have stopped growing, and run through
+`batch.run_entry` on a bounded worker pool. Drops beyond the pool's capacity
+wait in the folder, so a burst of drops never starts more than `max_jobs`
+encodes at once. Finished drops are moved into `done/`, failed drops into
+`failed/`.
+
+The folder is watched with inotify on Linux, and polled elsewhere.
+"""
+
+
+__all__ = [
+    'VIDEO_EXTENSIONS',
+    'AUDIO_EXTENSIONS',
+    'find_drops',
+    'watch',
+]
+
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Union
+
+from . import batch, resources, trace
+
+
+_log = logging.getLogger(__name__)
+
+
+VIDEO_EXTENSIONS = (
+    '.mkv', '.mp4', '.m4v', '.mov', '.avi', '.webm', '.ts', '.m2ts',
+    '.mpg', '.wmv', '.flv')
+"""(tuple of str): Extensions of source videos."""
+
+AUDIO_EXTENSIONS = ('.wav', '.flac')
+"""(tuple of str): Extensions of clean audio files."""
+
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+
+
+def find_drops(watch_dir: str) -> Dict[str, Dict[str, str]]:
+    """
+    Groups the files in a folder into drops by name.
+    Hidden files and subfolders are ignored.
+
+    Args:
+        watch_dir (str): Folder to look in.
+
+    Returns:
+        (dict of str: dict of str: str): Dictionary mapping each name that
+            has a source video to a dictionary with key `video`, and
+            `audio` and `sidecar` if present, holding file paths.
+    """
+    files = {}
+    for name in sorted(os.listdir(watch_dir)):
+        path = os.path.join(watch_dir, name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+        stem, extension = os.path.splitext(name)
+        extension = extension.lower()
+        if extension in VIDEO_EXTENSIONS:
+            files.setdefault(stem, {}).setdefault('video', path)
+        elif extension in AUDIO_EXTENSIONS:
+            files.setdefault(stem, {}).setdefault('audio', path)
+        elif extension == '.json':
+            files.setdefault(stem, {})['sidecar'] = path
+    return {stem: drop for stem, drop in files.items() if 'video' in drop}
+
+
+def watch(
+        watch_dir: str,
+        output_dir: str = None,
+        max_jobs: int = 1,
+        max_workers: int = 1,
+        cpu_budget: int = None,
+        settle: float = 5,
+        poll_interval: float = 2,
+        require_audio: bool = False,
+        progress_callback: Callable = None,
+        stop: threading.Event = None) -> None:
+    """
+    Encodes drops from a folder until stopped. Each drop is encoded into
+    `output_dir/NAME/source`, and muxed with its clean audio into
+    `output_dir/NAME/clean` if it has any.
+
+    Args:
+        watch_dir (str): Folder to watch.
+        output_dir (str, optional): Folder to write outputs to.
+            Defaults to `encoded/` in the watched folder.
+        max_jobs (int, optional): Maximum number of drops encoding at the
+            same time. Further drops wait in the folder. Defaults to 1.
+        max_workers (int, optional): Default `max_workers` for each drop's
+            `encode_all` call. Defaults to 1.
+        cpu_budget (int, optional): Number of CPU threads shared by every
+            encode. See `encode_all`. Use 0 for all cores. Defaults to None.
+        settle (float, optional): Seconds a drop's files must go without
+            changing before it is picked up. Defaults to 5.
+        poll_interval (float, optional): Seconds between scans of the folder
+            when no change is reported. Defaults to 2.
+        require_audio (bool, optional): Whether to wait for clean audio
+            before picking up a video. A sidecar naming a `clean_audio` file
+            always waits for it. Defaults to False.
+        progress_callback (callable, optional): Called with progress reports
+            from every ffmpeg process. See `progress`. Defaults to None.
+        stop (threading.Event, optional): Event that ends the watch once
+            set. Running encodes are finished first. Defaults to None, which
+            watches until interrupted.
+    """
+    watch_dir = os.path.abspath(watch_dir)
+    output_dir = os.path.abspath(
+        output_dir or os.path.join(watch_dir, 'encoded'))
+    stop = stop or threading.Event()
+    defaults = {'max_workers': max_workers}
+    if cpu_budget is not None:
+        defaults['cpu_budget'] = resources.CpuBudget(cpu_budget or None)
+    if progress_callback is not None:
+        defaults['progress_callback'] = progress_callback
+
+    try:
+        notifier = _Inotify(watch_dir)
+    except (AttributeError, OSError, TypeError):
+        notifier = None
+    sizes = {}
+    running = {}
+    abandoned = set()
+    _log.info("Watching %s%s", watch_dir,
+              ' (polling)' if notifier is None else '')
+    with ThreadPoolExecutor(max_workers=max(max_jobs, 1)) as executor:
+        try:
+            while not stop.is_set():
+                for stem, (future, drop) in list(running.items()):
+                    if future.done():
+                        del running[stem]
+                        for path in drop.values():
+                            sizes.pop(path, None)
+                        try:
+                            future.result()
+                        except Exception:
+                            # E.g. the drop's files vanished mid-encode:
+                            # fail this drop, but keep watching.
+                            _log.exception("[FAILED] %s", drop['video'])
+                            _fail_drop(stem, drop, watch_dir, abandoned)
+                now = time.monotonic()
+                waiting = False
+                for stem, drop in find_drops(watch_dir).items():
+                    if stem in running or stem in abandoned:
+                        continue
+                    if len(running) >= max(max_jobs, 1):
+                        break
+                    try:
+                        entry = _ready_entry(
+                            stem, drop, watch_dir, output_dir, sizes, now,
+                            settle, require_audio)
+                    except ValueError as error:
+                        _log.error("[FAILED] %s\n%s", drop['video'], error)
+                        _fail_drop(stem, drop, watch_dir, abandoned)
+                        continue
+                    if entry is None:
+                        waiting = True
+                        continue
+                    running[stem] = (executor.submit(trace.propagate(partial(
+                        _run_drop, dict(defaults, **entry), drop, watch_dir))),
+                        drop)
+                timeout = min(poll_interval, settle) if waiting else (
+                    poll_interval)
+                if notifier is not None:
+                    notifier.wait(timeout)
+                else:
+                    stop.wait(timeout)
+        finally:
+            stop.set()
+            if notifier is not None:
+                notifier.close()
+
+
+def _ready_entry(
+        stem: str,
+        drop: Dict[str, str],
+        watch_dir: str,
+        output_dir: str,
+        sizes: Dict[str, tuple],
+        now: float,
+        settle: float,
+        require_audio: bool) -> Union[Dict[str, any], None]:
+    """
+    Returns the manifest entry for a drop if all of its files have settled,
+    or None if it isn't ready yet.
+
+    Args:
+        stem (str): Name of the drop.
+        drop (dict of str: str): Drop from `find_drops`.
+        watch_dir (str): Watched folder.
+        output_dir (str): Folder to write outputs to.
+        sizes (dict of str: tuple): Last seen size and modification time
+            of each file, with the time they were first seen. Updated in
+            place.
+        now (float): Current monotonic time.
+        settle (float): Seconds files must go without changing.
+        require_audio (bool): Whether to wait for clean audio.
+
+    Returns:
+        (dict of str: any): Normalized manifest entry, or None.
+
+    Raises:
+        ValueError: If the sidecar can't be read or parsed.
+    """
+    if not all(_settled(path, sizes, now, settle) for path in drop.values()):
+        return None
+    entry = {}
+    if 'sidecar' in drop:
+        try:
+            with open(drop['sidecar']) as file:
+                entry = json.load(file)
+        except (OSError, ValueError) as error:
+            raise ValueError(
+                f"Invalid sidecar {drop['sidecar']}: {error}") from error
+    entry['input'] = drop['video']
+    if 'clean_audio' not in entry and 'audio' in drop:
+        entry['clean_audio'] = drop['audio']
+    if 'clean_audio' in entry:
+        audio_file = os.path.join(watch_dir, entry['clean_audio'])
+        if not _settled(audio_file, sizes, now, settle):
+            return None
+        drop['audio'] = audio_file
+    elif require_audio:
+        return None
+    entry.setdefault('output_dir', os.path.join(output_dir, stem, 'source'))
+    entry.setdefault('clean_dir', os.path.join(output_dir, stem, 'clean'))
+    return batch.normalize_entry(entry, watch_dir)
+
+
+def _settled(
+        path: str,
+        sizes: Dict[str, tuple],
+        now: float,
+        settle: float) -> bool:
+    """
+    Returns whether a file exists, isn't empty and hasn't changed for
+    `settle` seconds. See `_ready_entry`.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        sizes.pop(path, None)
+        return False
+    state = (stat.st_size, stat.st_mtime)
+    if path not in sizes or sizes[path][0] != state:
+        sizes[path] = (state, now)
+        return False
+    return stat.st_size > 0 and now - sizes[path][1] >= settle
+
+
+def _run_drop(
+        entry: Dict[str, any],
+        drop: Dict[str, str],
+        watch_dir: str) -> Dict[str, any]:
+    """
+    Encodes a drop, then moves its files into `done/` or `failed/`.
+
+    Args:
+        entry (dict of str: any): Manifest entry with defaults applied.
+        drop (dict of str: str): Drop from `find_drops`.
+        watch_dir (str): Watched folder.
+
+    Returns:
+        (dict of str: any): Result from `batch.run_entry`.
+    """
+    result = batch.run_entry(entry)
+    _move_drop(drop, watch_dir, 'done' if result['ok'] else 'failed')
+    if result['ok']:
+        _log.info("[done] %s (%.1fs)", entry['input'], result['seconds'])
+    else:
+        _log.error("[FAILED] %s (%.1fs)\n%s", entry['input'],
+                   result['seconds'], result['error'].rstrip())
+    return result
+
+
+def _fail_drop(
+        stem: str,
+        drop: Dict[str, str],
+        watch_dir: str,
+        abandoned: set) -> None:
+    """
+    Moves the files of a failed drop into `failed/`. If they can't be
+    moved, the drop is added to `abandoned` so that it isn't picked up
+    again until the watch restarts.
+
+    Args:
+        stem (str): Name of the drop.
+        drop (dict of str: str): Drop from `find_drops`.
+        watch_dir (str): Watched folder.
+        abandoned (set of str): Names of drops to leave alone.
+    """
+    try:
+        _move_drop(drop, watch_dir, 'failed')
+    except OSError as error:
+        _log.error("Can't move %s to failed/, ignoring it: %s",
+                   drop['video'], error)
+        abandoned.add(stem)
+
+
+def _move_drop(
+        drop: Dict[str, str],
+        watch_dir: str,
+        status: str) -> None:
+    """
+    Moves the files of a drop that are in the watched folder into the
+    subfolder named after its status.
+
+    Args:
+        drop (dict of str: str): Drop from `find_drops`.
+        watch_dir (str): Watched folder.
+        status (str): `done` or `failed`.
+    """
+    target_dir = os.path.join(watch_dir, status)
+    os.makedirs(target_dir, exist_ok=True)
+    for path in drop.values():
+        if (os.path.dirname(os.path.abspath(path)) ==
+                os.path.abspath(watch_dir) and os.path.exists(path)):
+            shutil.move(path, os.path.join(
+                target_dir, os.path.basename(path)))
+
+
+class _Inotify:
+    """
+    Wakes the watch loop when files are written to or moved into a folder.
+
+    Args:
+        path (str): Folder to watch.
+
+    Raises:
+        OSError: If inotify isn't available.
+    """
+
+    def __init__(self, path: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        if libc.inotify_add_watch(self._fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"Can't watch {path}")
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Waits until a change is reported or the timeout passes.
+
+        Args:
+            timeout (float): Maximum seconds to wait.
+
+        Returns:
+            (bool): Whether a change was reported.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        """
+        Stops watching.
+        """
+        os.close(self._fd)
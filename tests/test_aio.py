@@ -0,0 +1,84 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from amqencode import aio
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+@pytest.fixture(autouse=True)
+def event_loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def test_run_ffmpeg_kills_its_process_when_cancelled(tmp_path):
+    output_file = str(tmp_path / 'out.txt')
+    pid_file = str(tmp_path / 'pid')
+    # Writes to the partial path of output_file, like ffmpeg would.
+    cmd = ['sh', '-c', f"echo $$ > {pid_file}; touch \"$0\"; exec sleep 30",
+           output_file]
+
+    async def cancel_soon():
+        task = asyncio.ensure_future(aio.run_ffmpeg(
+            cmd, output_file=output_file))
+        while not os.path.exists(pid_file):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    _run(cancel_soon())
+    assert time.monotonic() - start < 10
+    with open(pid_file) as file:
+        pid = int(file.read())
+    with pytest.raises(OSError):
+        os.kill(pid, 0)
+    assert os.listdir(str(tmp_path)) == ['pid']
+
+
+def test_gather_cancels_siblings_of_a_failed_job():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('encode failed')
+
+    with pytest.raises(RuntimeError, match='encode failed'):
+        _run(aio._gather(slow(), fail(), slow()))
+    assert cancelled == [True, True]
+
+
+def test_gather_returns_results_in_order():
+    async def value(x, delay):
+        await asyncio.sleep(delay)
+        return x
+
+    assert _run(aio._gather(value(1, 0.02), value(2, 0))) == [1, 2]
+
+
+def test_probe_returns_a_copy_of_the_cached_result(tmp_path):
+    input_file = str(tmp_path / 'in.mkv')
+    with open(input_file, 'w') as file:
+        file.write('source')
+    aio.probe_.store_cached(input_file, {
+        'streams': [{'codec_type': 'audio'}], 'format': {'duration': '3'}})
+    metadata = _run(aio.probe(input_file))
+    metadata['streams'].clear()
+    assert _run(aio.probe(input_file))['streams'] == [
+        {'codec_type': 'audio'}]
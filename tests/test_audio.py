@@ -0,0 +1,66 @@
+import pytest
+
+from amqencode import audio
+
+
+def _metadata(stream_duration=None, format_duration=None):
+    stream = {'codec_type': 'audio'}
+    if stream_duration is not None:
+        stream['duration'] = stream_duration
+    container = {'filename': 'in.mkv'}
+    if format_duration is not None:
+        container['duration'] = format_duration
+    return {'streams': [{'codec_type': 'video'}, stream], 'format': container}
+
+
+def test_duration_prefers_the_audio_stream():
+    assert audio.duration_from_metadata(_metadata('12.5', '13.0')) == 12.5
+
+
+def test_duration_without_a_container_duration():
+    assert audio.duration_from_metadata(_metadata('12.5')) == 12.5
+
+
+def test_duration_falls_back_to_the_container():
+    assert audio.duration_from_metadata(_metadata(None, '13.0')) == 13.0
+
+
+def test_duration_missing_everywhere():
+    with pytest.raises(ValueError, match='No duration'):
+        audio.duration_from_metadata(_metadata())
+
+
+def test_duration_without_audio():
+    with pytest.raises(ValueError, match='No audio stream'):
+        audio.duration_from_metadata(
+            {'streams': [{'codec_type': 'video'}],
+             'format': {'filename': 'in.mkv', 'duration': '1'}})
+
+
+def test_parse_volumedetect():
+    assert audio.parse_volumedetect([
+        '[Parsed_volumedetect_0 @ 0x0] n_samples: 480000',
+        '[Parsed_volumedetect_0 @ 0x0] mean_volume: -21.5 dB',
+        '[Parsed_volumedetect_0 @ 0x0] max_volume: -0.4 dB']) == {
+            'peak_db': -0.4, 'mean_db': -21.5, 'n_samples': 480000}
+
+
+def test_merge_levels_weights_the_mean_by_energy_and_samples():
+    levels = audio.merge_levels([
+        {'peak_db': -6.0, 'mean_db': -20.0, 'n_samples': 300},
+        {'peak_db': -1.0, 'mean_db': -10.0, 'n_samples': 100}])
+    assert levels['peak_db'] == -1.0
+    # (300 * 0.01 + 100 * 0.1) / 400 = 0.0325
+    assert levels['mean_db'] == pytest.approx(-14.881, abs=1e-3)
+
+
+def test_merge_levels_of_one_segment_is_unchanged():
+    levels = audio.merge_levels(
+        [{'peak_db': -3.0, 'mean_db': -18.0, 'n_samples': 50}])
+    assert levels == {'peak_db': -3.0, 'mean_db': pytest.approx(-18.0)}
+
+
+def test_merge_levels_without_any_levels():
+    assert audio.merge_levels(
+        [{'peak_db': None, 'mean_db': None, 'n_samples': 0}]) == {
+            'peak_db': None, 'mean_db': None}
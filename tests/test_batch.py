@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from amqencode import batch, encode, trace
+
+
+def test_max_processes_limits_jobs_across_entries(tmp_path, monkeypatch):
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def job():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    def fake_encode_all(input_file, output_dir, executor='thread', **kwargs):
+        # Stands in for run_plan, which submits every job to the executor.
+        for future in [executor.submit(job) for _ in range(4)]:
+            future.result()
+
+    monkeypatch.setattr(encode, 'encode_all', fake_encode_all)
+    entries = [{'input': str(tmp_path / f"{i}.mkv")} for i in range(4)]
+    summary = batch.run_batch(
+        entries, max_jobs=4, max_workers=4, max_processes=3)
+    assert summary['succeeded'] == 4
+    assert peak[0] <= 3
+
+
+def test_entries_default_to_a_folder_per_input(tmp_path):
+    manifest_file = tmp_path / 'manifest.json'
+    manifest_file.write_text(json.dumps([
+        {'input': 'ep01.mkv', 'clean_audio': 'ep01.wav'},
+        {'input': 'ep02.mkv'}]))
+    entries = batch.load_manifest(str(manifest_file))
+    assert [batch.output_dirs(entry) for entry in entries] == [
+        (str(tmp_path / 'ep01' / 'source'), str(tmp_path / 'ep01' / 'clean')),
+        (str(tmp_path / 'ep02' / 'source'), str(tmp_path / 'ep02' / 'clean'))]
+
+
+def test_entries_cannot_share_an_output_folder(tmp_path):
+    manifest_file = tmp_path / 'manifest.json'
+    manifest_file.write_text(json.dumps([
+        {'input': 'ep01.mkv', 'ss': '1:00', 'to': '2:00'},
+        {'input': 'ep01.mkv', 'ss': '5:00', 'to': '6:00'}]))
+    with pytest.raises(ValueError, match='both write to'):
+        batch.load_manifest(str(manifest_file))
+
+
+def test_entry_counts_only_the_bytes_it_wrote(tmp_path, monkeypatch):
+    output_dir = tmp_path / 'ep01' / 'source'
+    output_dir.mkdir(parents=True)
+    (output_dir / 'old.webm').write_bytes(b'x' * 1000)
+
+    def fake_encode_all(input_file, output_dir, **kwargs):
+        output_file = os.path.join(output_dir, '480.webm')
+        with open(output_file, 'wb') as file:
+            file.write(b'x' * 10)
+        for stage in ('pass 2', 'validate'):
+            trace.stage_result(stage, '480.webm', [], 0, 0, 0,
+                               output_file=output_file)
+        trace.stage_result(
+            'skip', '0.mp3', [], 0, 0, 0,
+            output_file=os.path.join(output_dir, 'old.webm'))
+
+    monkeypatch.setattr(encode, 'encode_all', fake_encode_all)
+    result = batch.run_entry({'input': str(tmp_path / 'ep01.mkv')})
+    assert result['ok']
+    assert result['bytes'] == 10
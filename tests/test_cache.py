@@ -0,0 +1,50 @@
+import os
+
+from amqencode import cache
+
+
+def _entry(directory, name, mtime, size=1, folder=False):
+    path = os.path.join(directory, name)
+    if folder:
+        os.mkdir(path)
+        with open(os.path.join(path, 'data'), 'wb') as file:
+            file.write(b'x' * size)
+    else:
+        with open(path, 'wb') as file:
+            file.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_evict_lru_keeps_the_newest_entries(tmp_path):
+    for i in range(5):
+        _entry(str(tmp_path), f"entry-{i}", 1000 + i)
+    cache.evict_lru(str(tmp_path), max_entries=2)
+    assert sorted(os.listdir(tmp_path)) == ['entry-3', 'entry-4']
+
+
+def test_evict_lru_by_size_counts_folders(tmp_path):
+    _entry(str(tmp_path), 'old', 1000, size=40)
+    _entry(str(tmp_path), 'folder', 1001, size=40, folder=True)
+    _entry(str(tmp_path), 'new', 1002, size=40)
+    cache.evict_lru(str(tmp_path), max_bytes=100)
+    assert sorted(os.listdir(tmp_path)) == ['folder', 'new']
+    cache.evict_lru(str(tmp_path), max_bytes=50)
+    assert os.listdir(tmp_path) == ['new']
+
+
+def test_touch_makes_an_entry_recent(tmp_path):
+    old = _entry(str(tmp_path), 'old', 1000)
+    _entry(str(tmp_path), 'new', 1001)
+    cache.touch(old)
+    cache.evict_lru(str(tmp_path), max_entries=1)
+    assert os.listdir(tmp_path) == ['old']
+
+
+def test_evict_lru_missing_directory(tmp_path):
+    cache.evict_lru(str(tmp_path / 'missing'), max_entries=0)
+
+
+def test_hash_key_is_stable():
+    assert cache.hash_key({'b': 1, 'a': 2}) == cache.hash_key({'a': 2, 'b': 1})
+    assert cache.hash_key([1]) != cache.hash_key([2])
@@ -0,0 +1,84 @@
+import os
+import time
+
+import pytest
+
+from amqencode import common
+
+
+def test_partial_path_is_hidden_and_keeps_the_extension(tmp_path):
+    output_file = str(tmp_path / 'out.webm')
+    partial_file = common.partial_path(output_file)
+    assert os.path.dirname(partial_file) == str(tmp_path)
+    name = os.path.basename(partial_file)
+    assert name.startswith('.out.partial-')
+    assert name.endswith('.webm')
+
+
+def test_stage_outputs_rewrites_only_outputs(tmp_path):
+    output_file = str(tmp_path / 'out.webm')
+    cmd = ['ffmpeg', '-i', 'in.mp4', output_file]
+    staged = common.stage_outputs(cmd, [output_file])
+    assert staged[:3] == cmd[:3]
+    assert staged[3] == common.partial_path(output_file)
+    assert cmd[3] == output_file
+
+
+def test_finish_outputs_moves_partials_into_place(tmp_path):
+    output_file = str(tmp_path / 'out.webm')
+    with open(output_file, 'w') as file:
+        file.write('old')
+    with open(common.partial_path(output_file), 'w') as file:
+        file.write('new')
+    common.finish_outputs([output_file], True)
+    with open(output_file) as file:
+        assert file.read() == 'new'
+    assert os.listdir(str(tmp_path)) == ['out.webm']
+
+
+def test_finish_outputs_removes_partials_of_failed_commands(tmp_path):
+    output_file = str(tmp_path / 'out.webm')
+    with open(common.partial_path(output_file), 'w') as file:
+        file.write('truncated')
+    common.finish_outputs([output_file], False)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_stage_outputs_only_removes_stale_partials_of_other_writers(tmp_path):
+    output_file = str(tmp_path / 'out.webm')
+    fresh = str(tmp_path / '.out.partial-otherhost-1-1.webm')
+    stale = str(tmp_path / '.out.partial-otherhost-2-1.webm')
+    own = common.partial_path(output_file)
+    for path in (fresh, stale, own):
+        with open(path, 'w') as file:
+            file.write('x')
+    old = time.time() - common.STALE_PARTIAL_SECONDS - 60
+    os.utime(stale, (old, old))
+    common.stage_outputs(['ffmpeg', output_file], [output_file])
+    assert os.listdir(str(tmp_path)) == [os.path.basename(fresh)]
+
+
+def test_parse_timestamp_forms():
+    assert common.parse_timestamp(90) == 90.0
+    assert common.parse_timestamp('1:30') == 90.0
+    assert common.parse_timestamp('01:01:30.5') == 3690.5
+    assert common.parse_timestamp('-2.5') == -2.5
+    assert common.parse_timestamp('1500ms') == 1.5
+    assert common.parse_timestamp('250000us') == 0.25
+    assert common.parse_timestamp(' 12s ') == 12.0
+
+
+@pytest.mark.parametrize('timestamp', ['', 'abc', '1:30ms', '1:2:3:4'])
+def test_parse_timestamp_rejects_invalid(timestamp):
+    with pytest.raises(ValueError):
+        common.parse_timestamp(timestamp)
+
+
+def test_extract_seek_pops_trim_parameters():
+    kwargs = {'ss': '1:00', 't': 30, 'to': '2:00', 'crf': 30}
+    assert common.extract_seek(kwargs) == [
+        '-ss', '1:00', '-accurate_seek', '-t', '30']
+    assert kwargs == {'crf': 30}
+    kwargs = {'to': '2:00'}
+    assert common.extract_seek(kwargs) == ['-to', '2:00']
+    assert kwargs == {}
@@ -0,0 +1,83 @@
+import os
+
+from amqencode import capabilities, encode, mezzanine, probe, ratecontrol
+
+
+def _compile(tmp_path, monkeypatch, **kwargs):
+    # Stands in for the probes: a 10 second source with one mp3 and one webm.
+    output_dir = str(tmp_path)
+    outputs = {
+        os.path.join(output_dir, '0.mp3'): None,
+        os.path.join(output_dir, '480.webm'): {
+            'scale': '853x480', 'setsar': 1}}
+    settings = {os.path.join(output_dir, '480.webm'): {'threads': 4}}
+
+    def prepare_outputs(input_file, output_dir, muted, skip_resolutions,
+                        budget, draft, kwargs):
+        output_settings = {k: dict(v) for k, v in settings.items()}
+        return dict(outputs), output_settings, kwargs.pop('af', {})
+
+    monkeypatch.setattr(encode, '_prepare_outputs', prepare_outputs)
+    monkeypatch.setattr(capabilities, 'require_outputs', lambda *args: {})
+    monkeypatch.setattr(ratecontrol, 'trim_range', lambda *args: (0, 10))
+    return encode.compile_encode_all('in.mkv', output_dir, **kwargs)
+
+
+def test_norm_measures_the_unfiltered_source(tmp_path, monkeypatch):
+    for shared_audio in (True, False):
+        job_plan = _compile(
+            tmp_path, monkeypatch, norm=True, max_workers=2,
+            shared_audio=shared_audio, af={'highpass': 'f=200'})
+        measures = [job for job in job_plan['jobs']
+                    if job['stage'] == 'volumedetect']
+        assert len(measures) == 2
+        for job in measures:
+            assert job['inputs'] == ['in.mkv']
+            assert 'highpass' not in ' '.join(job['cmd'])
+        assert any('volume={gain}' in ' '.join(job['cmd'])
+                   for job in job_plan['jobs'] if job['cmd'] is not None)
+
+
+def test_size_cap_picks_a_crf_per_split_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        ratecontrol, 'select_crf',
+        lambda input_file, video_bitrate, **kwargs: 40)
+    job_plan = _compile(
+        tmp_path, monkeypatch, engine='split', target_size='8M')
+    pass_2 = next(job for job in job_plan['jobs']
+                  if job['id'] == 'split:pass2')
+    cmd = pass_2['cmd']
+    assert cmd[cmd.index('-crf') + 1] == '40'
+
+
+def _mezzanine_source(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(mezzanine, 'MEZZANINE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(probe, 'probe', lambda input_file: {
+        'streams': [{'codec_type': 'video'}, {'codec_type': 'audio'}]})
+    with open('in.mkv', 'w') as file:
+        file.write('source')
+    return mezzanine.mezzanine_path('in.mkv', {'ss': 1, 'to': 5})
+
+
+def test_missing_mezzanine_is_cut_after_making_room(tmp_path, monkeypatch):
+    mezzanine_file = _mezzanine_source(tmp_path, monkeypatch)
+    job_plan = _compile(tmp_path, monkeypatch, mezzanine=True, ss=1, to=5)
+    cut = next(job for job in job_plan['jobs'] if job['id'] == 'mezzanine')
+    assert cut['outputs'] == [mezzanine_file]
+    assert cut['args'] == {'cache_bytes': mezzanine.MEZZANINE_CACHE_BYTES}
+    assert '0:v:0' in cut['cmd'] and '0:a:0' in cut['cmd']
+    assert all(job['inputs'] == [mezzanine_file] for job in job_plan['jobs']
+               if job['stage'] == 'volumedetect')
+
+
+def test_cached_mezzanine_is_reused_and_marked_used(tmp_path, monkeypatch):
+    mezzanine_file = _mezzanine_source(tmp_path, monkeypatch)
+    os.makedirs(os.path.dirname(mezzanine_file))
+    with open(mezzanine_file, 'w') as file:
+        file.write('mezzanine')
+    os.utime(mezzanine_file, (1, 1))
+    job_plan = _compile(tmp_path, monkeypatch, mezzanine=True, ss=1, to=5)
+    assert all(job['id'] != 'mezzanine' for job in job_plan['jobs'])
+    assert any(job['inputs'] == [mezzanine_file] for job in job_plan['jobs'])
+    assert os.path.getmtime(mezzanine_file) > 1
@@ -0,0 +1,66 @@
+import os
+
+from amqencode import encode, fingerprints, plan
+
+
+def _job(job_id, cmd, outputs=(), deps=(), **kwargs):
+    return plan.make_job(
+        job_id, 'test', job_id, cmd, [], list(outputs), deps, **kwargs)
+
+
+def test_fingerprint_is_recorded_for_nonempty_outputs(tmp_path):
+    source = tmp_path / 'source.mkv'
+    source.write_bytes(b'source')
+    output_file = str(tmp_path / '480.webm')
+    key = fingerprints.fingerprint(str(source), [['ffmpeg', '-crf', '20']])
+    assert key != fingerprints.fingerprint(
+        str(source), [['ffmpeg', '-crf', '21']])
+
+    open(output_file, 'w').close()
+    fingerprints.write_fingerprint(output_file, key)
+    assert not os.path.exists(fingerprints.sidecar_path(output_file))
+
+    with open(output_file, 'w') as file:
+        file.write('webm')
+    fingerprints.write_fingerprint(output_file, key)
+    assert fingerprints.is_up_to_date(output_file, key)
+    fingerprints.clear_fingerprint(output_file)
+    assert not fingerprints.is_up_to_date(output_file, key)
+
+
+def test_output_commands_include_dependencies_but_not_the_mezzanine():
+    jobs = [
+        _job('mezzanine', ['cut']),
+        _job('audio.wav', ['extract'], deps=['mezzanine']),
+        _job('volumedetect-1', ['measure'], deps=['audio.wav']),
+        _job('gain', None, deps=['volumedetect-1'], kind='gain'),
+        _job('0.mp3', ['mp3', '{gain}'], deps=['audio.wav', 'gain']),
+        _job('480.webm:pass1', ['pass1'], deps=['mezzanine']),
+    ]
+    assert encode._job_commands(jobs, '0.mp3') == [
+        ['extract'], ['measure'], ['mp3', '{gain}']]
+
+
+def test_outputs_rewritten_by_an_outdated_job_are_not_skipped(tmp_path):
+    outputs = [str(tmp_path / name) for name in ('0.mp3', '480.webm',
+                                                 '720.webm')]
+    jobs = [
+        _job('0.mp3', ['mp3'], [outputs[0]]),
+        _job('split:pass2', ['split'], outputs[1:]),
+    ]
+    finals = {}
+    for output_file, final in zip(outputs, ['0.mp3'] + ['split:pass2'] * 2):
+        name = os.path.basename(output_file)
+        jobs.append(_job(
+            f"{name}:fingerprint", None, deps=[final], kind='fingerprint',
+            args={'fingerprint': 'new'}))
+        finals[output_file] = f"{name}:fingerprint"
+        with open(output_file, 'w') as file:
+            file.write('output')
+    fingerprints.write_fingerprint(outputs[0], 'new')
+    fingerprints.write_fingerprint(outputs[1], 'new')
+    fingerprints.write_fingerprint(outputs[2], 'old')
+    assert encode._up_to_date(jobs, finals) == [outputs[0]]
+    assert [job['id'] for job in encode._prune(
+        jobs, [finals[outputs[1]], finals[outputs[2]]])] == [
+        'split:pass2', '480.webm:fingerprint', '720.webm:fingerprint']
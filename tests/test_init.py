@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+import amqencode
+
+
+PACKAGE_DIR = os.path.dirname(amqencode.__file__)
+
+
+def test_every_submodule_is_listed():
+    modules = sorted(
+        name[:-3] for name in os.listdir(PACKAGE_DIR)
+        if name.endswith('.py') and not name.startswith('_'))
+    assert list(amqencode._SUBMODULES) == modules
+    assert 'batch' in modules and 'lazy' in modules
+
+
+def test_submodules_load_on_attribute_access():
+    # A fresh interpreter, so that no submodule was imported by another test.
+    code = (
+        "import amqencode, sys\n"
+        "assert 'amqencode.batch' not in sys.modules\n"
+        "for name in amqencode._SUBMODULES:\n"
+        "    assert getattr(amqencode, name).__name__ == 'amqencode.' + name\n")
+    subprocess.run(
+        [sys.executable, '-c', code], check=True,
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(PACKAGE_DIR)))
@@ -0,0 +1,80 @@
+import threading
+import time
+
+from amqencode import jobqueue
+
+
+def _queue(tmp_path, **kwargs):
+    return jobqueue.JobQueue(str(tmp_path / 'queue.db'), **kwargs)
+
+
+def test_claim_takes_jobs_in_order(tmp_path):
+    job_queue = _queue(tmp_path)
+    first = job_queue.submit('mux_clean', input_file='a')
+    second = job_queue.submit('mux_clean', input_file='b')
+    job = job_queue.claim('w1')
+    assert job == {
+        'id': first, 'kind': 'mux_clean', 'args': {'input_file': 'a'},
+        'attempts': 1}
+    assert job_queue.claim('w2')['id'] == second
+    assert job_queue.claim('w3') is None
+
+
+def test_expired_lease_goes_to_another_worker(tmp_path):
+    job_queue = _queue(tmp_path, lease=0.05)
+    job_id = job_queue.submit('mux_clean')
+    job_queue.claim('w1')
+    time.sleep(0.1)
+    job = job_queue.claim('w2')
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+    assert not job_queue.heartbeat(job_id, 'w1')
+    assert not job_queue.finish(job_id, 'w1', True)
+    assert job_queue.heartbeat(job_id, 'w2')
+    assert job_queue.finish(job_id, 'w2', True)
+    assert job_queue.counts() == {'done': 1}
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    job_queue = _queue(tmp_path, lease=0.2)
+    job_id = job_queue.submit('mux_clean')
+    job_queue.claim('w1')
+    for _ in range(3):
+        time.sleep(0.1)
+        assert job_queue.heartbeat(job_id, 'w1')
+    assert job_queue.claim('w2') is None
+
+
+def test_lease_runs_out_max_attempts_times(tmp_path):
+    job_queue = _queue(tmp_path, lease=0.01, max_attempts=2)
+    job_queue.submit('mux_clean')
+    for worker in ('w1', 'w2'):
+        assert job_queue.claim(worker) is not None
+        time.sleep(0.05)
+    assert job_queue.claim('w3') is None
+    assert job_queue.counts() == {'failed': 1}
+
+
+def test_finish_records_errors(tmp_path):
+    job_queue = _queue(tmp_path)
+    job_id = job_queue.submit('mux_clean')
+    job_queue.claim('w1')
+    assert job_queue.finish(job_id, 'w1', False, 'boom')
+    assert job_queue.counts() == {'failed': 1}
+    assert job_queue.jobs()[0]['error'] == 'boom'
+
+
+def test_heartbeat_cancels_a_job_whose_lease_was_lost(tmp_path):
+    job_queue = _queue(tmp_path, lease=0.3)
+    job_id = job_queue.submit('mux_clean')
+    job_queue.claim('w1')
+    time.sleep(0.35)
+    job_queue.claim('w2')
+    done, cancel = threading.Event(), threading.Event()
+    beat = threading.Thread(
+        target=jobqueue._heartbeat,
+        args=(job_queue, job_id, 'w1', done, cancel))
+    beat.start()
+    assert cancel.wait(5)
+    beat.join(5)
+    assert not beat.is_alive()
@@ -0,0 +1,41 @@
+from amqencode import journal
+
+
+def test_load_states_keeps_the_last_state_of_each_job(tmp_path):
+    journal_file = str(tmp_path / 'manifest.json.journal')
+    writer = journal.Journal(journal_file)
+    writer.write('a', 'running')
+    writer.write('b', 'running')
+    writer.write('a', 'stage', stage='pass 1')
+    writer.write('a', 'done')
+    writer.write('b', 'failed')
+    writer.write('b', 'running')
+    writer.close()
+    assert journal.load_states(journal_file) == {'a': 'done', 'b': 'running'}
+
+
+def test_load_states_ignores_a_torn_last_line(tmp_path):
+    journal_file = str(tmp_path / 'manifest.json.journal')
+    writer = journal.Journal(journal_file)
+    writer.write('a', 'done')
+    writer.close()
+    with open(journal_file, 'a') as file:
+        file.write('{"time": 1, "job": "b", "sta')
+    assert journal.load_states(journal_file) == {'a': 'done'}
+
+
+def test_load_states_of_a_missing_journal(tmp_path):
+    assert journal.load_states(str(tmp_path / 'missing.journal')) == {}
+
+
+def test_resumed_journal_appends(tmp_path):
+    journal_file = str(tmp_path / 'manifest.json.journal')
+    writer = journal.Journal(journal_file)
+    writer.write('a', 'done')
+    writer.close()
+    writer = journal.Journal(journal_file, resume=True)
+    writer.write('b', 'done')
+    writer.close()
+    assert journal.load_states(journal_file) == {'a': 'done', 'b': 'done'}
+    journal.Journal(journal_file).close()
+    assert journal.load_states(journal_file) == {}
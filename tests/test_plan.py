@@ -0,0 +1,156 @@
+import os
+import stat
+from concurrent.futures import Executor, Future
+
+import pytest
+
+from amqencode import plan, resources, trace
+
+
+def _fake_ffmpeg(directory):
+    # Logs its arguments, writes a line to the last one if it ends in .txt,
+    # reports levels like volumedetect and fails if any argument is `fail`.
+    path = os.path.join(directory, 'ffmpeg')
+    with open(path, 'w') as file:
+        file.write(
+            '#!/bin/sh\n'
+            f'echo "$@" >> {os.path.join(directory, "log")}\n'
+            'for arg; do :; done\n'
+            'case "$arg" in *.txt) echo written > "$arg";; esac\n'
+            'echo " mean_volume: -20.0 dB" >&2\n'
+            'echo " max_volume: -6.0 dB" >&2\n'
+            'echo " n_samples: 100" >&2\n'
+            'case " $* " in *" fail "*) exit 1;; esac\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+class _RecordingExecutor(Executor):
+    """Runs each call right away and records the IDs of submitted jobs."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted.append(args[0]['id'])
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+class _RecordingBudget(resources.CpuBudget):
+    """Records the threads held by running jobs."""
+
+    def __init__(self, total):
+        super().__init__(total)
+        self.held = 0
+        self.peak = 0
+
+    def acquire(self, threads):
+        threads = super().acquire(threads)
+        self.held += threads
+        self.peak = max(self.peak, self.held)
+        return threads
+
+    def release(self, threads):
+        self.held -= threads
+        super().release(threads)
+
+
+def _job(job_id, deps=(), **kwargs):
+    return plan.make_job(job_id, 'test', job_id, None, [], [], deps, **kwargs)
+
+
+def test_order_runs_dependencies_first_and_keeps_plan_order():
+    job_plan = {'jobs': [
+        _job('mux', ['video', 'audio']), _job('video'), _job('audio'),
+        _job('mp3', ['audio'])]}
+    assert [job['id'] for job in plan.order(job_plan)] == [
+        'video', 'audio', 'mux', 'mp3']
+
+
+def test_order_rejects_unknown_dependencies_and_cycles():
+    with pytest.raises(ValueError):
+        plan.order({'jobs': [_job('a', ['missing'])]})
+    with pytest.raises(ValueError):
+        plan.order({'jobs': [_job('a', ['b']), _job('b', ['a'])]})
+
+
+def test_format_plan_lists_skipped_outputs_first():
+    job_plan = {
+        'jobs': [plan.make_job(
+            'a', 'mp3', 'a', ['ffmpeg', '-i', 'in file', 'out.mp3'],
+            ['in file'], ['out.mp3'])],
+        'skipped': ['source/480.webm']}
+    assert plan.format_plan(job_plan).splitlines() == [
+        '# source/480.webm is up to date',
+        '# [a] mp3',
+        "ffmpeg -i 'in file' out.mp3"]
+
+
+def test_run_plan_passes_gain_and_work_folder_to_later_jobs(tmp_path):
+    ffmpeg = _fake_ffmpeg(str(tmp_path))
+    output_file = str(tmp_path / 'out' / 'final.txt')
+    job_plan = {'jobs': [
+        plan.make_job(
+            'volumedetect', 'volumedetect', 'volumedetect',
+            [ffmpeg, '-i', 'in.wav'], ['in.wav'], [], parse='volumedetect'),
+        _job('gain', ['volumedetect'], kind='gain'),
+        plan.make_job(
+            'encode', 'mp3', 'encode',
+            [ffmpeg, '-af', 'volume={gain}', '{work}/audio.txt'],
+            ['in.wav'], ['{work}/audio.txt'], ['gain']),
+        plan.make_job(
+            'copy', 'copy', 'copy', None, ['{work}/audio.txt'],
+            [output_file], ['encode'], kind='copy')]}
+    results = plan.run_plan(job_plan, 'thread', 2)
+    assert [r['stage'] for r in results] == ['volumedetect', 'mp3']
+    assert trace.failed(results) == []
+    with open(output_file) as file:
+        assert file.read() == 'written\n'
+    with open(str(tmp_path / 'log')) as file:
+        # Peak -6 dB and mean -20 dB are 5.5 and 1.5 dB below the targets.
+        assert 'volume=1.5dB' in file.read()
+
+
+def test_run_plan_skips_jobs_that_depend_on_failed_ones(tmp_path):
+    ffmpeg = _fake_ffmpeg(str(tmp_path))
+    job_plan = {
+        'jobs': [
+            plan.make_job('pass1', 'pass 1', 'a', [ffmpeg, 'fail'], [], []),
+            plan.make_job('pass2', 'pass 2', 'a', [ffmpeg], [], [],
+                          ['pass1']),
+            plan.make_job('mp3', 'mp3', 'b', [ffmpeg], [], [])],
+        'skipped': [str(tmp_path / 'c.webm')]}
+    executor = _RecordingExecutor()
+    results = plan.run_plan(job_plan, executor)
+    assert executor.submitted == ['pass1', 'mp3']
+    assert sorted((r['stage'], r['returncode']) for r in results) == [
+        ('mp3', 0), ('pass 1', 1), ('skip', 0)]
+
+
+def test_run_plan_reserves_threads_of_each_job_from_the_budget(tmp_path):
+    ffmpeg = _fake_ffmpeg(str(tmp_path))
+    job_plan = {'jobs': [
+        plan.make_job(f"chunk-{i}", 'pass 1', 'a', [ffmpeg], [], [],
+                      threads=2)
+        for i in range(4)]}
+    budget = _RecordingBudget(4)
+    results = plan.run_plan(job_plan, 'thread', 4, budget=budget)
+    assert len(results) == 4
+    assert budget.peak <= 4
+    assert budget.held == 0
+
+
+def test_prepare_job_evicts_its_cache_folder_first(tmp_path):
+    cache_dir = tmp_path / 'mezzanine'
+    cache_dir.mkdir()
+    for i, name in enumerate(['old.mkv', 'recent.mkv']):
+        path = cache_dir / name
+        path.write_bytes(b'x' * 10)
+        os.utime(str(path), (1000 + i, 1000 + i))
+    new_file = str(cache_dir / 'new.mkv')
+    plan.prepare_job(plan.make_job(
+        'mezzanine', 'mezzanine', 'in.mkv', ['ffmpeg', new_file], ['in.mkv'],
+        [new_file], args={'cache_bytes': 15}), {})
+    assert sorted(os.listdir(str(cache_dir))) == ['recent.mkv']
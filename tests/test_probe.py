@@ -0,0 +1,59 @@
+import pytest
+
+from amqencode import probe
+
+
+_INDEX = {
+    'keyframes': [0.0, 10.0, 20.0],
+    'positions': [0, 1000, 2000],
+    'duration': 30.0,
+    'frame_rate': '25/1',
+}
+
+
+def test_plan_seek_snaps_onto_a_keyframe_less_than_a_frame_later():
+    assert probe.plan_seek(_INDEX, 19.99) == {
+        'start': 20.0, 'keyframe': 20.0, 'preroll': 0.0}
+
+
+def test_plan_seek_keeps_other_starts():
+    planned = probe.plan_seek(_INDEX, 15.0)
+    assert planned['start'] == 15.0
+    assert planned['keyframe'] == 10.0
+    assert planned['preroll'] == 5.0
+
+
+def test_snap_seek_shortens_the_duration():
+    assert probe.snap_seek({'ss': '19.99', 't': 5}, _INDEX) == {
+        'ss': '20.000000', 't': '4.990000'}
+    assert probe.snap_seek({'ss': '0:19.99', 'to': 25}, _INDEX) == {
+        'ss': '20.000000'}
+
+
+def test_snap_seek_leaves_far_starts_alone():
+    assert probe.snap_seek({'ss': 15}, _INDEX) == {}
+    assert probe.snap_seek({'t': 5}, _INDEX) == {}
+    assert probe.snap_seek({'ss': 19.99}, None) == {}
+
+
+def _index_without_container_duration(monkeypatch, stream):
+    monkeypatch.setattr(probe, 'probe', lambda input_file, use_cache: {
+        'streams': [dict(stream, index=0, codec_type='video')],
+        'format': {'filename': input_file}})
+    monkeypatch.setattr(probe, 'run_probe', lambda cmd, stage: {'packets': [
+        {'pts_time': '0.000000', 'pos': '48', 'flags': 'K__'},
+        {'pts_time': '0.040000', 'pos': '900', 'flags': '___'}]})
+    return probe.keyframe_index('in.ts', use_cache=False)
+
+
+def test_keyframe_index_falls_back_to_the_stream_duration(monkeypatch):
+    index = _index_without_container_duration(
+        monkeypatch, {'duration': '12.5', 'avg_frame_rate': '25/1'})
+    assert index == {'keyframes': [0.0], 'positions': [48],
+                     'duration': 12.5, 'frame_rate': '25/1'}
+
+
+def test_keyframe_index_without_any_duration(monkeypatch):
+    with pytest.raises(ValueError, match='No duration'):
+        _index_without_container_duration(
+            monkeypatch, {'avg_frame_rate': '25/1'})
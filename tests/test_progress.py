@@ -0,0 +1,67 @@
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from amqencode import progress, trace
+
+
+def _fake_ffmpeg(directory, script):
+    path = os.path.join(directory, 'ffmpeg')
+    with open(path, 'w') as file:
+        file.write('#!/bin/sh\n' + script + '\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def test_parse_progress_reports_each_block():
+    lines = [
+        'fps=24.5', 'out_time_us=1500000', 'speed=1.5x', 'progress=continue',
+        'fps=0.0', 'out_time_us=N/A', 'speed=N/A', 'progress=end']
+    reports = list(progress.parse_progress(lines))
+    assert reports == [
+        {'out_time': 1.5, 'fps': 24.5, 'speed': 1.5, 'end': False},
+        {'out_time': None, 'fps': 0.0, 'speed': None, 'end': True}]
+
+
+def test_run_moves_output_into_place_on_success(tmp_path):
+    # The last argument is the (partial) output path.
+    ffmpeg = _fake_ffmpeg(
+        str(tmp_path), 'for arg; do :; done; echo done > "$arg"')
+    output_file = str(tmp_path / 'out.webm')
+    with trace.recording() as recorder:
+        result = progress.run([ffmpeg, output_file], output_file=output_file)
+    assert result['returncode'] == 0
+    assert recorder.results == [result]
+    assert sorted(os.listdir(str(tmp_path))) == ['ffmpeg', 'out.webm']
+
+
+def test_cancellation_kills_the_process(tmp_path):
+    pid_file = str(tmp_path / 'pid')
+    ffmpeg = _fake_ffmpeg(
+        str(tmp_path),
+        f'for arg; do :; done; touch "$arg"; echo $$ > {pid_file}; '
+        'exec sleep 30')
+    output_file = str(tmp_path / 'out.webm')
+    cancel = threading.Event()
+
+    def cancel_soon():
+        while not os.path.exists(pid_file):
+            time.sleep(0.01)
+        cancel.set()
+
+    threading.Thread(target=cancel_soon, daemon=True).start()
+    start = time.monotonic()
+    with trace.cancellation(cancel), pytest.raises(RuntimeError):
+        progress.run([ffmpeg, output_file], 'out', output_file=output_file)
+    assert time.monotonic() - start < 10
+    assert sorted(os.listdir(str(tmp_path))) == ['ffmpeg', 'pid']
+
+
+def test_cancelled_work_does_not_start():
+    cancel = threading.Event()
+    cancel.set()
+    with trace.cancellation(cancel), pytest.raises(RuntimeError):
+        progress.run(['false'])
@@ -0,0 +1,61 @@
+import os
+import stat
+
+import pytest
+
+from amqencode import ratecontrol
+
+
+def test_parse_size_and_bitrate():
+    assert ratecontrol.parse_size('8M') == 8000000
+    assert ratecontrol.parse_size('7.5MiB') == 7864320
+    assert ratecontrol.parse_size('500kb') == 500000
+    assert ratecontrol.parse_size(1234) == 1234
+    assert ratecontrol.parse_bitrate('320k') == 320000
+    assert ratecontrol.parse_bitrate('1.5M') == 1500000
+    with pytest.raises(ValueError, match='Invalid size'):
+        ratecontrol.parse_size('8 potatoes')
+    with pytest.raises(ValueError, match='Invalid bitrate'):
+        ratecontrol.parse_bitrate('')
+
+
+def test_sample_windows_are_centered_in_equal_shares():
+    assert ratecontrol.sample_windows(10, 50, 4, 2) == [
+        (14, 16), (24, 26), (34, 36), (44, 46)]
+
+
+def test_sample_windows_of_a_short_range():
+    assert ratecontrol.sample_windows(10, 17, 4, 2) == [(10, 17)]
+
+
+def test_interpolate_between_the_samples_around_the_target():
+    # The bitrate halves every 4 crf: 1000 at crf 30, 250 at crf 38.
+    samples = {30: 1000.0, 38: 250.0}
+    assert ratecontrol._interpolate(samples, 500) == 34
+    assert ratecontrol._interpolate(samples, 499) == 35
+
+
+def test_interpolate_keeps_the_lowest_fitting_sample():
+    assert ratecontrol._interpolate({30: 400.0, 38: 100.0}, 500) == 30
+
+
+def test_interpolate_extrapolates_past_the_samples():
+    assert ratecontrol._interpolate({30: 1000.0, 38: 500.0}, 250) == 46
+
+
+def test_interpolate_without_a_falling_bitrate():
+    assert ratecontrol._interpolate({30: 1000.0, 38: 1000.0}, 500) == (
+        ratecontrol.MAX_CRF)
+
+
+def test_failed_sample_raises_with_its_log(tmp_path, monkeypatch):
+    ffmpeg_path = str(tmp_path / 'ffmpeg')
+    with open(ffmpeg_path, 'w') as file:
+        file.write('#!/bin/sh\necho "Unknown encoder" >&2\nexit 1\n')
+    os.chmod(ffmpeg_path, os.stat(ffmpeg_path).st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    sampler = ratecontrol._Sampler(
+        'in.mkv', [(0, 2)], str(tmp_path), 1, None, 'in.mkv', {})
+    with pytest.raises(ratecontrol.ffmpeg.Error) as error:
+        sampler.run_pass_1(30)
+    assert b'Unknown encoder' in error.value.stderr
@@ -0,0 +1,15 @@
+from amqencode import trace, validate
+
+
+def test_failed_checks_reach_the_stage_result(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        validate, '_check', lambda output_file, expected: ['Not indexed'])
+    output_file = str(tmp_path / '480.webm')
+    with trace.recording() as recorder:
+        report = validate.validate_output(output_file)
+    assert report == {'output': output_file, 'ok': False,
+                      'errors': ['Not indexed']}
+    result, = recorder.results
+    assert result['errors'] == ['Not indexed']
+    assert trace.format_failure(result) == (
+        'validate 480.webm exited with code 1\n  Not indexed')
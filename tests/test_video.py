@@ -0,0 +1,61 @@
+from fractions import Fraction
+
+from amqencode import encode, video
+
+
+def test_plan_chunks_splits_on_keyframes():
+    keyframes = [0, 2, 4, 6, 8, 10]
+    assert video.plan_chunks(keyframes, 0, 12, 3) == [
+        (0, 4), (4, 8), (8, 12)]
+
+
+def test_plan_chunks_keeps_chunks_at_least_min_duration():
+    keyframes = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    assert video.plan_chunks(keyframes, 0, 10, 4, min_duration=4) == [
+        (0, 4), (4, 10)]
+
+
+def test_plan_chunks_falls_back_to_one_chunk_without_keyframes():
+    assert video.plan_chunks([0], 1.5, 9.5, 4) == [(1.5, 9.5)]
+
+
+def test_chunk_jobs_are_separate_plan_jobs():
+    timing = {
+        'keyframes': [0, 2, 4, 6, 8], 'duration': 10, 'fps': Fraction(24)}
+    jobs = encode._compile_chunked_jobs(
+        'in.mkv', 'out.webm', 'out.webm', False, [], ['gain'], 2, timing,
+        muted=False, vf={'scale': '640x360'}, af={'volume': '{gain}'},
+        g=24, threads=4)
+    by_id = {job['id']: job for job in jobs}
+    assert [job['id'] for job in jobs] == [
+        'out.webm:chunk-1:pass1', 'out.webm:chunk-1:pass2',
+        'out.webm:chunk-2:pass1', 'out.webm:chunk-2:pass2',
+        'out.webm:list', 'out.webm:audio', 'out.webm:concat']
+    # Every pass is its own job, scheduled and budgeted like any other.
+    assert all(by_id[f"out.webm:chunk-{i}:pass{p}"]['threads'] == 4
+               for i in (1, 2) for p in (1, 2))
+    assert by_id['out.webm:chunk-2:pass1']['deps'] == []
+    assert by_id['out.webm:audio']['deps'] == ['gain']
+    assert sorted(by_id['out.webm:concat']['deps']) == [
+        'out.webm:audio', 'out.webm:chunk-1:pass2',
+        'out.webm:chunk-2:pass2', 'out.webm:list']
+    assert by_id['out.webm:concat']['outputs'] == ['out.webm']
+
+
+def test_split_pass_1_copies_audio_and_keeps_per_output_settings():
+    outputs = {
+        '360.webm': {'scale': '640x360'}, '720.webm': {'scale': '1280x720'}}
+    pass_1_cmd, pass_2_cmd = video.compile_webm_split(
+        'in.mkv', outputs, passlogfile='log',
+        settings={'360.webm': {'threads': 2}, '720.webm': {'threads': 8}},
+        af={'volume': '2dB'}, **{'c:a': 'libopus', 'b:a': '320k', 'ac': 2})
+    # Pass logs are named after global stream indexes, so both passes map
+    # video and audio for every output; pass 1 only copies the audio.
+    assert pass_1_cmd.count('-map') == pass_2_cmd.count('-map') == 4
+    assert 'volume' not in ' '.join(pass_1_cmd)
+    assert pass_1_cmd.count('copy') == 2
+    assert '-b:a' not in pass_1_cmd
+    assert [pass_2_cmd[i + 1] for i, arg in enumerate(pass_2_cmd)
+            if arg == '-threads'] == ['2', '8']
+    assert [pass_2_cmd[i + 1] for i, arg in enumerate(pass_2_cmd)
+            if arg == '-passlogfile'] == ['log-0', 'log-1']
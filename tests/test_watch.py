@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+import pytest
+
+from amqencode import batch, watch
+
+
+def _write(path, content='data'):
+    with open(str(path), 'w') as file:
+        file.write(content)
+    return str(path)
+
+
+def test_find_drops_pairs_files_by_name(tmp_path):
+    video = _write(tmp_path / 'ep01.mkv')
+    audio = _write(tmp_path / 'ep01.wav')
+    sidecar = _write(tmp_path / 'ep01.json', '{}')
+    other = _write(tmp_path / 'ep02.MP4')
+    _write(tmp_path / 'lonely.flac')
+    _write(tmp_path / '.ep03.mkv')
+    (tmp_path / 'done').mkdir()
+    _write(tmp_path / 'done' / 'ep04.mkv')
+    assert watch.find_drops(str(tmp_path)) == {
+        'ep01': {'video': video, 'audio': audio, 'sidecar': sidecar},
+        'ep02': {'video': other}}
+
+
+def test_settled_waits_for_files_to_stop_changing(tmp_path):
+    path = _write(tmp_path / 'ep01.mkv')
+    sizes = {}
+    assert not watch._settled(path, sizes, 100, 5)
+    assert not watch._settled(path, sizes, 104, 5)
+    assert watch._settled(path, sizes, 105, 5)
+    _write(path, 'more data')
+    assert not watch._settled(path, sizes, 106, 5)
+    assert watch._settled(path, sizes, 111, 5)
+    os.remove(path)
+    assert not watch._settled(path, sizes, 112, 5)
+    assert path not in sizes
+
+
+def test_settled_ignores_empty_files(tmp_path):
+    path = _write(tmp_path / 'ep01.mkv', '')
+    sizes = {}
+    assert not watch._settled(path, sizes, 100, 0)
+    assert not watch._settled(path, sizes, 200, 0)
+
+
+def _ready(tmp_path, drop, *paths):
+    # Every file was last seen unchanged long enough ago to have settled.
+    sizes = {
+        path: ((os.path.getsize(path), os.path.getmtime(path)), 0)
+        for path in list(drop.values()) + list(paths)}
+    return watch._ready_entry(
+        'ep01', drop, str(tmp_path), 'out', sizes, 100, 5, False)
+
+
+def test_sidecar_settings_and_clean_audio(tmp_path):
+    drop = {
+        'video': _write(tmp_path / 'ep01.mkv'),
+        'sidecar': _write(tmp_path / 'ep01.json',
+                          '{"ss": "1:39", "norm": "yes", '
+                          '"clean_audio": "clean.flac"}')}
+    clean_audio = _write(tmp_path / 'clean.flac')
+    assert _ready(tmp_path, dict(drop)) is None  # clean.flac is new
+    entry = _ready(tmp_path, drop, clean_audio)
+    assert entry['input'] == drop['video']
+    assert entry['ss'] == '1:39'
+    assert entry['norm'] is True
+    assert entry['clean_audio'] == clean_audio
+    assert entry['output_dir'] == os.path.join(
+        str(tmp_path), 'out', 'ep01', 'source')
+    assert drop['audio'] == clean_audio
+
+
+def test_invalid_sidecar_fails_the_drop(tmp_path):
+    drop = {'video': _write(tmp_path / 'ep01.mkv'),
+            'sidecar': _write(tmp_path / 'ep01.json', '{"ss": ')}
+    with pytest.raises(ValueError, match='Invalid sidecar'):
+        _ready(tmp_path, drop)
+
+
+def test_unreadable_sidecar_fails_the_drop(tmp_path):
+    # A folder passes the settle check, but can't be read.
+    drop = {'video': _write(tmp_path / 'ep01.mkv'),
+            'sidecar': str(tmp_path / 'ep01.json')}
+    os.mkdir(drop['sidecar'])
+    with pytest.raises(ValueError, match='Invalid sidecar'):
+        _ready(tmp_path, drop)
+
+
+def test_watch_moves_drops_and_survives_errors(tmp_path, monkeypatch):
+    def no_inotify(path):
+        raise OSError('polling')
+
+    def fake_run_entry(entry):
+        name = os.path.basename(entry['input'])
+        if name == 'crash.mkv':
+            raise OSError('source vanished')
+        return {'input': entry['input'], 'ok': name == 'good.mkv',
+                'seconds': 0, 'error': 'pass 2 exited with code 1\n'}
+
+    monkeypatch.setattr(watch, '_Inotify', no_inotify)
+    monkeypatch.setattr(batch, 'run_entry', fake_run_entry)
+    for name in ('good.mkv', 'good.wav', 'bad.mkv', 'crash.mkv'):
+        _write(tmp_path / name)
+    _write(tmp_path / 'broken.mkv')
+    _write(tmp_path / 'broken.json', 'not json')
+
+    stop = threading.Event()
+    thread = threading.Thread(target=watch.watch, args=(str(tmp_path),),
+                              kwargs={'settle': 0, 'poll_interval': 0.01,
+                                      'max_jobs': 2, 'stop': stop})
+    thread.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and len(watch.find_drops(
+            str(tmp_path))) != 0:
+        time.sleep(0.05)
+    time.sleep(0.1)
+    stop.set()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert sorted(os.listdir(str(tmp_path / 'done'))) == [
+        'good.mkv', 'good.wav']
+    assert sorted(os.listdir(str(tmp_path / 'failed'))) == [
+        'bad.mkv', 'broken.json', 'broken.mkv', 'crash.mkv']